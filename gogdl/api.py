@@ -2,8 +2,10 @@ import logging
 import time
 import requests
 import json
+import threading
 from multiprocessing import cpu_count
 from gogdl.dl import dl_utils
+from gogdl import http_cache
 from gogdl import version
 import gogdl.constants as constants
 from gogdl import version
@@ -15,7 +17,8 @@ class ApiHandler:
         self.auth_manager = auth_manager
         self.logger = logging.getLogger("API")
         self.session = requests.Session()
-        adapter = requests.adapters.HTTPAdapter(pool_maxsize=cpu_count())
+        self.cache = http_cache.HttpCache(constants.HTTP_CACHE_DIR)
+        adapter = http_cache.CachingAdapter(self.cache, pool_maxsize=cpu_count())
         self.session.mount("https://", adapter)
         self.session.headers = {
             'User-Agent': f'gogdl/{version} (Heroic Games Launcher)'
@@ -25,6 +28,9 @@ class ApiHandler:
             token = credentials["access_token"]
             self.session.headers["Authorization"] = f"Bearer {token}"
         self.owned = []
+        self.dependencies_repository = None
+        # Guards data shared by managers running in threads
+        self.cache_lock = threading.Lock()
 
         self.endpoints = dict()  # Map of secure link endpoints
         self.working_on_ids = list()  # List of products we are waiting for to complete getting the secure link
@@ -62,10 +68,26 @@ class ApiHandler:
         json_data = json.loads(response.content)
         return json_data
 
+    def get_dependencies_repository(self):
+        """
+        Returns manifest of dependencies repository, fetched once per handler
+        """
+        with self.cache_lock:
+            if self.dependencies_repository is None:
+                build = self.get_dependencies_repo()
+                self.dependencies_repository = dl_utils.get_zlib_encoded(self, build['repository_manifest'])[0] or {}
+            return self.dependencies_repository
+
+    def set_workers(self, count):
+        # Connection per thread using the handler
+        adapter = http_cache.CachingAdapter(self.cache, pool_maxsize=max(cpu_count(), count))
+        self.session.mount("https://", adapter)
+
     def does_user_own(self, id):
-        if not self.owned:
-            response = self.session.get(f'{constants.GOG_EMBED}/user/data/games')
-            self.owned = response.json()['owned']
+        with self.cache_lock:
+            if not self.owned:
+                response = self.session.get(f'{constants.GOG_EMBED}/user/data/games')
+                self.owned = response.json()['owned']
         for owned in self.owned:
             if str(owned) == str(id):
                 return True
@@ -1,9 +1,9 @@
 # Initialize argparse module and return arguments
 import argparse
-from multiprocessing import cpu_count
+from os import cpu_count
 
 
-def init_parser():
+def init_parser(argv=None):
     parser = argparse.ArgumentParser(
         description="GOG downloader for Heroic Games Launcher"
     )
@@ -18,6 +18,8 @@ def init_parser():
 
     parser.add_argument("--auth-config-path", dest="auth_config_path",
                         help="Path to json file where tokens will be stored", required=False)
+    parser.add_argument("--no-cache", dest="no_cache", action="store_true",
+                        help="Don't use cached API responses, fresh ones are still stored (also GOGDL_NO_CACHE)")
 
     subparsers = parser.add_subparsers(dest="command")
 
@@ -37,7 +39,7 @@ def init_parser():
     redist_download_parser.add_argument(
         "--max-workers",
         dest="workers_count",
-        default=cpu_count(),
+        default=cpu_count() or 1,
         help="Specify number of worker threads, by default number of CPU threads",
     )
 
@@ -92,9 +94,48 @@ def init_parser():
     download_parser.add_argument(
         "--max-workers",
         dest="workers_count",
-        default=cpu_count(),
+        default=cpu_count() or 1,
         help="Specify number of worker threads, by default number of CPU threads",
     )
+    download_parser.add_argument(
+        "--local-installer",
+        dest="local_installer",
+        help="Path to local .sh installer to install Linux native game from, instead of downloading it",
+    )
+    download_parser.add_argument(
+        "--max-range-span",
+        dest="max_range_span",
+        type=int,
+        default=8,
+        help="Max size in MiB of single request used to download many small files at once (legacy and Linux installers), 0 disables it",
+    )
+    download_parser.add_argument(
+        "--patch-cost-bandwidth",
+        dest="patch_cost_bandwidth",
+        type=float,
+        default=25,
+        help="Expected download speed in MiB/s, used to choose between applying a patch and downloading changed chunks",
+    )
+    download_parser.add_argument(
+        "--patch-cost-disk",
+        dest="patch_cost_disk",
+        type=float,
+        default=200,
+        help="Expected disk speed in MiB/s, used to choose between applying a patch and downloading changed chunks",
+    )
+    download_parser.add_argument(
+        "--patch-cost-cpu",
+        dest="patch_cost_cpu",
+        type=float,
+        default=150,
+        help="Expected patch decoding speed in MiB/s, used to choose between applying a patch and downloading changed chunks",
+    )
+    download_parser.add_argument(
+        "--dry-run",
+        dest="dry_run",
+        action="store_true",
+        help="Print estimated cost of patching and downloading changed chunks for each file and exit",
+    )
 
     # SIZE CALCULATING, AND OTHER MANIFEST INFO
 
@@ -119,7 +160,27 @@ def init_parser():
     calculate_size_parser.add_argument(
         "--dlc-only", dest="dlc_only", action="store_true", help="Download only DLC"
     )
-    calculate_size_parser.add_argument("id")
+    calculate_size_parser.add_argument(
+        "id",
+        nargs="+",
+        help="Game id, many ids can be given as ID or ID:PLATFORM to get info for all of them",
+    )
+    calculate_size_parser.add_argument(
+        "--diff",
+        action="store_true",
+        help="Calculate exact size of update of the installed game instead of full download size",
+    )
+    calculate_size_parser.add_argument(
+        "--path",
+        "-p",
+        dest="path",
+        help="Path of the installed game, makes --diff account for interrupted update",
+    )
+    calculate_size_parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Print info as JSON line per game even for a single id",
+    )
     calculate_size_parser.add_argument(
         "--platform",
         "--os",
@@ -137,7 +198,7 @@ def init_parser():
     calculate_size_parser.add_argument(
         "--max-workers",
         dest="workers_count",
-        default=cpu_count(),
+        default=cpu_count() or 1,
         help="Specify number of worker threads, by default number of CPU threads",
     )
 
@@ -166,6 +227,32 @@ def init_parser():
     launch_parser.add_argument(
         "--override-exe", dest="override_exe", help="Override executable to be run"
     )
+    launch_parser.add_argument(
+        "--prewarm",
+        action="store_true",
+        help="Read executable, its libraries and game assets into page cache while the game starts",
+    )
+    launch_parser.add_argument(
+        "--prewarm-budget",
+        dest="prewarm_budget",
+        type=int,
+        default=1024,
+        help="Maximum amount of data prewarmed in MiB",
+    )
+    launch_parser.add_argument(
+        "--prewarm-assets",
+        dest="prewarm_assets",
+        type=int,
+        default=32,
+        help="Number of asset files prewarmed after the executable and libraries",
+    )
+    launch_parser.add_argument(
+        "--prewarm-order",
+        dest="prewarm_order",
+        choices=["size", "recent"],
+        default="size",
+        help="Prewarm largest or most recently accessed assets first",
+    )
 
     # SAVES
 
@@ -194,6 +281,24 @@ def init_parser():
         action="store_const",
         const="forcedownload",
     )
+    save_parser.add_argument(
+        "--max-workers",
+        dest="workers_count",
+        type=int,
+        default=8,
+        help="Number of files synced at once",
+    )
+    save_parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="After syncing keep uploading changed files until terminated (Linux only)",
+    )
+    save_parser.add_argument(
+        "--debounce",
+        type=float,
+        default=5,
+        help="Seconds without changes before uploading them in watch mode",
+    )
 
     save_parser.add_argument(
         "--os",
@@ -210,6 +315,13 @@ def init_parser():
     clear_parser.add_argument("path", help="Path to sync files")
     clear_parser.add_argument("id", help="Game id")
     clear_parser.add_argument("--name", dest="dirname", default="__default")
+    clear_parser.add_argument(
+        "--max-workers",
+        dest="workers_count",
+        type=int,
+        default=8,
+        help="Number of files deleted at once",
+    )
 
     clear_parser.add_argument(
         "--os",
@@ -220,9 +332,46 @@ def init_parser():
         required=True,
     )
 
+    # UPDATES
+
+    updates_parser = subparsers.add_parser(
+        "check-updates", help="Check installed games for updates, printing JSON line per game with an update"
+    )
+    updates_parser.add_argument("--ids", help="Coma separated ids of games to check, all installed games by default")
+    updates_parser.add_argument(
+        "--skip-size",
+        action="store_true",
+        help="Don't download metas of updated games to estimate update size, games with unknown installed build are reported with \"unknown\": true",
+    )
+    updates_parser.add_argument(
+        "--max-workers",
+        dest="workers_count",
+        type=int,
+        default=8,
+        help="Number of games checked at once",
+    )
+
+    # SERVICE
+
+    serve_parser = subparsers.add_parser(
+        "serve", help="Run commands received over a Unix socket, keeping connections and caches warm"
+    )
+    serve_parser.add_argument(
+        "--socket",
+        dest="socket_path",
+        help="Path of the socket, GOGDL_SOCKET or a path in XDG_RUNTIME_DIR by default",
+    )
+    serve_parser.add_argument(
+        "--max-workers",
+        dest="workers_count",
+        type=int,
+        default=8,
+        help="Number of requests handled at once",
+    )
+
     # Languages
 
     locale_parser = subparsers.add_parser("lang-match", help="Query GOG language data for given locale code/name")
     locale_parser.add_argument("language", help="Language query to match")
 
-    return parser.parse_known_args()
+    return parser.parse_known_args(argv)
@@ -1,34 +1,140 @@
 #!/usr/bin/env python3
-from multiprocessing import freeze_support
+import os
+import sys
+import time
 import gogdl.args as args
-from gogdl.dl.managers import manager
-from gogdl.dl.managers import dependencies
-import gogdl.api as api
-import gogdl.imports as imports
-import gogdl.launch as launch
-import gogdl.languages as languages
-import gogdl.saves as saves
-import gogdl.auth as auth
+import gogdl.constants as constants
 from gogdl import version as gogdl_version
 import json
 import logging
 
+# Subcommand modules are imported when used, most invocations need only one of them
+
 
 def display_version():
     print(f"{gogdl_version}")
 
 
 def match_lang(arguments, unknown_arguments):
+    import gogdl.languages as languages
     lang = languages.Language.parse(arguments.language)
     data = lang.__dict__ if lang else {}
     print(json.dumps(data))
 
+
+# Handlers kept between commands run by the service, with their sessions and cached data
+API_HANDLER_TTL = 10 * 60
+api_handlers = dict()
+cloud_storage_managers = dict()
+
+
+def get_authorization_manager(arguments):
+    import gogdl.auth as auth
+    return auth.AuthorizationManager(arguments.auth_config_path)
+
+
+def get_api_handler(arguments):
+    """
+    Returns ApiHandler for auth config, reused until credentials change on disk or it gets old
+    """
+    import gogdl.api as api
+    path = arguments.auth_config_path
+    try:
+        mtime = os.stat(path).st_mtime_ns if path else None
+    except OSError:
+        mtime = None
+    cached = api_handlers.get(path)
+    if cached and cached[0] == mtime and time.monotonic() - cached[1] < API_HANDLER_TTL:
+        api_handler = cached[2]
+    else:
+        api_handler = api.ApiHandler(get_authorization_manager(arguments))
+        api_handlers[path] = (mtime, time.monotonic(), api_handler)
+    api_handler.cache.enabled = not (arguments.no_cache or os.environ.get("GOGDL_NO_CACHE"))
+    return api_handler
+
+
+def download(arguments, unknown_args):
+    from gogdl.dl.managers import manager
+    if arguments.command == "info":
+        if arguments.batch or len(arguments.id) > 1 or ":" in arguments.id[0]:
+            manager.calculate_batch_download_size(arguments, unknown_args, get_api_handler(arguments))
+            return
+        arguments.id = arguments.id[0]
+    download_manager = manager.Manager(arguments, unknown_args, get_api_handler(arguments))
+    if arguments.command == "info":
+        download_manager.calculate_download_size(arguments, unknown_args)
+    else:
+        download_manager.download(arguments, unknown_args)
+
+
+def dependencies(arguments, unknown_args):
+    from gogdl.dl.managers import dependencies
+    dependencies_handler = dependencies.DependenciesManager(arguments.ids.split(","), arguments.path, arguments.workers_count, get_api_handler(arguments), print_manifest=arguments.print_manifest)
+    if not arguments.print_manifest:
+        dependencies_handler.get()
+
+
+def get_info(arguments, unknown_args):
+    import gogdl.imports as imports
+    imports.get_info(arguments, unknown_args)
+
+
+def launch(arguments, unknown_args):
+    import gogdl.launch as launch
+    launch.launch(arguments, unknown_args)
+
+
+def saves(arguments, unknown_args):
+    import gogdl.saves as saves
+    api_handler = get_api_handler(arguments)
+    cached = cloud_storage_managers.get(arguments.auth_config_path)
+    if cached and cached[0] is api_handler:
+        clouds_storage_manager = cached[1]
+    else:
+        clouds_storage_manager = saves.CloudStorageManager(api_handler, api_handler.auth_manager)
+        cloud_storage_managers[arguments.auth_config_path] = (api_handler, clouds_storage_manager)
+    if arguments.command == "save-clear":
+        clouds_storage_manager.clear(arguments, unknown_args)
+    elif arguments.watch:
+        clouds_storage_manager.watch(arguments, unknown_args)
+    else:
+        clouds_storage_manager.sync(arguments, unknown_args)
+
+
+def check_updates(arguments, unknown_args):
+    import gogdl.updates as updates
+    updates.check_updates(arguments, unknown_args, get_api_handler(arguments))
+
+
+def auth(arguments, unknown_args):
+    get_authorization_manager(arguments).handle_cli(arguments, unknown_args)
+
+
+def serve(arguments, unknown_args):
+    import gogdl.service as service
+    service.Service(arguments.socket_path, arguments.workers_count).serve()
+
+
 def main():
     arguments, unknown_args = args.init_parser()
+    # Service client is imported only when there is a service to talk to
+    socket_path = os.environ.get("GOGDL_SOCKET", constants.SERVICE_SOCKET_PATH)
+    if not arguments.display_version and socket_path and os.path.exists(socket_path):
+        import gogdl.service as service
+        if service.should_forward(arguments):
+            exit_code = service.run_client(sys.argv[1:])
+            if exit_code is not None:
+                sys.exit(exit_code)
+    run(arguments, unknown_args)
+
+
+def run(arguments, unknown_args):
     level = logging.INFO
     if '-d' in unknown_args or '--debug' in unknown_args:
         level = logging.DEBUG
     logging.basicConfig(format="[%(name)s] %(levelname)s: %(message)s", level=level)
+    # Level of the service's logger is set by each command
+    logging.getLogger().setLevel(level)
     logging.getLogger("urllib3").setLevel(level)
     logger = logging.getLogger("MAIN")
     logger.debug(arguments)
@@ -38,32 +144,23 @@ def main():
     if not arguments.command:
         print("No command provided!")
         return
-    authorization_manager = auth.AuthorizationManager(arguments.auth_config_path)
-    api_handler = api.ApiHandler(authorization_manager)
-    clouds_storage_manager = saves.CloudStorageManager(api_handler, authorization_manager)
-
-    switcher = {}
-    if arguments.command in ["download", "repair", "update", "info"]:
-        download_manager = manager.Manager(arguments, unknown_args, api_handler)
-        switcher = {
-            "download": download_manager.download,
-            "repair": download_manager.download,
-            "update": download_manager.download,
-            "info": download_manager.calculate_download_size,
-        }
-    elif arguments.command in ["redist", "dependencies"]:
-        dependencies_handler = dependencies.DependenciesManager(arguments.ids.split(","), arguments.path, arguments.workers_count, api_handler, print_manifest=arguments.print_manifest)
-        if not arguments.print_manifest:
-            dependencies_handler.get()
-    else:
-        switcher = {
-            "import": imports.get_info,
-            "launch": launch.launch,
-            "save-sync": clouds_storage_manager.sync,
-            "save-clear": clouds_storage_manager.clear,
-            "auth": authorization_manager.handle_cli,
-            "lang-match": match_lang
-        }
+
+    switcher = {
+        "download": download,
+        "repair": download,
+        "update": download,
+        "info": download,
+        "redist": dependencies,
+        "dependencies": dependencies,
+        "import": get_info,
+        "launch": launch,
+        "save-sync": saves,
+        "save-clear": saves,
+        "auth": auth,
+        "check-updates": check_updates,
+        "lang-match": match_lang,
+        "serve": serve,
+    }
 
     function = switcher.get(arguments.command)
     if function:
@@ -71,5 +168,7 @@ def main():
 
 
 if __name__ == "__main__":
-    freeze_support()
+    if getattr(sys, "frozen", False):
+        from multiprocessing import freeze_support
+        freeze_support()
     main()
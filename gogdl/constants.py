@@ -29,3 +29,8 @@ if os.getenv("GOGDL_CONFIG_PATH"):
     CONFIG_DIR = os.path.join(os.getenv("GOGDL_CONFIG_PATH"), "heroic_gogdl")
 
 MANIFESTS_DIR = os.path.join(CONFIG_DIR, "manifests")
+LINUX_INSTALLERS_DIR = os.path.join(CONFIG_DIR, "linux-installers")
+SAVES_INDEX_DIR = os.path.join(CONFIG_DIR, "saves-index")
+HTTP_CACHE_DIR = os.path.join(CONFIG_DIR, "http-cache")
+RUNNERS_CACHE_PATH = os.path.join(CONFIG_DIR, "runners.json")
+SERVICE_SOCKET_PATH = os.path.join(os.getenv("XDG_RUNTIME_DIR") or CONFIG_DIR, "heroic_gogdl.sock")
@@ -1,15 +1,15 @@
+import codecs
 import json
 import zlib
 import os
 import gogdl.constants as constants
-from gogdl.dl.objects import v1, v2
 import shutil
 import time
-import requests
 from sys import exit, platform
 
 PATH_SEPARATOR = os.sep
 TIMEOUT = 10
+STREAM_READ_SIZE = 256 * 1024
 
 
 def get_json(api_handler, url):
@@ -37,6 +37,134 @@ def get_zlib_encoded(api_handler, url):
     return None, None
 
 
+def iter_zlib_encoded_items(api_handler, url, path=("depot", "items")):
+    """
+    Streams a (possibly zlib compressed) JSON manifest and yields elements
+    of the array found under `path` one by one, without keeping the whole
+    compressed, decompressed or parsed document in memory
+    """
+    retries = 5
+    yielded = False
+    while True:
+        try:
+            response = api_handler.session.get(url, timeout=TIMEOUT, stream=True)
+            with response:
+                response.raise_for_status()
+                for item in iter_json_array(iter_inflated_text(response), path):
+                    yielded = True
+                    yield item
+            return
+        except Exception as exception:
+            # Client errors, like a missing patch meta, won't go away when retried
+            status = getattr(getattr(exception, "response", None), "status_code", None)
+            # Items were already handed out, we can't start over silently
+            if yielded or retries <= 1 or (status and status < 500):
+                raise
+            time.sleep(2)
+            retries -= 1
+
+
+def iter_inflated_text(response, read_size=STREAM_READ_SIZE):
+    decompressor = None
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    for chunk in response.iter_content(read_size):
+        if decompressor is None:
+            # Manifests are usually zlib compressed, but some are served as plain json
+            decompressor = zlib.decompressobj(15) if chunk[:1] == b"\x78" else False
+        if decompressor:
+            chunk = decompressor.decompress(chunk)
+        yield text_decoder.decode(chunk)
+    if decompressor:
+        yield text_decoder.decode(decompressor.flush(), final=True)
+    else:
+        yield text_decoder.decode(b"", final=True)
+
+
+def iter_json_array(chunks, path):
+    """
+    Yields elements of the array located under `path` (sequence of object keys)
+    in a JSON document provided as an iterable of text chunks.
+    Everything outside of that array is skipped without being parsed into objects
+    """
+    # Elements are decoded separately, share object keys between them
+    # the same way json.loads does within a single document
+    keys = dict()
+    decoder = json.JSONDecoder(
+        object_pairs_hook=lambda pairs: {keys.setdefault(k, k): v for k, v in pairs}
+    )
+    chunks = iter(chunks)
+    target = [None] + list(path[:-1])
+    buffer = ""
+    index = 0
+
+    def fill():
+        nonlocal buffer, index
+        for data in chunks:
+            if data:
+                buffer = buffer[index:] + data
+                index = 0
+                return True
+        return False
+
+    # Find beginning of the array
+    stack = []
+    last_string = None
+    key = None
+    while True:
+        if index >= len(buffer) and not fill():
+            return
+        char = buffer[index]
+        if char == '"':
+            try:
+                last_string, end = json.decoder.scanstring(buffer, index + 1)
+            except json.JSONDecodeError:
+                if not fill():
+                    raise
+                continue
+            index = end
+            continue
+        index += 1
+        if char == ":":
+            key = last_string
+        elif char == ",":
+            key = None
+        elif char == "{":
+            stack.append(key)
+            key = None
+        elif char == "[":
+            if key == path[-1] and stack == target:
+                break
+            stack.append(key)
+            key = None
+        elif char in "}]":
+            if not stack:
+                return
+            stack.pop()
+            key = None
+
+    # Parse array elements one by one
+    while True:
+        if index >= len(buffer) and not fill():
+            raise json.JSONDecodeError("Unterminated array", buffer, index)
+        char = buffer[index]
+        if char in " \t\n\r,":
+            index += 1
+            continue
+        if char == "]":
+            return
+        try:
+            item, end = decoder.raw_decode(buffer, index)
+        except json.JSONDecodeError:
+            if not fill():
+                raise
+            continue
+        # A number at the end of the buffer may be incomplete
+        if end == len(buffer) and not isinstance(item, (dict, list)) and fill():
+            continue
+        index = end
+        yield item
+
+
 def prepare_location(path, logger=None):
     os.makedirs(path, exist_ok=True)
     if logger:
@@ -60,6 +188,7 @@ def get_secure_link(api_handler, path, gameId, generation=2, logger=None, root=N
     if root:
         url += f"&root={root}"
 
+    import requests
     try:
         r = requests.get(url, headers=api_handler.session.headers, timeout=TIMEOUT)
     except BaseException as exception:
@@ -132,6 +261,21 @@ def check_free_space(size: int, path: str):
     return size < available_space
 
 
+def get_available_memory():
+    # Returns None if it can't be determined on this platform
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
 def get_range_header(offset, size):
     from_value = offset
     to_value = (int(offset) + int(size)) - 1
@@ -139,6 +283,7 @@ def get_range_header(offset, size):
 
 # Creates appropriate Manifest class based on provided meta from json
 def create_manifest_class(meta: dict, api_handler):
+    from gogdl.dl.objects import v1, v2
     version = meta.get("version") 
     if version == 1:
         return v1.Manifest.from_json(meta, api_handler)
@@ -10,9 +10,9 @@ from gogdl.dl.objects import v2
 from gogdl.dl.objects.generic import BaseDiff
 
 
-def get_depot_list(manifest, product_id=None):
+def get_depot_list(items, product_id=None):
     download_list = list()
-    for item in manifest["depot"]["items"]:
+    for item in items:
         if item["type"] == "DepotFile":
             download_list.append(v2.DepotFile(item, product_id))
     return download_list
@@ -43,9 +43,9 @@ class DependenciesManager:
 
     def get_files_for_depot_manifest(self, manifest):
         url = f'{constants.GOG_CDN}/content-system/v2/dependencies/meta/{dl_utils.galaxy_path(manifest)}'
-        manifest = dl_utils.get_zlib_encoded(self.api, url)[0]
+        items = dl_utils.iter_zlib_encoded_items(self.api, url)
 
-        return get_depot_list(manifest, 'redist')
+        return get_depot_list(items, 'redist')
 
 
     def get(self, return_files=False):
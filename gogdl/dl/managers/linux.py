@@ -7,7 +7,7 @@ import stat
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from zlib import crc32
 from gogdl.dl import dl_utils
-from gogdl.dl.managers.task_executor import ExecutingManager
+from gogdl.dl.managers.task_executor import ExecutingManager, COALESCE_MAX_GAP, COALESCE_MAX_SPAN
 from gogdl.dl.objects.generic import BaseDiff
 from gogdl.dl.objects.v2 import DepotLink
 from gogdl.dl.workers import linux as linux_worker
@@ -17,6 +17,7 @@ from gogdl import constants
 
 
 def get_folder_name_from_windows_manifest(api_handler, id):
+    # Builds are revalidated and metas are kept by the session's cache
     builds = dl_utils.get_json(
         api_handler,
         f"{constants.GOG_CONTENT_SYSTEM}/products/{id}/os/windows/builds?generation=2",
@@ -44,6 +45,16 @@ class Manager:
 
         self.api_handler = generic_manager.api_handler
         self.allowed_threads = generic_manager.allowed_threads
+        if "max_range_span" in self.arguments:
+            self.max_range_span = self.arguments.max_range_span * 1024 * 1024
+        else:
+            self.max_range_span = COALESCE_MAX_SPAN
+        if "local_installer" in self.arguments:
+            self.local_installer = self.arguments.local_installer
+        else:
+            self.local_installer = None
+
+        self.logger = logging.getLogger("LINUX")
         self.folder_name = get_folder_name_from_windows_manifest(self.api_handler, self.game_id)
 
         if "path" in self.arguments:
@@ -61,7 +72,6 @@ class Manager:
             self.dlcs_list = []
         self.dlc_only = self.arguments.dlc_only
 
-        self.logger = logging.getLogger("LINUX")
         self.logger.info("Initialized Linux Download Manager")
 
         self.game_data = None
@@ -90,12 +100,26 @@ class Manager:
 
         return None
 
+    def get_local_installer_handler(self, installers):
+        """
+        Opens local installer of the base game, it has to be one of the game's current installers
+        """
+        size = os.path.getsize(self.local_installer)
+        for installer in installers:
+            if sum(f["size"] for f in installer["files"]) == size:
+                self.game_installer = installer
+                return linux.LocalInstallerHandler(self.local_installer, self.game_id)
+        raise Exception(f"{self.local_installer} doesn't match any current Linux installer of the game")
+
     def setup(self):
         self.game_data = self.api_handler.get_item_data(self.game_id, expanded=['downloads', 'expanded_dlcs'])
 
+        if not self.game_data and self.local_installer:
+            raise Exception("Could not fetch game data to check the local installer against")
         if not self.game_data: # Adicionado este bloco de proteção
             self.logger.error("Could not fetch game data. Check your connection or auth.")
             self.game_data = {"downloads": {"installers": []}, "expanded_dlcs": []}
+            self.setup_installer_handlers()
             return
 
         # Filter linux installers
@@ -105,9 +129,13 @@ class Manager:
 
         self.game_installer = self.find_matching_installer(game_installers)
 
-        if not self.dlc_only:
+        if not self.dlc_only and self.local_installer:
+            # Base game is read from the local file instead of range requests
+            self.installer_handlers.append(self.get_local_installer_handler(game_installers))
+        elif not self.dlc_only:
             installer_data = dl_utils.get_json(self.api_handler, self.game_installer["files"][0]["downlink"])
-            game_install_handler = linux.InstallerHandler(installer_data["downlink"],self.game_id,self.api_handler.session)
+            game_install_handler = linux.InstallerHandler(installer_data["downlink"],self.game_id,self.api_handler.session,
+                                                          version=self.game_installer["version"])
             self.installer_handlers.append(game_install_handler)
 
         # Create dlc installer handlers
@@ -130,10 +158,14 @@ class Manager:
 
                     install_handler = linux.InstallerHandler(installer_data["downlink"],
                                                              str(dlc["id"]),
-                                                             self.api_handler.session)
+                                                             self.api_handler.session,
+                                                             version=installer["version"])
 
                     self.installer_handlers.append(install_handler)
 
+        self.setup_installer_handlers()
+
+    def setup_installer_handlers(self):
         pool = ThreadPoolExecutor(self.allowed_threads)
         futures = []
         for handler in self.installer_handlers:
@@ -185,6 +217,40 @@ class Manager:
 
         return response
 
+    def resolve_links(self, links):
+        """
+        Reads symlink targets, links lying close to each other in the installer
+        are fetched with one range request, requests are run in parallel
+        """
+        links.sort(key=lambda link: (link[0].product, link[1]))
+        groups = list()
+        for link in links:
+            handler, start, size, _ = link
+            if groups:
+                group = groups[-1]
+                group_handler, group_start, group_end = group[0][0], group[0][1], group[-1][1] + group[-1][2]
+                if (group_handler is handler and 0 <= start - group_end <= COALESCE_MAX_GAP
+                        and start + size - group_start <= COALESCE_MAX_SPAN):
+                    group.append(link)
+                    continue
+            groups.append([link])
+
+        def read_group(group):
+            handler, group_start = group[0][0], group[0][1]
+            group_size = group[-1][1] + group[-1][2] - group_start
+            data = handler.get_bytes_from_file(from_b=group_start, size=group_size, add_archive_index=False)
+            resolved = list()
+            for _, start, size, path in group:
+                target = data[start - group_start:start - group_start + size].decode()
+                resolved.append(DepotLink({"path": path, "target": os.path.normpath(os.path.join(dl_utils.parent_dir(path), target))}))
+            return resolved
+
+        resolved = list()
+        with ThreadPoolExecutor(self.allowed_threads) as pool:
+            for group_links in pool.map(read_group, groups):
+                resolved.extend(group_links)
+        return resolved
+
     def download(self):
         self.setup()
         manifest_path = os.path.join(self.path, '.gogdl-linux-manifest')
@@ -223,8 +289,12 @@ class Manager:
             new = list(cd_files.values())
 
         sources = dict()
+        local_sources = dict()
         for handler in self.installer_handlers:
-            sources.update({handler.product: handler.url})
+            if isinstance(handler, linux.LocalInstallerHandler):
+                local_sources.update({handler.product: handler.path})
+            else:
+                sources.update({handler.product: handler.url})
 
         print("New/changed files", len(new))
         print("Deleted", len(deleted))
@@ -257,6 +327,7 @@ class Manager:
         diff = BaseDiff()
 
         final_files = list()
+        links = list()
         for i, file in enumerate(new):
             # Prepare file for download
             # Calculate data offsets 
@@ -278,16 +349,19 @@ class Manager:
 
             path = file.file_name.replace("data/noarch", self.path)
             if file.is_symlink():
-                data = handler.get_bytes_from_file(from_b=data_start, size=c_size, add_archive_index=False)
-                diff.links.append(DepotLink({"path": path, "target": os.path.normpath(os.path.join(dl_utils.parent_dir(path), data.decode()))}))
+                links.append((handler, data_start, c_size, path))
                 continue
-            file_permissions = int(bin(int.from_bytes(file.ext_file_attrs, "little"))[3:][:9])
+            file_permissions = int(bin(file.ext_file_attrs)[3:][:9])
             executable = (file_permissions & (stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)) != 0
             final_files.append(linux.LinuxFile(file.product, path, method, data_start, c_size, size, checksum, executable))
 
+        # Neighbouring entries are read with single request
+        final_files.sort(key=lambda f: (f.product, f.offset))
         diff.new = final_files
+        diff.links = self.resolve_links(links)
 
-        manager = ExecutingManager(self.api_handler, self.allowed_threads, self.path, None, diff, sources)  
+        manager = ExecutingManager(self.api_handler, self.allowed_threads, self.path, None, diff, sources,
+                                   max_range_span=self.max_range_span, local_sources=local_sources)
         
         manager.setup()
         for file in deleted:
@@ -295,6 +369,9 @@ class Manager:
             if os.path.exists(path):
                 os.remove(path)
         cancelled = manager.run()
+        for handler in self.installer_handlers:
+            if isinstance(handler, linux.LocalInstallerHandler):
+                handler.close()
 
         if cancelled:
             return
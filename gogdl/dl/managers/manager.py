@@ -1,9 +1,11 @@
 from dataclasses import dataclass
 from multiprocessing import cpu_count
 from sys import exit
+import argparse
 import os
 import logging
 import json
+import threading
 
 from gogdl import constants
 from gogdl.dl.managers import linux, v1, v2
@@ -12,6 +14,32 @@ from gogdl.dl.managers import linux, v1, v2
 class UnsupportedPlatform(Exception):
     pass
 
+def get_target_build(builds, branch=None, build_id=None):
+    """
+    Returns build to install from builds list: requested build, latest of the branch
+    or latest of the default branch
+    """
+    target_build = builds["items"][0]
+
+    for build in builds["items"]:
+        if build["branch"] == None:
+            target_build = build
+            break
+
+    for build in builds["items"]:
+        if build["branch"] == branch:
+            target_build = build
+            break
+
+    if build_id:
+        # Find build
+        for build in builds["items"]:
+            if build["build_id"] == build_id:
+                target_build = build
+                break
+    return target_build
+
+
 class Manager:
     def __init__(self, arguments, unknown_arguments, api_handler):
         self.arguments = arguments
@@ -52,18 +80,30 @@ class Manager:
 
         return data 
 
-    def calculate_download_size(self, arguments, unknown_arguments):
+    def get_download_size(self):
         self.setup_download_manager()
 
+        if getattr(self.arguments, "diff", False):
+            if not isinstance(self.download_manager, v2.Manager):
+                raise Exception("Update size can only be calculated for v2 depots")
+            return self.download_manager.get_diff_size()
+
         download_size_response = self.download_manager.get_download_size()
         download_size_response['builds'] = self.builds
+        return download_size_response
 
-
-        print(json.dumps(download_size_response))
+    def calculate_download_size(self, arguments, unknown_arguments):
+        print(json.dumps(self.get_download_size()))
 
     def download(self, arguments, unknown_arguments):
         self.setup_download_manager()
 
+        if getattr(self.arguments, "dry_run", False) and not isinstance(self.download_manager, v2.Manager):
+            # Patches are only available for v2 depots
+            self.logger.info("Nothing to estimate, patches are only available for v2 depots")
+            print(json.dumps({"files": []}))
+            return
+
         self.download_manager.download()
 
     def setup_download_manager(self):
@@ -99,24 +139,7 @@ class Manager:
         if len(self.builds["items"]) == 0:
             self.logger.error("No builds found") 
             exit(1)
-        self.target_build = self.builds["items"][0]
-
-        for build in self.builds["items"]:
-            if build["branch"] == None:
-                self.target_build = build
-                break
-
-        for build in self.builds["items"]:
-            if build["branch"] == self.branch:
-                self.target_build = build
-                break
-
-        if self.arguments.build:
-            # Find build
-            for build in self.builds["items"]:
-                if build["build_id"] == self.arguments.build:
-                    self.target_build = build
-                    break
+        self.target_build = get_target_build(self.builds, self.branch, self.arguments.build)
         self.logger.debug(f'Found build {self.target_build}')
 
         generation = self.target_build["generation"]
@@ -139,3 +162,51 @@ class Manager:
             self.download_manager = v1.Manager(self)
         elif generation == 2:
             self.download_manager = v2.Manager(self)
+
+
+def parse_batch_targets(ids, default_platform):
+    """
+    Returns (id, platform) pairs from list of ID or ID:PLATFORM entries
+    """
+    targets = list()
+    for entry in ids:
+        game_id, _, platform = entry.partition(":")
+        targets.append((game_id, platform or default_platform))
+    return targets
+
+
+def calculate_batch_download_size(arguments, unknown_arguments, api_handler):
+    """
+    Runs info for many games concurrently, printing JSON line for each as soon as it's done
+    Games share api handler, so owned games and dependencies repository are fetched once
+    """
+    # Imported here to keep startup of single game commands fast
+    from concurrent.futures import ThreadPoolExecutor
+
+    logger = logging.getLogger("BATCH_INFO")
+    targets = parse_batch_targets(arguments.id, arguments.platform)
+    workers = max(1, min(int(arguments.workers_count), len(targets)))
+    api_handler.set_workers(workers)
+    print_lock = threading.Lock()
+
+    def run(game_id, platform):
+        game_arguments = argparse.Namespace(**vars(arguments))
+        game_arguments.id = game_id
+        game_arguments.platform = platform
+        result = {"id": game_id, "platform": platform}
+        try:
+            result["info"] = Manager(game_arguments, unknown_arguments, api_handler).get_download_size()
+        except SystemExit:
+            result["error"] = "Unable to get game info"
+        except Exception as e:
+            logger.error(f"Failed to get info for {game_id} on {platform}: {e}")
+            result["error"] = str(e) or e.__class__.__name__
+        with print_lock:
+            print(json.dumps(result), flush=True)
+        return "error" not in result
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(lambda target: run(*target), targets))
+
+    if not all(results):
+        exit(1)
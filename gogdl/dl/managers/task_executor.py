@@ -17,8 +17,16 @@ from gogdl.dl.progressbar import ProgressBar
 from gogdl.dl.workers import task_executor
 from gogdl.dl.objects import generic, v2, v1, linux
 
+# Small files lying close to each other are downloaded with single range request
+COALESCE_MAX_FILE_SIZE = 1024 * 1024
+COALESCE_MAX_GAP = 64 * 1024
+COALESCE_MAX_SPAN = 8 * 1024 * 1024
+
+# Block cache allocated by each xdelta3 patch
+PATCH_WORKER_MEMORY = 256 * 1024 * 1024
+
 class ExecutingManager:
-    def __init__(self, api_handler, allowed_threads, path, support, diff, secure_links) -> None:
+    def __init__(self, api_handler, allowed_threads, path, support, diff, secure_links, max_range_span=COALESCE_MAX_SPAN, local_sources=None) -> None:
         self.api_handler = api_handler
         self.allowed_threads = allowed_threads
         self.path = path
@@ -27,10 +35,19 @@ class ExecutingManager:
         self.cache = os.path.join(path, '.gogdl-download-cache')
         self.diff: generic.BaseDiff = diff
         self.secure_links = secure_links
+        # 0 disables merging of small files into bigger range requests
+        self.max_range_span = max_range_span
+        # Products installed from local installer files, product id -> path
+        self.local_sources = local_sources or dict()
         self.logger = logging.getLogger("TASK_EXEC")
 
         self.download_size = 0
         self.disk_size = 0
+        # Data copied from already installed files or cached chunks
+        self.copy_size = 0
+        # Size of files produced by patches and of patches downloaded
+        self.patch_size = 0
+        self.patch_download_size = 0
 
         self.shared_memory = None
         self.shm_segments = deque()
@@ -46,6 +63,8 @@ class ExecutingManager:
 
         self.download_workers = list()
         self.writer_worker = None
+        self.patch_workers = list()
+        self.patch_workers_count = 0
         self.threads = list()
 
         self.shm_cond = Condition()
@@ -61,6 +80,8 @@ class ExecutingManager:
         self.download_res_queue = Queue()
         self.writer_queue = Queue()
         self.writer_res_queue = Queue()
+        # One per patch worker, chunks of a patched file have to stay in order
+        self.patch_queues = list()
         
         self.download_speed_updates = Queue()
         self.writer_speed_updates = Queue()
@@ -69,6 +90,19 @@ class ExecutingManager:
         self.shared_secure_links = self.manager.dict()
         self.shared_secure_links.update(self.secure_links)
 
+        required_disk_size_delta = self.plan()
+        self.patch_queues = [Queue() for _ in range(self.patch_workers_count)]
+
+        print(get_readable_size(self.download_size), self.download_size)
+        print(get_readable_size(required_disk_size_delta), required_disk_size_delta)
+                
+        return dl_utils.check_free_space(required_disk_size_delta, self.path)
+
+    def plan(self):
+        """
+        Creates tasks for the diff and calculates sizes, without starting anything
+        Returns extra disk space needed at peak of the download
+        """
         # Required space for download to succeed
         required_disk_size_delta = 0
 
@@ -79,22 +113,27 @@ class ExecutingManager:
             if isinstance(f, v1.File):
                 required_disk_size_delta -= f.size
             elif isinstance(f, v2.DepotFile):
-                required_disk_size_delta -= sum([ch['size'] for ch in f.chunks])
+                required_disk_size_delta -= f.chunks.total_size()
 
         current_tmp_size = required_disk_size_delta
 
         shared_chunks_counter = Counter()
         completed_files = set()
+        # Disk space taken by each patch while being applied
+        patch_disk_usage = list()
 
         missing_files = set()
         mismatched_files = set()
 
         downloaded_v1 = dict()
         downloaded_linux = dict()
+        # Ranges currently being filled with small files, with the last task reading from them
+        v1_range = None
+        linux_range = None
         cached = set()
         
-        # Re-use caches
-        if os.path.exists(self.cache):
+        # Re-use caches, without path only the diff itself is planned
+        if self.path and os.path.exists(self.cache):
             for cache_file in os.listdir(self.cache):
                 cached.add(cache_file)
 
@@ -143,7 +182,7 @@ class ExecutingManager:
             # Have at least 10 MiB chunk size for V1 downloads
             self.biggest_chunk = max(self.biggest_chunk, 10 * 1024 * 1024)
 
-        if os.path.exists(self.resume_file):
+        if self.path and os.path.exists(self.resume_file):
             self.logger.info("Attempting to continue the download")
             try:
                 missing = 0
@@ -194,13 +233,31 @@ class ExecutingManager:
                 required_disk_size_delta += f.size
                 # In case of same file we can copy it over
                 if f.hash in downloaded_v1:
+                    self.copy_size += f.size
                     self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.COPY_FILE | support_flag, old_flags=generic.TaskFlag.SUPPORT if 'support' in downloaded_v1[f.hash].flags else generic.TaskFlag.NONE, old_file=downloaded_v1[f.hash].path))
                     if 'executable' in f.flags:
                         self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.MAKE_EXE | support_flag))
                     continue
-                self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.OPEN_FILE | support_flag))
                 self.download_size += f.size
                 self.disk_size += f.size
+                if self.max_range_span and f.size <= COALESCE_MAX_FILE_SIZE:
+                    part = task_executor.RangePart(0, f.size, f.size, md5=f.hash)
+                    task, v1_range = self.plan_range_part(v1_range, self.v1_chunks_to_download, f.product_id, f.offset, part)
+
+                    self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.OPEN_FILE | support_flag))
+                    self.tasks.append(task)
+                    self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.CLOSE_FILE | support_flag))
+                    if 'executable' in f.flags:
+                        self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.MAKE_EXE | support_flag))
+                    downloaded_v1[f.hash] = f
+                    continue
+
+                # Keep downloads in order of tasks
+                if v1_range:
+                    self.v1_chunks_to_download.append(v1_range[0])
+                    v1_range = None
+
+                self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.OPEN_FILE | support_flag))
                 size_left = f.size
                 chunk_offset = 0
                 i = 0
@@ -234,14 +291,56 @@ class ExecutingManager:
                 
                 required_disk_size_delta += f.size
                 if f.hash in downloaded_linux:
+                    self.copy_size += f.size
                     self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.COPY_FILE, old_flags=generic.TaskFlag.NONE, old_file=downloaded_linux[f.hash].path))
                     if 'executable' in f.flags:
                         self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.MAKE_EXE))
                     continue
-                
-                self.tasks.append(generic.FileTask(f.path+'.tmp', flags=generic.TaskFlag.OPEN_FILE))
+
+                if f.product in self.local_sources:
+                    # Writer copies or inflates the entry straight from the installer
+                    self.disk_size += f.size
+                    old_flags = generic.TaskFlag.MMAP
+                    if f.compression:
+                        old_flags |= generic.TaskFlag.ZIP_DEC
+                    self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.OPEN_FILE))
+                    self.tasks.append(generic.ChunkTask(f.product, 0, f.hash + "_local", f.hash, f.compressed_size, 0, old_offset=f.offset, old_flags=old_flags, old_file=self.local_sources[f.product], crc32=int(f.hash)))
+                    self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.CLOSE_FILE))
+                    if 'executable' in f.flags:
+                        self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.MAKE_EXE))
+                    downloaded_linux[f.hash] = f
+                    continue
+
                 self.download_size += f.compressed_size
                 self.disk_size += f.size
+                if self.max_range_span and f.compressed_size <= COALESCE_MAX_FILE_SIZE and f.size <= COALESCE_MAX_FILE_SIZE:
+                    part = task_executor.RangePart(0, f.compressed_size, f.size, f.compression, crc32=int(f.hash))
+                    task, linux_range = self.plan_range_part(linux_range, self.linux_chunks_to_download, f.product, f.offset, part)
+
+                    self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.OPEN_FILE))
+                    self.tasks.append(task)
+                    self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.CLOSE_FILE))
+                    if 'executable' in f.flags:
+                        self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.MAKE_EXE))
+                    downloaded_linux[f.hash] = f
+                    continue
+
+                # Keep downloads in order of tasks
+                if linux_range:
+                    self.linux_chunks_to_download.append(linux_range[0])
+                    linux_range = None
+
+                if f.compression:
+                    # Inflated on the fly by download worker, straight to the destination
+                    task = generic.InflateTask(f.product, f.path, f.offset, f.compressed_size, f.size, int(f.hash))
+                    self.tasks.append(task)
+                    self.linux_chunks_to_download.append(task_executor.DownloadTaskInflate(f.product, f.offset, f.compressed_size, f.size, task.crc32, task.path, task.compressed_md5, self.biggest_chunk))
+                    if 'executable' in f.flags:
+                        self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.MAKE_EXE))
+                    downloaded_linux[f.hash] = f
+                    continue
+
+                self.tasks.append(generic.FileTask(f.path+'.tmp', flags=generic.TaskFlag.OPEN_FILE))
                 size_left = f.compressed_size
                 chunk_offset = 0
                 i = 0
@@ -260,13 +359,7 @@ class ExecutingManager:
                     i += 1
 
                 self.tasks.append(generic.FileTask(f.path + '.tmp', flags=generic.TaskFlag.CLOSE_FILE))
-                if f.compression:
-                    self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.OPEN_FILE))
-                    self.tasks.append(generic.ChunkTask(f.product, 0, f.hash+"_dec", f.hash+"_dec", f.compressed_size, f.compressed_size, True, False, 0, old_flags=generic.TaskFlag.ZIP_DEC, old_file=f.path+'.tmp'))
-                    self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.CLOSE_FILE))
-                    self.tasks.append(generic.FileTask(f.path + '.tmp', flags=generic.TaskFlag.DELETE_FILE))
-                else:
-                    self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.DELETE_FILE | generic.TaskFlag.RENAME_FILE, old_file=f.path+'.tmp'))
+                self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.DELETE_FILE | generic.TaskFlag.RENAME_FILE, old_file=f.path+'.tmp'))
 
                 if 'executable' in f.flags:
                     self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.MAKE_EXE))
@@ -291,6 +384,7 @@ class ExecutingManager:
                         cached.add(chunk["md5"])
                         current_tmp_size += chunk['size']
                     elif is_cached:
+                        self.copy_size += chunk['size']
                         new_task.old_offset = 0
                         # This can safely be absolute path, due to
                         # how os.path.join works in Writer
@@ -327,6 +421,7 @@ class ExecutingManager:
                         chunk_task.old_flags = old_support_flag  
                         chunk_task.old_file = f.file.path
                         reused += 1
+                        self.copy_size += chunk['size']
 
                         chunk_tasks.append(chunk_task)
                     else:
@@ -338,6 +433,7 @@ class ExecutingManager:
                             cached.add(chunk["md5"])
                             current_tmp_size += chunk['size']
                         elif is_cached:
+                            self.copy_size += chunk['size']
                             chunk_task.old_offset = 0
                             chunk_task.old_file = os.path.join(self.cache, chunk["md5"])
                         else:
@@ -369,19 +465,17 @@ class ExecutingManager:
 
             elif isinstance(f, v2.FilePatchDiff):
                 chunk_tasks = []
+                cache_deletes = []
+                cache_freed = 0
                 patch_size = 0
-                old_file_size = 0
-                out_file_size = 0
                 if f.target.lower() in completed_files:
                     continue
 
                 # Calculate output size  
-                for chunk in f.new_file.chunks:
-                    out_file_size += chunk['size']
+                out_file_size = f.new_file.chunks.total_size()
 
                 # Calculate old size  
-                for chunk in f.old_file.chunks:
-                    old_file_size += chunk['size']
+                old_file_size = f.old_file.chunks.total_size()
 
                 # Make chunk tasks
                 for i, chunk in enumerate(f.chunks):
@@ -394,6 +488,7 @@ class ExecutingManager:
                         chunk_task.offload_to_cache = True
                         cached.add(chunk["md5"])
                         self.download_size += chunk['compressedSize']
+                        self.patch_download_size += chunk['compressedSize']
                         current_tmp_size += chunk['size']
                         required_disk_size_delta = max(current_tmp_size, required_disk_size_delta)
                     elif is_cached:
@@ -402,51 +497,88 @@ class ExecutingManager:
                     else:
                         self.v2_chunks_to_download.append((f'{f.new_file.product_id}_patch', chunk["compressedMd5"]))
                         self.download_size += chunk['compressedSize']
+                        self.patch_download_size += chunk['compressedSize']
                     shared_chunks_counter[chunk['compressedMd5']] -= 1
                     chunk_tasks.append(chunk_task)
                     if is_cached and shared_chunks_counter[chunk["compressedMd5"]] == 0:
                         cached.remove(chunk["md5"])
-                        self.tasks.append(generic.FileTask(os.path.join(self.cache, chunk["md5"]), flags=generic.TaskFlag.DELETE_FILE))
-                        current_tmp_size -= chunk['size']
-
-                self.disk_size += patch_size
-                current_tmp_size += patch_size 
-                required_disk_size_delta = max(current_tmp_size, required_disk_size_delta)
+                        cache_deletes.append(generic.FileTask(os.path.join(self.cache, chunk["md5"]), flags=generic.TaskFlag.DELETE_FILE))
+                        cache_freed += chunk['size']
 
-                # Download patch
-                self.tasks.append(generic.FileTask(f.target + ".delta", flags=generic.TaskFlag.OPEN_FILE))
+                # Patch chunks are streamed into the decoder, which writes <target>.tmp
+                # and moves it to old one's location on close
+                self.tasks.append(generic.FileTask(f.target, flags=generic.TaskFlag.OPEN_FILE | generic.TaskFlag.PATCH, old_file=f.source))
                 self.tasks.extend(chunk_tasks)
-                self.tasks.append(generic.FileTask(f.target + ".delta", flags=generic.TaskFlag.CLOSE_FILE))
+                self.tasks.append(generic.FileTask(f.target, flags=generic.TaskFlag.CLOSE_FILE | generic.TaskFlag.PATCH))
+                self.tasks.extend(cache_deletes)
 
                 current_tmp_size += out_file_size
                 required_disk_size_delta = max(current_tmp_size, required_disk_size_delta)
-                
-                # Apply patch to .tmp file
-                self.tasks.append(generic.FileTask(f.target + ".tmp", flags=generic.TaskFlag.PATCH, patch_file=(f.target + '.delta'), old_file=f.source))
-                current_tmp_size -= patch_size 
-                required_disk_size_delta = max(current_tmp_size, required_disk_size_delta)
-                # Remove patch file
-                self.tasks.append(generic.FileTask(f.target + ".delta", flags=generic.TaskFlag.DELETE_FILE))
-                current_tmp_size -= old_file_size
-                required_disk_size_delta = max(current_tmp_size, required_disk_size_delta)
-                # Move new file to old one's location
-                self.tasks.append(generic.FileTask(f.target, flags=generic.TaskFlag.RENAME_FILE | generic.TaskFlag.DELETE_FILE, old_file=f.target + ".tmp"))
-                self.disk_size += out_file_size
+                patch_disk_usage.append(out_file_size)
+                current_tmp_size -= old_file_size + cache_freed
+                self.disk_size += patch_size + out_file_size
+                self.patch_size += out_file_size
 
             required_disk_size_delta = max(current_tmp_size, required_disk_size_delta)
-            
-            
+
+        if v1_range:
+            self.v1_chunks_to_download.append(v1_range[0])
+        if linux_range:
+            self.linux_chunks_to_download.append(linux_range[0])
+
         for f in self.diff.links:
             self.tasks.append(generic.FileTask(f.path, flags=generic.TaskFlag.CREATE_SYMLINK, old_file=f.target))
 
         self.items_to_complete = len(self.tasks)
 
-        print(get_readable_size(self.download_size), self.download_size)
-        print(get_readable_size(required_disk_size_delta), required_disk_size_delta)
-                
-        return dl_utils.check_free_space(required_disk_size_delta, self.path)
+        if patch_disk_usage:
+            self.patch_workers_count = self.get_patch_workers_count(len(patch_disk_usage))
+            # Patches run concurrently, output of any of them may still be
+            # written next to the old file while the rest is processed
+            patch_disk_usage.sort()
+            required_disk_size_delta += sum(patch_disk_usage[len(patch_disk_usage) - self.patch_workers_count + 1:])
+
+        return required_disk_size_delta
 
         
+    def get_patch_workers_count(self, patches):
+        workers = min(self.allowed_threads, patches)
+        available_memory = dl_utils.get_available_memory()
+        if available_memory:
+            # Leave half of the memory to the rest of the system
+            workers = min(workers, available_memory // 2 // PATCH_WORKER_MEMORY)
+        return max(1, workers)
+
+    def plan_range_part(self, pending, downloads, product_id, offset, part):
+        """
+        Adds small file to the range request being built, starting a new one when it doesn't fit.
+        Finished ranges are pushed to downloads queue.
+        Returns task writing the file out of range's memory segment and new pending range
+        """
+        if pending:
+            current_range, last_task = pending
+            range_end = current_range.offset + current_range.size
+            output_size = last_task.segment_offset + last_task.size
+            if (current_range.product_id != product_id
+                or not 0 <= offset - range_end <= COALESCE_MAX_GAP
+                or offset + part.compressed_size - current_range.offset > min(self.max_range_span, self.biggest_chunk)
+                or output_size + part.size > self.biggest_chunk):
+                downloads.append(current_range)
+                pending = None
+
+        if not pending:
+            task = generic.V1Task(product_id, 0, offset, part.size, f"{product_id}_range_{offset}")
+            current_range = task_executor.DownloadTaskRange(product_id, offset, 0, task.compressed_md5, list())
+        else:
+            task = generic.V1Task(product_id, 0, offset, part.size, last_task.md5, segment_offset=output_size)
+            # Only the last part releases the memory
+            last_task.cleanup = False
+
+        part.offset = offset - current_range.offset
+        current_range.parts.append(part)
+        current_range.size = offset + part.compressed_size - current_range.offset
+        return task, (current_range, task)
+
     def run(self):
         self.shared_memory = SharedMemory(create=True, size=1024*1024*1024)
         self.logger.debug(f"Created shared memory {self.shared_memory.size / 1024 / 1024:.02f} MiB")
@@ -476,9 +608,14 @@ class ExecutingManager:
                 worker.start()
                 self.download_workers.append(worker)
         
-            self.writer_worker = task_executor.Writer(self.shared_memory.name, self.writer_queue, self.writer_res_queue, self.writer_speed_updates, self.cache)
+            self.writer_worker = task_executor.Writer(self.shared_memory.name, self.writer_queue, self.writer_res_queue, self.writer_speed_updates, self.cache, self.patch_queues)
             self.writer_worker.start()
 
+            for patch_queue in self.patch_queues:
+                worker = task_executor.Patcher(self.shared_memory.name, patch_queue, self.writer_res_queue, self.writer_speed_updates)
+                worker.start()
+                self.patch_workers.append(worker)
+
             [th.start() for th in self.threads]
 
             signal.signal(signal.SIGTERM, handle_sig)
@@ -516,9 +653,12 @@ class ExecutingManager:
             child.join(timeout=5.0)
             if child.exitcode is None:
                 child.terminate()
+
+        for child in self.patch_workers:
+            child.terminate()
             
         # Clean queues
-        for queue in [self.writer_res_queue, self.writer_queue, self.download_queue, self.download_res_queue, self.download_speed_updates, self.writer_speed_updates]:
+        for queue in [self.writer_res_queue, self.writer_queue, *self.patch_queues, self.download_queue, self.download_res_queue, self.download_speed_updates, self.writer_speed_updates]:
             try:
                 while True:
                     _ = queue.get_nowait()
@@ -551,8 +691,10 @@ class ExecutingManager:
             self.download_queue.put(generic.TerminateWorker())
         
         self.writer_queue.put(generic.TerminateWorker())
+        for patch_queue in self.patch_queues:
+            patch_queue.put(generic.TerminateWorker())
 
-        for worker in self.download_workers:
+        for worker in self.download_workers + self.patch_workers:
             worker.join(timeout=2)
             if worker.is_alive():
                 self.logger.warning("Forcefully terminating download workers")
@@ -561,6 +703,8 @@ class ExecutingManager:
         
         self.writer_queue.close()
         self.writer_res_queue.close()
+        for patch_queue in self.patch_queues:
+            patch_queue.close()
         self.download_queue.close()
         self.download_res_queue.close()
         self.download_speed_updates.close()
@@ -593,6 +737,19 @@ class ExecutingManager:
         while self.running:
             while self.active_tasks <= self.allowed_threads * 2 and (self.v2_chunks_to_download or self.v1_chunks_to_download or self.linux_chunks_to_download):
 
+                # Inflate tasks write to disk on their own, no memory needed
+                if self.linux_chunks_to_download and isinstance(self.linux_chunks_to_download[0], task_executor.DownloadTaskInflate):
+                    inflate_task = self.linux_chunks_to_download.popleft()
+                    try:
+                        self.download_queue.put(inflate_task)
+                        self.logger.debug(f"Pushed linux inflate download to queue {inflate_task.compressed_sum} {inflate_task.destination}")
+                        self.active_tasks += 1
+                        continue
+                    except Exception as e:
+                        self.logger.warning(f"Failed to push inflate task to download {e}")
+                        self.linux_chunks_to_download.appendleft(inflate_task)
+                        break
+
                 try:
                     memory_segment = self.shm_segments.popleft()
                     no_shm = False
@@ -600,29 +757,23 @@ class ExecutingManager:
                     no_shm = True
                     break 
 
-                if self.v1_chunks_to_download:
-                    product_id, chunk_id, offset, chunk_size = self.v1_chunks_to_download.popleft()
-
-                    try:
-                        self.download_queue.put(task_executor.DownloadTask1(product_id, offset, chunk_size, chunk_id, memory_segment))
-                        self.logger.debug(f"Pushed v1 download to queue {chunk_id} {product_id} {offset} {chunk_size}")
-                        self.active_tasks += 1
-                        continue
-                    except Exception as e:
-                        self.logger.warning(f"Failed to push v1 task to download {e}")
-                        self.v1_chunks_to_download.appendleft((product_id, chunk_id, offset, chunk_size))
-                        self.shm_segments.appendleft(memory_segment)
-                        break
-                elif self.linux_chunks_to_download:
-                    product_id, chunk_id, offset, chunk_size = self.linux_chunks_to_download.popleft()
+                if self.v1_chunks_to_download or self.linux_chunks_to_download:
+                    chunks_to_download = self.v1_chunks_to_download or self.linux_chunks_to_download
+                    entry = chunks_to_download.popleft()
+                    if isinstance(entry, task_executor.DownloadTaskRange):
+                        entry.memory_segment = memory_segment
+                        download_task = entry
+                    else:
+                        product_id, chunk_id, offset, chunk_size = entry
+                        download_task = task_executor.DownloadTask1(product_id, offset, chunk_size, chunk_id, memory_segment)
                     try:
-                        self.download_queue.put(task_executor.DownloadTask1(product_id, offset, chunk_size, chunk_id, memory_segment))
-                        self.logger.debug(f"Pushed linux download to queue {chunk_id} {product_id} {offset} {chunk_size}")
+                        self.download_queue.put(download_task)
+                        self.logger.debug(f"Pushed v1 download to queue {download_task.compressed_sum} {download_task.product_id} {download_task.offset} {download_task.size}")
                         self.active_tasks += 1
                         continue
                     except Exception as e:
                         self.logger.warning(f"Failed to push v1 task to download {e}")
-                        self.v1_chunks_to_download.appendleft((product_id, chunk_id, offset, chunk_size))
+                        chunks_to_download.appendleft(entry)
                         self.shm_segments.appendleft(memory_segment)
                         break
 
@@ -674,7 +825,7 @@ class ExecutingManager:
                     if task.old_flags & generic.TaskFlag.SUPPORT:
                         old_destination = self.support
 
-                    writer_task = task_executor.WriterTask(task_dest, task.path, task.flags, old_destination=old_destination, old_file=task.old_file, patch_file=task.patch_file)
+                    writer_task = task_executor.WriterTask(task_dest, task.path, task.flags, old_destination=old_destination, old_file=task.old_file)
                     self.writer_queue.put(writer_task, timeout=1)
                     if task.flags & generic.TaskFlag.OPEN_FILE:
                         current_file = task.path
@@ -685,12 +836,27 @@ class ExecutingManager:
                     continue
 
                 try:
-                    task: Union[generic.ChunkTask, generic.V1Task] = self.tasks.popleft()
+                    task: Union[generic.ChunkTask, generic.V1Task, generic.InflateTask] = self.tasks.popleft()
                 except IndexError:
                     break
                 continue
-            
-            while ((task.compressed_md5 in ready_chunks) or task.old_file):
+
+            if isinstance(task, generic.InflateTask) and task.compressed_md5 in ready_chunks:
+                # File is already written, let the writer account for it
+                try:
+                    self.writer_queue.put(task_executor.WriterTask(self.path, task.path, generic.TaskFlag.CLOSE_FILE | generic.TaskFlag.ZIP_DEC, size=task.size), timeout=1)
+                except Exception as e:
+                    self.logger.warning(f"Failed to add queue element {e}")
+                    continue
+                del ready_chunks[task.compressed_md5]
+
+                try:
+                    task = self.tasks.popleft()
+                except IndexError:
+                    break
+                continue
+
+            while not isinstance(task, generic.InflateTask) and ((task.compressed_md5 in ready_chunks) or task.old_file):
                 shm = None
                 if not task.old_file:
                     shm = ready_chunks[task.compressed_md5].task.memory_segment
@@ -705,9 +871,12 @@ class ExecutingManager:
                         flags |= generic.TaskFlag.OFFLOAD_TO_CACHE
                     if task.old_flags & generic.TaskFlag.ZIP_DEC:
                         flags |= generic.TaskFlag.ZIP_DEC
+                    if task.old_flags & generic.TaskFlag.MMAP:
+                        flags |= generic.TaskFlag.MMAP
                     if task.old_flags & generic.TaskFlag.SUPPORT:
                         old_destination = self.support
-                    self.writer_queue.put(task_executor.WriterTask(current_dest, current_file, flags=flags, shared_memory=shm, old_destination=old_destination, old_file=task.old_file, old_offset=task.old_offset, size=task.size, hash=task.md5), timeout=1)
+                    self.writer_queue.put(task_executor.WriterTask(current_dest, current_file, flags=flags, shared_memory=shm, old_destination=old_destination, old_file=task.old_file, old_offset=task.old_offset, size=task.size, hash=task.md5,
+                                                                   shared_memory_offset=getattr(task, 'segment_offset', 0), crc32=getattr(task, 'crc32', None)), timeout=1)
                 except Exception as e:
                     self.logger.error(f"Adding to writer queue failed {e}")
                     break
@@ -773,22 +942,6 @@ class ExecutingManager:
                         with open(self.resume_file, 'a') as f:
                             f.write(f"{checksum}:{support}:{res.task.file_path}\n")
 
-                if res.success and res.task.flags & generic.TaskFlag.PATCH:
-                    if res.task.file_path.endswith('.tmp'):
-                        res.task.file_path = res.task.file_path[:-4]
-
-                    checksum = self.hash_map.get(res.task.file_path.lower())
-                    if not checksum:
-                        self.logger.warning(f"No checksum for patched file, unable to push to resume file {res.task.file_path}")
-                    else:
-                        if res.task.flags & generic.TaskFlag.SUPPORT:
-                            support = "support"
-                        else:
-                            support = ""
-
-                        with open(self.resume_file, 'a') as f:
-                            f.write(f"{checksum}:{support}:{res.task.file_path}\n")
-
                 if not res.success:
                     self.logger.fatal("Task writer failed")
                     self.fatal_error = True
@@ -9,7 +9,7 @@ from typing import Union
 from gogdl import constants
 from gogdl.dl import dl_utils
 from gogdl.dl.managers.dependencies import DependenciesManager
-from gogdl.dl.managers.task_executor import ExecutingManager
+from gogdl.dl.managers.task_executor import ExecutingManager, COALESCE_MAX_SPAN
 from gogdl.dl.workers.task_executor import DownloadTask1, DownloadTask2, WriterTask
 from gogdl.dl.objects import v1
 from gogdl.languages import Language
@@ -34,6 +34,10 @@ class Manager:
         self.should_append_folder_name = generic_manager.should_append_folder_name
         self.is_verifying = generic_manager.is_verifying
         self.allowed_threads = generic_manager.allowed_threads
+        if "max_range_span" in self.arguments:
+            self.max_range_span = self.arguments.max_range_span * 1024 * 1024
+        else:
+            self.max_range_span = COALESCE_MAX_SPAN
 
         self.platform = generic_manager.platform
 
@@ -75,8 +79,7 @@ class Manager:
         dlcs = self.get_dlcs_user_owns(True)
         self.manifest = v1.Manifest(self.platform, self.meta, self.lang, dlcs, self.api_handler, False)
 
-        build = self.api_handler.get_dependencies_repo()
-        repository = dl_utils.get_zlib_encoded(self.api_handler, build['repository_manifest'])[0] or {}
+        repository = self.api_handler.get_dependencies_repository()
 
         size_data = self.manifest.calculate_download_size()
 
@@ -267,7 +270,12 @@ class Manager:
             self.logger.info(f"Found {invalid} broken files, repairing...")
             diff = new_diff
 
-        executor = ExecutingManager(self.api_handler, self.allowed_threads, self.path, self.support, diff, secure_links)
+        # Files next to each other in main.bin are merged into bigger range requests
+        for files in (diff.new, diff.changed):
+            files.sort(key=lambda f: (str(f.product_id), f.offset or 0) if isinstance(f, v1.File) else ("", 0))
+
+        executor = ExecutingManager(self.api_handler, self.allowed_threads, self.path, self.support, diff, secure_links,
+                                    max_range_span=self.max_range_span)
         success = executor.setup()
         if not success:
             print('Unable to proceed, Not enough disk space')
@@ -285,6 +293,10 @@ class Manager:
 
         dl_utils.prepare_location(constants.MANIFESTS_DIR)
         if self.manifest:
+            if not self.is_verifying:
+                # Installed build, used to check for updates without downloading metas
+                self.manifest.data["HGLBuildId"] = self.build["build_id"]
+                self.manifest.data["HGLBranch"] = self.build["branch"]
             with open(manifest_path, 'w') as f_handle:
                 data = self.manifest.serialize_to_json()
                 f_handle.write(data)
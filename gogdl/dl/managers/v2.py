@@ -1,8 +1,10 @@
 # Handle newer depots download
 # This was introduced in GOG Galaxy 2.0, it features compression and files split by chunks
 import json
+from concurrent.futures import ThreadPoolExecutor
 from sys import exit
 from gogdl.dl import dl_utils
+import gogdl.dl.objects.v1 as v1
 import gogdl.dl.objects.v2 as v2
 import hashlib
 from gogdl.dl.managers import dependencies
@@ -57,8 +59,7 @@ class Manager:
         dlcs = self.get_dlcs_user_owns(info_command=True)
         self.manifest = v2.Manifest(self.meta, self.lang, dlcs, self.api_handler, False)
         
-        build = self.api_handler.get_dependencies_repo()
-        repository = dl_utils.get_zlib_encoded(self.api_handler, build['repository_manifest'])[0] or {}
+        repository = self.api_handler.get_dependencies_repository()
     
         size_data = self.manifest.calculate_download_size()
 
@@ -88,21 +89,94 @@ class Manager:
         }
         return response
 
+    def get_installed_manifest(self):
+        manifest_path = os.path.join(constants.MANIFESTS_DIR, self.game_id)
+        if not os.path.exists(manifest_path):
+            return None
+        self.logger.debug(f"Loading existing manifest for game {self.game_id}")
+        with open(manifest_path, 'r') as f_handle:
+            try:
+                json_data = json.load(f_handle)
+                self.logger.info("Creating Manifest instance from existing manifest")
+                return dl_utils.create_manifest_class(json_data, self.api_handler)
+            except json.JSONDecodeError:
+                return None
+
+    def get_patch_cost_model(self):
+        return v2.PatchCostModel(
+            getattr(self.arguments, "patch_cost_bandwidth", 25) * v2.PatchCostModel.MIB,
+            getattr(self.arguments, "patch_cost_disk", 200) * v2.PatchCostModel.MIB,
+            getattr(self.arguments, "patch_cost_cpu", 150) * v2.PatchCostModel.MIB,
+        )
+
+    def get_diff_size(self):
+        """
+        Calculates exact cost of updating installed game to the target build,
+        planning the update without downloading any of its data
+        """
+        old_manifest = self.get_installed_manifest()
+        if not old_manifest:
+            raise Exception("No manifest stored locally, unable to calculate update size")
+        if not self.arguments.lang:
+            self.lang = Language.parse(old_manifest.data["HGLInstallLanguage"])
+        self.get_meta()
+        if self.dlcs_list or self.dlcs_should_be_downloaded:
+            dlcs = self.get_dlcs_user_owns(requested_dlcs=self.dlcs_list)
+        else:
+            # Keep installed dlcs
+            installed_dlcs = [dlc["id"] for dlc in old_manifest.dlcs or []]
+            dlcs = [dlc for dlc in self.get_dlcs_user_owns(info_command=True) if dlc["id"] in installed_dlcs]
+        self.manifest = v2.Manifest(self.meta, self.lang, dlcs, self.api_handler, self.dlc_only)
+
+        response = {
+            "buildId": self.build["build_id"],
+            "installedBuildId": old_manifest.data.get("HGLBuildId") or old_manifest.data.get("buildId"),
+            "versionName": self.version_name,
+        }
+
+        # Depots with the same manifest have the same files, only the rest has to be compared
+        unchanged = set()
+        if not isinstance(old_manifest, v1.Manifest):
+            unchanged = set(depot.manifest for depot in self.manifest.depots) & set(depot.manifest for depot in old_manifest.depots)
+        patch = None
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            files = executor.submit(self.manifest.get_files, unchanged)
+            old_files = executor.submit(old_manifest.get_files, *((unchanged,) if unchanged else ()))
+            if len(unchanged) < len(self.manifest.depots):
+                patch = executor.submit(v2.Patch.get, self.manifest, old_manifest, self.lang, dlcs, self.api_handler)
+            files.result()
+            old_files.result()
+            patch = patch and patch.result()
+
+        cost_model = self.get_patch_cost_model()
+        diff = v2.ManifestDiff.compare(self.manifest, old_manifest, patch, cost_model)
+        self.logger.info(diff)
+
+        executor = ExecutingManager(self.api_handler, self.allowed_threads, self.path, self.support, diff, dict())
+        required_space = executor.plan()
+
+        repository = self.api_handler.get_dependencies_repository()
+        new_dependencies = [id for id in self.manifest.dependencies_ids if id not in old_manifest.dependencies_ids]
+        dependencies_size = 0
+        for depot in repository["depots"]:
+            if depot["dependencyId"] in new_dependencies and not depot["executable"]["path"].startswith("__redist"):
+                dependencies_size += depot.get("compressedSize") or 0
+
+        response.update({
+            "download_size": executor.download_size,
+            "copy_size": executor.copy_size,
+            "patch_size": executor.patch_size,
+            "patch_download_size": executor.patch_download_size,
+            "required_space": max(required_space, 0),
+            "files": {"new": len(diff.new), "changed": len(diff.changed), "deleted": len(diff.deleted)},
+            "dependencies": new_dependencies,
+            "dependencies_download_size": dependencies_size,
+        })
+        return response
+
     def download(self):
         manifest_path = os.path.join(constants.MANIFESTS_DIR, self.game_id)
-        old_manifest = None
-
-        # Load old manifest
-        if os.path.exists(manifest_path):
-            self.logger.debug(f"Loading existing manifest for game {self.game_id}")
-            with open(manifest_path, 'r') as f_handle:
-                try:
-                    json_data = json.load(f_handle)
-                    self.logger.info("Creating Manifest instance from existing manifest")
-                    old_manifest = dl_utils.create_manifest_class(json_data, self.api_handler)
-                except json.JSONDecodeError:
-                    old_manifest = None
-                    pass
+        old_manifest = self.get_installed_manifest()
 
         if self.is_verifying:
             if old_manifest:
@@ -137,9 +211,14 @@ class Manager:
             if not patch:
                 self.logger.info("No patch found, falling back to chunk based updates")
 
-        diff = v2.ManifestDiff.compare(self.manifest, old_manifest, patch)
+        cost_model = self.get_patch_cost_model()
+        diff = v2.ManifestDiff.compare(self.manifest, old_manifest, patch, cost_model)
         self.logger.info(diff)
 
+        if getattr(self.arguments, "dry_run", False):
+            print(json.dumps({"cost_model": vars(cost_model), "files": diff.patch_report}))
+            return
+
 
         dependencies_manager = dependencies.DependenciesManager(self.manifest.dependencies_ids, self.path,
                                                                 self.arguments.workers_count, self.api_handler, download_game_deps_only=True)
@@ -269,6 +348,11 @@ class Manager:
 
         dl_utils.prepare_location(constants.MANIFESTS_DIR)
         if self.manifest:
+            if not self.is_verifying:
+                # Installed build, used to check for updates without downloading metas
+                self.manifest.data["HGLBuildId"] = self.build["build_id"]
+                self.manifest.data["HGLBranch"] = self.build["branch"]
+                self.manifest.data["HGLPlatform"] = self.arguments.platform
             with open(manifest_path, 'w') as f_handle:
                 data = self.manifest.serialize_to_json()
                 f_handle.write(data)
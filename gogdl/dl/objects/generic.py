@@ -31,6 +31,8 @@ class TaskFlag(Flag):
     PATCH = auto()
     RELEASE_MEM = auto()
     ZIP_DEC = auto()
+    # Read old file through mmap, it's kept mapped until writer exits
+    MMAP = auto()
 
 @dataclass
 class MemorySegment:
@@ -56,6 +58,8 @@ class ChunkTask:
     old_offset: Optional[int] = None
     old_flags: TaskFlag = TaskFlag.NONE 
     old_file: Optional[str] = None
+    # Checksum of file written from this chunk alone, read from local installer
+    crc32: Optional[int] = None
 
 @dataclass
 class V1Task:
@@ -70,6 +74,8 @@ class V1Task:
     offload_to_cache: Optional[bool] = False
     old_flags: TaskFlag = TaskFlag.NONE 
     old_file: Optional[str] = None
+    # Where data starts in memory segment, when file was downloaded as part of bigger range
+    segment_offset: int = 0
 
     # This isn't actual sum, but unique id of chunk we use to decide 
     # if we should push it to writer
@@ -77,6 +83,21 @@ class V1Task:
     def compressed_md5(self):
         return self.md5 + "_" + str(self.index)
 
+@dataclass
+class InflateTask:
+    # Deflated Linux installer entry, downloaded and inflated
+    # by a download worker straight to its destination
+    product: str
+    path: str
+    offset: int
+    compressed_size: int
+    size: int
+    crc32: int
+
+    @property
+    def compressed_md5(self):
+        return self.product + "_" + str(self.offset)
+
 @dataclass
 class FileTask:
     path: str
@@ -85,8 +106,6 @@ class FileTask:
     old_flags: TaskFlag = TaskFlag.NONE 
     old_file: Optional[str] = None
 
-    patch_file: Optional[str] = None
-
 
 @dataclass
 class TerminateWorker:
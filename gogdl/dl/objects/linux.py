@@ -1,5 +1,11 @@
-from io import BytesIO
+import hashlib
+import json
+import mmap
+import os
 import stat
+import struct
+from urllib.parse import urlsplit
+from gogdl import constants
 
 
 END_OF_CENTRAL_DIRECTORY = b"\x50\x4b\x05\x06"
@@ -72,96 +78,104 @@ class LocalFile:
 
 
 class CentralDirectoryFile:
+    __slots__ = (
+        "product", "version_made_by", "version_needed_to_extract", "general_purpose_bit_flag",
+        "compression_method", "last_modification_time", "last_modification_date", "crc32",
+        "compressed_size", "uncompressed_size", "file_name_length", "extra_field_length",
+        "file_comment_length", "disk_number_start", "int_file_attrs", "ext_file_attrs",
+        "relative_local_file_offset", "file_name", "last_byte", "file_data_offset",
+    )
+
+    # Fixed size part of the central directory file header
+    HEADER = struct.Struct("<4xHHHHHHIIIHHHHHII")
+    ZIP64_FIELD = struct.Struct("<Q")
+
     def __init__(self, product):
         self.product = product
-        self.version_made_by: bytes
-        self.version_needed_to_extract: bytes
-        self.general_purpose_bit_flag: bytes
+        self.version_made_by: int
+        self.version_needed_to_extract: int
+        self.general_purpose_bit_flag: int
         self.compression_method: int 
-        self.last_modification_time: bytes
-        self.last_modification_date: bytes
+        self.last_modification_time: int
+        self.last_modification_date: int
         self.crc32: int
         self.compressed_size: int
         self.uncompressed_size: int
         self.file_name_length: int
         self.extra_field_length: int
         self.file_comment_length: int
-        self.disk_number_start: bytes
-        self.int_file_attrs: bytes
-        self.ext_file_attrs: bytes
+        self.disk_number_start: int
+        self.int_file_attrs: int
+        self.ext_file_attrs: int
         self.relative_local_file_offset: int
         self.file_name: str
-        self.extra_field: BytesIO 
-        self.comment: bytes
         self.last_byte: int
         self.file_data_offset: int
 
     @classmethod
-    def from_bytes(cls, data, product):
+    def from_bytes(cls, data, product, offset=0):
+        """
+        Parses record starting at `offset` of data (preferably a memoryview, nothing gets copied)
+        Returns the record and offset of the next one
+        """
         cd_file = cls(product)
 
-        cd_file.version_made_by = data[4:6]
-        cd_file.version_needed_to_extract = data[6:8]
-        cd_file.general_purpose_bit_flag = data[8:10]
-        cd_file.compression_method = int.from_bytes(data[10:12], "little")
-        cd_file.last_modification_time = data[12:14]
-        cd_file.last_modification_date = data[14:16]
-        cd_file.crc32 = int.from_bytes(data[16:20], "little")
-        cd_file.compressed_size = int.from_bytes(data[20:24], "little")
-        cd_file.uncompressed_size = int.from_bytes(data[24:28], "little")
-        cd_file.file_name_length = int.from_bytes(data[28:30], "little")
-        cd_file.extra_field_length = int.from_bytes(data[30:32], "little")
-        cd_file.file_comment_length = int.from_bytes(data[32:34], "little")
-        cd_file.disk_number_start = data[34:36]
-        cd_file.int_file_attrs = data[36:38]
-        cd_file.ext_file_attrs = data[38:42]
-        cd_file.relative_local_file_offset = int.from_bytes(data[42:46], "little")
+        (
+            cd_file.version_made_by,
+            cd_file.version_needed_to_extract,
+            cd_file.general_purpose_bit_flag,
+            cd_file.compression_method,
+            cd_file.last_modification_time,
+            cd_file.last_modification_date,
+            cd_file.crc32,
+            cd_file.compressed_size,
+            cd_file.uncompressed_size,
+            cd_file.file_name_length,
+            cd_file.extra_field_length,
+            cd_file.file_comment_length,
+            cd_file.disk_number_start,
+            cd_file.int_file_attrs,
+            cd_file.ext_file_attrs,
+            cd_file.relative_local_file_offset,
+        ) = cls.HEADER.unpack_from(data, offset)
         cd_file.file_data_offset = 0
 
-        extra_field_start = 46 + cd_file.file_name_length
-        cd_file.file_name = bytes(data[46:extra_field_start]).decode()
-
-        cd_file.extra_field = BytesIO(data[
-                              extra_field_start: extra_field_start + cd_file.extra_field_length
-                              ])
+        extra_field_start = offset + cls.HEADER.size + cd_file.file_name_length
+        cd_file.file_name = str(data[offset + cls.HEADER.size:extra_field_start], "utf-8")
 
+        # Look for ZIP64 extended information field
+        extra_field_end = extra_field_start + cd_file.extra_field_length
         field = None
-        while True:
-            id = int.from_bytes(cd_file.extra_field.read(2), "little")
-            size = int.from_bytes(cd_file.extra_field.read(2), "little")
+        position = extra_field_start
+        while extra_field_end - position >= 4:
+            id, size = struct.unpack_from("<HH", data, position)
+            position += 4
 
             if id == 0x01:
-                if cd_file.extra_field_length - cd_file.extra_field.tell() >= size:
-                    field = BytesIO(cd_file.extra_field.read(size))
+                if extra_field_end - position >= size:
+                    field = position
                 break
-            
-            cd_file.extra_field.seek(size, 1)
 
-            if cd_file.extra_field_length - cd_file.extra_field.tell() == 0:
-                break
-        
+            position += size
 
-        if field:
+        if field is not None:
             if cd_file.uncompressed_size == 0xFFFFFFFF:
-                cd_file.uncompressed_size = int.from_bytes(field.read(8), "little")
+                cd_file.uncompressed_size = cls.ZIP64_FIELD.unpack_from(data, field)[0]
+                field += 8
 
             if cd_file.compressed_size == 0xFFFFFFFF:
-                cd_file.compressed_size = int.from_bytes(field.read(8), "little")
+                cd_file.compressed_size = cls.ZIP64_FIELD.unpack_from(data, field)[0]
+                field += 8
 
             if cd_file.relative_local_file_offset == 0xFFFFFFFF:
-                cd_file.relative_local_file_offset = int.from_bytes(field.read(8), "little")
+                cd_file.relative_local_file_offset = cls.ZIP64_FIELD.unpack_from(data, field)[0]
 
-        comment_start = extra_field_start + cd_file.extra_field_length
-        cd_file.comment = data[
-                          comment_start: comment_start + cd_file.file_comment_length
-                          ]
+        cd_file.last_byte = extra_field_end + cd_file.file_comment_length - offset
 
-        cd_file.last_byte = comment_start + cd_file.file_comment_length
-
-        return cd_file, comment_start + cd_file.file_comment_length
+        return cd_file, extra_field_end + cd_file.file_comment_length
     
     def is_symlink(self):
-        return stat.S_ISLNK(int.from_bytes(self.ext_file_attrs, "little") >> 16)
+        return stat.S_ISLNK(self.ext_file_attrs >> 16)
 
     def as_dict(self):
         return {'file_name': self.file_name, 'crc32': self.crc32, 'compressed_size': self.compressed_size, 'size': self.uncompressed_size, 'is_symlink': self.is_symlink()}
@@ -179,24 +193,21 @@ class CentralDirectory:
         self.product = product
 
     @staticmethod
-    def create_central_dir_file(data, product):
-        return CentralDirectoryFile.from_bytes(data, product)
+    def create_central_dir_file(data, product, offset=0):
+        return CentralDirectoryFile.from_bytes(data, product, offset)
 
     @classmethod
     def from_bytes(cls, data, n, product):
         central_dir = cls(product)
-        for record in range(n):
-            cd_file, next_offset = central_dir.create_central_dir_file(data, product)
+        data = memoryview(data)
+        offset = 0
+        prev = None
+        for _ in range(n):
+            cd_file, offset = central_dir.create_central_dir_file(data, product, offset)
             central_dir.files.append(cd_file)
-            data = data[next_offset:]
-            if record == 0:
-                continue
-            
-            prev_i = record - 1
-            if not (prev_i >= 0 and prev_i < len(central_dir.files)):
-                continue
-            prev = central_dir.files[prev_i]
-            prev.file_data_offset = cd_file.relative_local_file_offset - prev.compressed_size
+            if prev:
+                prev.file_data_offset = cd_file.relative_local_file_offset - prev.compressed_size
+            prev = cd_file
         
         return central_dir
 
@@ -280,12 +291,29 @@ class EndOfCentralDir:
 
 
 class InstallerHandler:
-    def __init__(self, url, product_id, session):
+    def __init__(self, url, product_id, session, version=None):
         self.url = url
         self.product = product_id
         self.session = session
         self.file_size = 0
 
+        # ZIP contents
+        self.central_directory_offset: int
+        self.central_directory_records: int
+        self.size_of_central_directory: int
+        self.central_directory: CentralDirectory
+
+        # Layout of the installer is cached, so it's not fetched again for the same version
+        self.layout_path = None
+        self.cached_central_directory = None
+        if version is not None:
+            key = hashlib.sha256(f"{product_id}:{urlsplit(url).path}:{version}".encode()).hexdigest()
+            self.layout_path = os.path.join(constants.LINUX_INSTALLERS_DIR, key)
+            self.load_layout()
+
+        if self.cached_central_directory is not None:
+            return
+
         SEARCH_OFFSET = 0
         SEARCH_RANGE = 2 * 1024 * 1024 # 2 MiB
 
@@ -295,11 +323,42 @@ class InstallerHandler:
         
         self.start_of_archive_index = beginning_of_file.find(LOCAL_FILE_HEADER) + SEARCH_OFFSET
 
-        # ZIP contents
-        self.central_directory_offset: int
-        self.central_directory_records: int
-        self.size_of_central_directory: int
-        self.central_directory: CentralDirectory
+    def load_layout(self):
+        if not os.path.exists(self.layout_path):
+            return
+        try:
+            with open(self.layout_path, 'rb') as f:
+                layout = json.loads(f.readline())
+                central_directory_data = f.read()
+        except (OSError, ValueError):
+            return
+        if len(central_directory_data) != layout["size_of_central_directory"]:
+            return
+
+        self.file_size = layout["file_size"]
+        self.start_of_archive_index = layout["start_of_archive_index"]
+        self.central_directory_offset = layout["central_directory_offset"]
+        self.size_of_central_directory = layout["size_of_central_directory"]
+        self.central_directory_records = layout["central_directory_records"]
+        self.cached_central_directory = central_directory_data
+
+    def save_layout(self, central_directory_data):
+        layout = {
+            "file_size": self.file_size,
+            "start_of_archive_index": self.start_of_archive_index,
+            "central_directory_offset": self.central_directory_offset,
+            "size_of_central_directory": self.size_of_central_directory,
+            "central_directory_records": self.central_directory_records,
+        }
+        try:
+            os.makedirs(constants.LINUX_INSTALLERS_DIR, exist_ok=True)
+            tmp_path = f"{self.layout_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(json.dumps(layout).encode() + b"\n")
+                f.write(central_directory_data)
+            os.replace(tmp_path, self.layout_path)
+        except OSError:
+            pass
 
     def get_bytes_from_file(self, from_b=-1, size=None, add_archive_index=True, raw_response=False):
         if add_archive_index:
@@ -331,6 +390,9 @@ class InstallerHandler:
         return f"bytes={from_b}-{to_b}"
 
     def setup(self):
+        if self.cached_central_directory is not None:
+            self.__parse_central_directory(self.cached_central_directory)
+            return
         self.__find_end_of_cd()
         self.__find_central_directory()
 
@@ -343,8 +405,13 @@ class InstallerHandler:
         zip64_end_of_cd_locator_index = end_of_cd_data.find(ZIP_64_END_OF_CD_LOCATOR)
         assert end_of_cd_header_data_index != -1
         end_of_cd = EndOfCentralDir.from_bytes(end_of_cd_data[end_of_cd_header_data_index:])
-        if end_of_cd.central_directory_offset == 0xFFFFFFFF:
-            assert zip64_end_of_cd_locator_index != -1
+        # Any of the fields can overflow, e.g. more than 65535 entries in a small archive
+        is_zip64 = (
+            end_of_cd.central_directory_offset == 0xFFFFFFFF
+            or end_of_cd.size_of_central_directory == 0xFFFFFFFF
+            or end_of_cd.central_directory_records == 0xFFFF
+        )
+        if is_zip64 and zip64_end_of_cd_locator_index != -1:
             # We need to find zip64 headers
 
             zip64_end_of_cd_locator = Zip64EndOfCentralDirLocator.from_bytes(end_of_cd_data[zip64_end_of_cd_locator_index:])
@@ -355,6 +422,7 @@ class InstallerHandler:
             self.size_of_central_directory = zip64_end_of_cd.size_of_central_directory
             self.central_directory_records = zip64_end_of_cd.number_of_entries_total
         else:
+            assert end_of_cd.central_directory_offset != 0xFFFFFFFF
             self.central_directory_offset = end_of_cd.central_directory_offset
             self.size_of_central_directory = end_of_cd.size_of_central_directory
             self.central_directory_records = end_of_cd.central_directory_records 
@@ -367,6 +435,11 @@ class InstallerHandler:
 
         assert central_directory_data[:4] == CENTRAL_DIRECTORY
 
+        self.__parse_central_directory(central_directory_data)
+        if self.layout_path:
+            self.save_layout(central_directory_data)
+
+    def __parse_central_directory(self, central_directory_data):
         self.central_directory = CentralDirectory.from_bytes(
             central_directory_data, self.central_directory_records, self.product
         )
@@ -374,7 +447,31 @@ class InstallerHandler:
         last_entry.file_data_offset = self.central_directory_offset - last_entry.compressed_size
 
 
+class LocalInstallerHandler(InstallerHandler):
+    """
+    Installer read from local file through mmap instead of range requests
+    """
+    def __init__(self, path, product_id):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        super().__init__(path, product_id, None)
+        self.file_size = len(self.map)
+
+    def get_bytes_from_file(self, from_b=-1, size=None, add_archive_index=True, raw_response=False):
+        from_b = max(from_b, 0)
+        if add_archive_index:
+            from_b += self.start_of_archive_index
+        end_b = from_b + size if size else len(self.map)
+        return self.map[from_b:end_b]
+
+    def close(self):
+        self.map.close()
+
+
 class LinuxFile:
+    __slots__ = ("product", "path", "compression", "offset", "compressed_size", "size", "hash", "flags")
+
     def __init__(self, product, path, compression, start, compressed_size, size, checksum, executable):
         self.product = product
         self.path = path
@@ -383,7 +480,5 @@ class LinuxFile:
         self.compressed_size = compressed_size
         self.size = size
         self.hash = str(checksum)
-        self.flags = []
-        if executable:
-            self.flags.append("executable")
+        self.flags = ("executable",) if executable else ()
 
@@ -23,6 +23,8 @@ class Depot:
         return status
 
 class Directory:
+    __slots__ = ("path",)
+
     def __init__(self, item_data):
         self.path = item_data["path"].replace(constants.NON_NATIVE_SEP, os.sep).lstrip(os.sep)
 
@@ -34,17 +36,20 @@ class Dependency:
 
 
 class File:
+    __slots__ = ("offset", "hash", "url", "path", "size", "flags", "product_id")
+
     def __init__(self, data, product_id):
         self.offset = data.get("offset")
         self.hash = data.get("hash")
         self.url = data.get("url")
         self.path = data["path"].lstrip("/")
         self.size = data["size"]
-        self.flags = []
+        flags = []
         if data.get("support"):
-            self.flags.append("support")
+            flags.append("support")
         if data.get("executable"):
-            self.flags.append("executble")
+            flags.append("executble")
+        self.flags = tuple(flags)
 
         self.product_id = product_id
 
@@ -1,5 +1,7 @@
 import json
 import os
+import struct
+from array import array
 
 from gogdl.dl import dl_utils
 from gogdl.dl.objects import generic, v1
@@ -7,13 +9,82 @@ from gogdl import constants
 from gogdl.languages import Language
 
 
+class DepotChunks:
+    """
+    Packed list of depot file chunks
+
+    Each chunk is stored as a fixed width record (md5, compressedMd5, size, compressedSize)
+    in a single bytes object. Indexing returns the chunk as a dict, like in the manifest json
+    """
+    __slots__ = ("data", "old_offsets")
+
+    RECORD = struct.Struct("<16s16sQQ")
+
+    def __init__(self, data=b""):
+        self.data = data
+        # Offsets of matching chunks in the previous version of the file, set by FileDiff
+        self.old_offsets = None
+
+    @classmethod
+    def from_json(cls, chunks):
+        pack = cls.RECORD.pack
+        return cls(b"".join(
+            pack(bytes.fromhex(chunk["md5"]), bytes.fromhex(chunk["compressedMd5"]), chunk["size"], chunk["compressedSize"])
+            for chunk in chunks
+        ))
+
+    def __len__(self):
+        return len(self.data) // self.RECORD.size
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("chunk index out of range")
+        md5, compressed_md5, size, compressed_size = self.RECORD.unpack_from(self.data, index * self.RECORD.size)
+        chunk = {"md5": md5.hex(), "compressedMd5": compressed_md5.hex(), "size": size, "compressedSize": compressed_size}
+        old_offset = self.old_offset(index)
+        if old_offset is not None:
+            chunk["old_offset"] = old_offset
+        return chunk
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def md5(self, index):
+        start = index * self.RECORD.size
+        return self.data[start:start + 16]
+
+    def size(self, index):
+        return self.RECORD.unpack_from(self.data, index * self.RECORD.size)[2]
+
+    def total_size(self):
+        return sum(record[2] for record in self.RECORD.iter_unpack(self.data))
+
+    def total_compressed_size(self):
+        return sum(record[3] for record in self.RECORD.iter_unpack(self.data))
+
+    def old_offset(self, index):
+        if self.old_offsets is None or self.old_offsets[index] < 0:
+            return None
+        return self.old_offsets[index]
+
+    def set_old_offset(self, index, offset):
+        if self.old_offsets is None:
+            self.old_offsets = array("q", [-1]) * len(self)
+        self.old_offsets[index] = offset
+
+
 class DepotFile:
+    __slots__ = ("flags", "path", "chunks", "md5", "sha256", "product_id")
+
     def __init__(self, item_data, product_id):
-        self.flags = item_data.get("flags") or list()
+        self.flags = tuple(item_data.get("flags") or ())
         self.path = item_data["path"].replace(constants.NON_NATIVE_SEP, os.sep).lstrip(os.sep)
         if "support" in self.flags:
             self.path = os.path.join(product_id, self.path)
-        self.chunks = item_data["chunks"]
+        self.chunks = DepotChunks.from_json(item_data["chunks"])
         self.md5 = item_data.get("md5")
         self.sha256 = item_data.get("sha256")
         self.product_id = product_id
@@ -22,10 +93,14 @@ class DepotFile:
 # That exists in some depots, indicates directory to be created, it has only path in it
 # Yes that's the thing
 class DepotDirectory:
+    __slots__ = ("path",)
+
     def __init__(self, item_data):
         self.path = item_data["path"].replace(constants.NON_NATIVE_SEP, os.sep).rstrip(os.sep)
     
 class DepotLink:
+    __slots__ = ("path", "target")
+
     def __init__(self, item_data):
         self.path = item_data["path"]
         self.target = item_data["target"]
@@ -125,13 +200,15 @@ class Manifest:
 
         return data 
 
-    def get_files(self):
+    def get_files(self, skip_manifests=()):
         for depot in self.depots:
-            manifest = dl_utils.get_zlib_encoded(
+            if depot.manifest in skip_manifests:
+                continue
+            items = dl_utils.iter_zlib_encoded_items(
                 self.api_handler,
                 f"{constants.GOG_CDN}/content-system/v2/meta/{dl_utils.galaxy_path(depot.manifest)}",
-            )[0]
-            for item in manifest["depot"]["items"]:
+            )
+            for item in items:
                 if item["type"] == "DepotFile":
                     self.files.append(DepotFile(item, depot.product_id))
                 elif item["type"] == "DepotLink":
@@ -148,15 +225,19 @@ class FileDiff:
     @classmethod
     def compare(cls, new: DepotFile, old: DepotFile):
         diff = cls()
-        diff.disk_size_diff = sum([ch['size'] for ch in new.chunks])
-        diff.disk_size_diff -= sum([ch['size'] for ch in old.chunks])
+        diff.disk_size_diff = new.chunks.total_size()
+        diff.disk_size_diff -= old.chunks.total_size()
         diff.old_file_flags = old.flags
-        for new_chunk in new.chunks:
-            old_offset = 0
-            for old_chunk in old.chunks:
-                if old_chunk["md5"] == new_chunk["md5"]:
-                    new_chunk["old_offset"] = old_offset
-                old_offset += old_chunk["size"]
+        # Last occurrence of the chunk in the old file wins
+        old_offsets = dict()
+        old_offset = 0
+        for i in range(len(old.chunks)):
+            old_offsets[old.chunks.md5(i)] = old_offset
+            old_offset += old.chunks.size(i)
+        for i in range(len(new.chunks)):
+            old_offset = old_offsets.get(new.chunks.md5(i))
+            if old_offset is not None:
+                new.chunks.set_old_offset(i, old_offset)
         diff.file = new
         return diff
 
@@ -168,18 +249,63 @@ class FilePatchDiff:
         self.source = data['path_source'].replace('\\', '/')
         self.target = data['path_target'].replace('\\', '/')
         self.md5 = data['md5']
-        self.chunks = data['chunks']
+        self.chunks = DepotChunks.from_json(data['chunks'])
 
         self.old_file: DepotFile
         self.new_file: DepotFile
 
+class PatchCostModel:
+    """
+    Estimates time in seconds needed to update a file by applying xdelta patch
+    or by downloading only the chunks that changed, speeds are in bytes per second
+    """
+    MIB = 1024 * 1024
+
+    def __init__(self, bandwidth=25 * MIB, disk_speed=200 * MIB, patch_speed=150 * MIB):
+        self.bandwidth = bandwidth
+        self.disk_speed = disk_speed
+        # Throughput of xdelta decoding, chunks are inflated while being downloaded
+        self.patch_speed = patch_speed
+
+    def estimate(self, patch_file: FilePatchDiff, old_file: DepotFile, new_file: DepotFile):
+        old_size = old_file.chunks.total_size()
+        new_size = new_file.chunks.total_size()
+
+        patch_download = patch_file.chunks.total_compressed_size()
+        # Patch is streamed into the decoder, that reads old file and writes the new one
+        patch_cost = patch_download / self.bandwidth + (old_size + new_size) / self.disk_speed + new_size / self.patch_speed
+
+        old_chunks = {record[0] for record in DepotChunks.RECORD.iter_unpack(old_file.chunks.data)}
+        chunks_download = 0
+        reused_size = 0
+        for md5, _, size, compressed_size in DepotChunks.RECORD.iter_unpack(new_file.chunks.data):
+            if md5 in old_chunks:
+                reused_size += size
+            else:
+                chunks_download += compressed_size
+        # Reused chunks are copied from the old file
+        chunks_cost = chunks_download / self.bandwidth + (reused_size + new_size) / self.disk_speed
+
+        return {
+            "path": new_file.path,
+            "strategy": "patch" if patch_cost <= chunks_cost else "chunks",
+            "patch_cost": round(patch_cost, 3),
+            "patch_download_size": patch_download,
+            "chunks_cost": round(chunks_cost, 3),
+            "chunks_download_size": chunks_download,
+        }
+
+
 class ManifestDiff(generic.BaseDiff):
     def __init__(self):
         super().__init__()
+        # Estimated costs of files that could be patched
+        self.patch_report = []
 
     @classmethod
-    def compare(cls, manifest, old_manifest=None, patch=None):
+    def compare(cls, manifest, old_manifest=None, patch=None, cost_model=None):
         comparison = cls()
+        cost_model = cost_model or PatchCostModel()
         is_manifest_upgrade = isinstance(old_manifest, v1.Manifest)
 
         if not old_manifest:
@@ -225,7 +351,12 @@ class ManifestDiff(generic.BaseDiff):
                             patch_file.new_file = new_file 
 
                 if patch_file:
-                    comparison.changed.append(patch_file)
+                    estimate = cost_model.estimate(patch_file, old_file, new_file)
+                    comparison.patch_report.append(estimate)
+                    if estimate["strategy"] == "patch":
+                        comparison.changed.append(patch_file)
+                    else:
+                        comparison.changed.append(FileDiff.compare(new_file, old_file))
                     continue
 
                 if len(new_file.chunks) == 1 and len(old_file.chunks) == 1:
@@ -276,16 +407,17 @@ class Patch:
         files = []
         fail = False
         for depot in depots:
-            depotdiffs = dl_utils.get_zlib_encoded(api_handler, f'{constants.GOG_CDN}/content-system/v2/patches/meta/{dl_utils.galaxy_path(depot["manifest"])}')[0]
-            if not depotdiffs:
+            depotdiffs = dl_utils.iter_zlib_encoded_items(api_handler, f'{constants.GOG_CDN}/content-system/v2/patches/meta/{dl_utils.galaxy_path(depot["manifest"])}')
+            try:
+                for diff in depotdiffs:
+                    if diff['type'] == 'DepotDiff':
+                       files.append(FilePatchDiff(diff))
+                    else:
+                        print('Unknown type in patcher', diff['type'])
+                        return None
+            except Exception:
                 fail = True
                 break
-            for diff in depotdiffs['depot']['items']:
-                if diff['type'] == 'DepotDiff':
-                   files.append(FilePatchDiff(diff))
-                else:
-                    print('Unknown type in patcher', diff['type'])
-                    return None
     
         if fail:
             # TODO: Handle this beter
@@ -25,7 +25,7 @@ class DLWorker:
             if self.verify():
                 return
 
-        file_permissions = bin(int.from_bytes(self.data.ext_file_attrs, "little"))[9:][:9]
+        file_permissions = bin(self.data.ext_file_attrs)[9:][:9]
 
         # Load local file header
         file_data = installer_handler.get_bytes_from_file(
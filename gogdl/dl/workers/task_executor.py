@@ -9,6 +9,7 @@ import time
 import requests
 import zlib
 import hashlib
+import mmap
 from io import BytesIO
 from typing import Optional, Union
 from copy import copy
@@ -19,6 +20,25 @@ from multiprocessing import Process, Queue
 from gogdl.dl.objects.generic import MemorySegment, TaskFlag, TerminateWorker
 import gogdl_xdelta3
 
+# Max amount of inflated data written at once
+INFLATE_WRITE_SIZE = 1024 * 1024
+
+
+def write_inflated(decompressor, data, file_handle, crc):
+    """
+    Inflates data to file in bounded blocks, returns amount written and updated crc32
+    """
+    written = 0
+    while True:
+        inflated = decompressor.decompress(data, INFLATE_WRITE_SIZE)
+        file_handle.write(inflated)
+        crc = zlib.crc32(inflated, crc)
+        written += len(inflated)
+        data = decompressor.unconsumed_tail
+        if not data and len(inflated) < INFLATE_WRITE_SIZE:
+            break
+    return written, crc
+
 
 class FailReason(Enum):
     UNKNOWN = 0
@@ -49,6 +69,39 @@ class DownloadTask2(DownloadTask):
     compressed_sum: str
     memory_segment: MemorySegment
 
+@dataclass
+class DownloadTaskInflate(DownloadTask):
+    # Deflated entry of Linux installer, it's inflated by the worker
+    # and written straight to the destination, no shared memory is used
+    offset: int
+    compressed_size: int
+    size: int
+    crc32: int
+    destination: str
+    compressed_sum: str
+    # Size of single range request, decompressor state is kept across them
+    range_size: int
+
+@dataclass
+class RangePart:
+    # Offset relative to the start of the range
+    offset: int
+    compressed_size: int
+    size: int
+    deflated: bool = False
+    crc32: Optional[int] = None
+    md5: Optional[str] = None
+
+@dataclass
+class DownloadTaskRange(DownloadTask):
+    # Single range request covering multiple small files, split back
+    # into memory segment one after another
+    offset: int
+    size: int
+    compressed_sum: str
+    parts: list
+    memory_segment: Optional[MemorySegment] = None
+
 
 @dataclass
 class WriterTask:
@@ -64,14 +117,18 @@ class WriterTask:
     old_destination: Optional[str] = None
     old_file: Optional[str] = None
     old_offset: Optional[int] = None
+    shared_memory_offset: int = 0
+    # Checksum of whole file read from old file, checked after writing it
+    crc32: Optional[int] = None
 
-    patch_file: Optional[str] = None
+    # Chunk read by the writer for a patched file, when it isn't in shared memory
+    data: Optional[bytes] = None
 
 @dataclass
 class DownloadTaskResult:
     success: bool
     fail_reason: Optional[FailReason]
-    task: Union[DownloadTask2, DownloadTask1]
+    task: Union[DownloadTask2, DownloadTask1, DownloadTaskInflate, DownloadTaskRange]
     download_size: Optional[int] = None
     decompressed_size: Optional[int] = None
 
@@ -96,7 +153,7 @@ class Download(Process):
     def run(self):
         while not self.early_exit:
             try:
-                task: Union[DownloadTask1, DownloadTask2, TerminateWorker] = self.download_queue.get(timeout=1)
+                task: Union[DownloadTask1, DownloadTask2, DownloadTaskInflate, DownloadTaskRange, TerminateWorker] = self.download_queue.get(timeout=1)
             except Empty:
                continue 
 
@@ -107,6 +164,10 @@ class Download(Process):
                 self.v2(task)
             elif type(task) == DownloadTask1:
                 self.v1(task)
+            elif type(task) == DownloadTaskInflate:
+                self.inflate(task)
+            elif type(task) == DownloadTaskRange:
+                self.coalesced(task)
 
         self.session.close()
         self.shared_memory.close()
@@ -250,19 +311,158 @@ class Download(Process):
 
         self.results_queue.put(DownloadTaskResult(True, None, task, download_size=download_size, decompressed_size=download_size))
 
+    def coalesced(self, task: DownloadTaskRange):
+        retries = 5
+        urls = self.secure_links[task.product_id]
+
+        url = self._get_download_url_v1(urls)
+        range_header = dl_utils.get_range_header(task.offset, task.size)
+
+        buffer = bytearray()
+        while retries > 0:
+            response = None
+            buffer = bytearray()
+            try:
+                response = self.session.get(url, stream=True, timeout=10, headers={'Range': range_header})
+                response.raise_for_status()
+                for chunk in response.iter_content(1024 * 512):
+                    buffer += chunk
+                    self.speed_queue.put((len(chunk), 0))
+                if len(buffer) != task.size:
+                    raise requests.exceptions.RequestException(f"Expected {task.size} bytes, got {len(buffer)}")
+            except Exception as e:
+                print("Connection failed", e)
+                if response is not None and response.status_code == 401:
+                    self.results_queue.put(DownloadTaskResult(False, FailReason.UNAUTHORIZED, task))
+                    return
+                retries -= 1
+                time.sleep(2)
+                continue
+            break
+        else:
+            self.results_queue.put(DownloadTaskResult(False, FailReason.CONNECTION, task))
+            return
+
+        view = memoryview(buffer)
+        position = task.memory_segment.offset
+        try:
+            for part in task.parts:
+                data = view[part.offset:part.offset + part.compressed_size]
+                if part.deflated:
+                    data = zlib.decompress(data, -15)
+                if (len(data) != part.size
+                    or (part.crc32 is not None and zlib.crc32(data) != part.crc32)
+                    or (part.md5 and hashlib.md5(data).hexdigest() != part.md5)):
+                    self.results_queue.put(DownloadTaskResult(False, FailReason.CHECKSUM, task))
+                    return
+                self.shared_memory.buf[position:position + part.size] = data
+                position += part.size
+        except Exception as e:
+            print("ERROR", e)
+            self.results_queue.put(DownloadTaskResult(False, FailReason.UNKNOWN, task))
+            return
+
+        decompressed_size = position - task.memory_segment.offset
+        self.speed_queue.put((0, decompressed_size))
+        self.results_queue.put(DownloadTaskResult(True, None, task, download_size=task.size, decompressed_size=decompressed_size))
+
+    def inflate(self, task: DownloadTaskInflate):
+        urls = self.secure_links[task.product_id]
+        url = self._get_download_url_v1(urls)
+
+        try:
+            path = dl_utils.get_case_insensitive_name(task.destination)
+            directory = os.path.dirname(path)
+            if directory and not os.path.exists(directory):
+                dl_utils.prepare_location(directory)
+            file_handle = open(path, 'wb')
+        except OSError as e:
+            print("ERROR", e)
+            self.results_queue.put(DownloadTaskResult(False, FailReason.UNKNOWN, task))
+            return
+
+        decompressor = zlib.decompressobj(-15)
+        crc = 0
+        download_size = 0
+        decompressed_size = 0
+        with file_handle:
+            range_offset = 0
+            while range_offset < task.compressed_size:
+                range_size = min(task.range_size, task.compressed_size - range_offset)
+                range_header = dl_utils.get_range_header(task.offset + range_offset, range_size)
+                # State before this range, so it can be retried without starting over
+                checkpoint = (decompressor.copy(), crc, decompressed_size)
+                # Data of the range already reported, retried part isn't reported again
+                reported = 0
+                reported_written = 0
+
+                retries = 5
+                while retries > 0:
+                    response = None
+                    received = 0
+                    try:
+                        response = self.session.get(url, stream=True, timeout=10, headers={'Range': range_header})
+                        response.raise_for_status()
+                        for chunk in response.iter_content(1024 * 512):
+                            received += len(chunk)
+                            written, crc = write_inflated(decompressor, chunk, file_handle, crc)
+                            decompressed_size += written
+                            new_reported = max(received, reported)
+                            new_reported_written = max(decompressed_size - checkpoint[2], reported_written)
+                            if new_reported > reported or new_reported_written > reported_written:
+                                self.speed_queue.put((new_reported - reported, new_reported_written - reported_written))
+                                reported, reported_written = new_reported, new_reported_written
+                        if received != range_size:
+                            raise requests.exceptions.RequestException(f"Expected {range_size} bytes, got {received}")
+                    except Exception as e:
+                        print("Connection failed", e)
+                        if response is not None and response.status_code == 401:
+                            self.results_queue.put(DownloadTaskResult(False, FailReason.UNAUTHORIZED, task))
+                            return
+                        decompressor = checkpoint[0].copy()
+                        crc, decompressed_size = checkpoint[1], checkpoint[2]
+                        file_handle.seek(decompressed_size)
+                        file_handle.truncate()
+                        retries -= 1
+                        time.sleep(2)
+                        continue
+                    break
+                else:
+                    self.results_queue.put(DownloadTaskResult(False, FailReason.CONNECTION, task))
+                    return
+
+                download_size += range_size
+                range_offset += range_size
+
+            remaining = decompressor.flush()
+            file_handle.write(remaining)
+            crc = zlib.crc32(remaining, crc)
+            decompressed_size += len(remaining)
+
+        if not decompressor.eof or decompressed_size != task.size or crc != task.crc32:
+            self.results_queue.put(DownloadTaskResult(False, FailReason.CHECKSUM, task))
+            return
+
+        self.results_queue.put(DownloadTaskResult(True, None, task, download_size=download_size, decompressed_size=decompressed_size))
+
 class Writer(Process):
-    def __init__(self, shared_memory, writer_queue, results_queue, speed_queue, cache):
+    def __init__(self, shared_memory, writer_queue, results_queue, speed_queue, cache, patch_queues=None):
         self.shared_memory = SharedMemory(name=shared_memory)
         self.cache = cache
         self.writer_queue: Queue = writer_queue
         self.results_queue: Queue = results_queue
         self.speed_queue: Queue = speed_queue
+        self.patch_queues: list = patch_queues or []
         self.early_exit = False
         super().__init__()
 
     def run(self):
         file_handle = None
         current_file = ''
+        mapped_files = dict()
+        # Patcher the currently open patched file is decoded by
+        patch_queue = None
+        patches = 0
 
         while not self.early_exit:
             try:
@@ -299,16 +499,42 @@ class Writer(Process):
                 if file_handle:
                     print("Opening on unclosed file")
                     file_handle.close()
-                file_handle = open(task_path, 'wb')
+                    file_handle = None
                 current_file = task_path
+                if task.flags & TaskFlag.PATCH:
+                    # Patched files are assigned to patchers in turns, chunks follow the file
+                    if self.patch_queues:
+                        patch_queue = self.patch_queues[patches % len(self.patch_queues)]
+                        patches += 1
+                        patch_queue.put(task)
+                        continue
+                    try:
+                        file_handle = open_patch(task, self.speed_queue)
+                    except Exception as e:
+                        print("Patch failed", e)
+                        self.results_queue.put(WriterTaskResult(False, task))
+                        continue
+                else:
+                    file_handle = open(task_path, 'wb')
 
                 self.results_queue.put(WriterTaskResult(True, task))
                 continue
             elif task.flags & TaskFlag.CLOSE_FILE:
+                if patch_queue:
+                    patch_queue.put(task)
+                    patch_queue = None
+                    continue
+                if task.flags & TaskFlag.PATCH:
+                    self.results_queue.put(close_patch(file_handle, task))
+                    file_handle = None
+                    continue
                 if file_handle:
                     file_handle.close()
                     file_handle = None
-                self.results_queue.put(WriterTaskResult(True, task))
+                # Inflated entries are written by download workers already
+                if task.flags & TaskFlag.ZIP_DEC:
+                    written = task.size or 0
+                self.results_queue.put(WriterTaskResult(True, task, written=written))
                 continue
             
             elif task.flags & TaskFlag.COPY_FILE:
@@ -360,37 +586,6 @@ class Writer(Process):
                 self.results_queue.put(WriterTaskResult(True, task))
                 continue
             
-            elif task.flags & TaskFlag.PATCH:
-                if file_handle and task.file_path == current_file:
-                    print("Patching on unclosed file")
-                    file_handle.close()
-                    file_handle = None
-
-                if not task.old_file or not task.patch_file:
-                    # if this ever happens....
-                    self.results_queue.put(WriterTaskResult(False, task))
-                    continue
-
-                try:
-                    dest = task.old_destination or task.destination
-                    source = os.path.join(dest, task.old_file)
-                    source = dl_utils.get_case_insensitive_name(source)
-                    patch = os.path.join(task.destination, task.patch_file)
-                    patch = dl_utils.get_case_insensitive_name(patch)
-                    target = task_path
-                    gogdl_xdelta3.patch(source, patch, target, self.speed_queue)
-
-                except Exception as e:
-                    print("Patch failed", e)
-                    print(traceback.format_exc())
-                    self.results_queue.put(WriterTaskResult(False, task))
-                    continue
-                written = 0
-                if os.path.exists(target):
-                    written = os.path.getsize(target)
-                self.results_queue.put(WriterTaskResult(True, task, written=written))
-                continue
-            
             elif task.flags & TaskFlag.DELETE_FILE:
                 if file_handle and task.file_path == current_file:
                     print("Deleting on unclosed file")
@@ -418,13 +613,33 @@ class Writer(Process):
                 self.results_queue.put(WriterTaskResult(True, task))
                 continue
 
+            if patch_queue and (task.shared_memory or task.old_file):
+                # Anything touching other files is done here, so patchers don't race
+                # with later tasks, patchers only decode
+                try:
+                    if task.shared_memory:
+                        offset = task.shared_memory.offset + task.shared_memory_offset
+                        if task.flags & TaskFlag.OFFLOAD_TO_CACHE and task.hash:
+                            self.offload_to_cache(task, offset, offset + task.size)
+                    elif task.old_file:
+                        dest = task.old_destination or task.destination
+                        with open(dl_utils.get_case_insensitive_name(os.path.join(dest, task.old_file)), "rb") as old_file_handle:
+                            old_file_handle.seek(task.old_offset or 0)
+                            task.data = old_file_handle.read(task.size)
+                except Exception as e:
+                    print("Writer exception", e)
+                    self.results_queue.put(WriterTaskResult(False, task))
+                    continue
+                patch_queue.put(task)
+                continue
+
             try:
                 if task.shared_memory:
                     if not task.size:
                         print("No size")
                         self.results_queue.put(WriterTaskResult(False, task))
                         continue
-                    offset = task.shared_memory.offset
+                    offset = task.shared_memory.offset + task.shared_memory_offset
                     end = offset + task.size
                     left = task.size
                     buffer = BytesIO(self.shared_memory.buf[offset:end].tobytes())
@@ -435,12 +650,38 @@ class Writer(Process):
                         left -= len(chunk)
                         
                     if task.flags & TaskFlag.OFFLOAD_TO_CACHE and task.hash:
-                        cache_file_path = os.path.join(self.cache, task.hash)
-                        dl_utils.prepare_location(self.cache)
-                        cache_file = open(cache_file_path, 'wb')
-                        cache_file.write(self.shared_memory.buf[offset:end].tobytes())
-                        self.speed_queue.put((task.size, 0))
-                        cache_file.close()
+                        self.offload_to_cache(task, offset, end)
+                elif task.old_file and task.flags & TaskFlag.MMAP:
+                    dest = task.old_destination or task.destination
+                    old_file_path = dl_utils.get_case_insensitive_name(os.path.join(dest, task.old_file))
+                    if old_file_path not in mapped_files:
+                        with open(old_file_path, 'rb') as old_file_handle:
+                            mapped_files[old_file_path] = mmap.mmap(old_file_handle.fileno(), 0, access=mmap.ACCESS_READ)
+                    start = task.old_offset or 0
+                    if task.flags & TaskFlag.ZIP_DEC:
+                        decompressor = zlib.decompressobj(-15)
+                    else:
+                        decompressor = None
+                    crc = 0
+                    # Views have to be released before the map can be closed
+                    with memoryview(mapped_files[old_file_path]) as source:
+                        for position in range(start, start + task.size, 1024 * 1024):
+                            with source[position:min(position + 1024 * 1024, start + task.size)] as chunk:
+                                if decompressor:
+                                    chunk_written, crc = write_inflated(decompressor, chunk, file_handle, crc)
+                                else:
+                                    chunk_written = file_handle.write(chunk)
+                                    crc = zlib.crc32(chunk, crc)
+                                written += chunk_written
+                                self.speed_queue.put((chunk_written, len(chunk)))
+                    if decompressor:
+                        remaining = decompressor.flush()
+                        written += file_handle.write(remaining)
+                        crc = zlib.crc32(remaining, crc)
+                        if not decompressor.eof:
+                            raise Exception(f"Truncated entry of {task.old_file} at {start}")
+                    if task.crc32 is not None and crc != task.crc32:
+                        raise Exception(f"Checksum mismatch of entry of {task.old_file} at {start}")
                 elif task.old_file:
                     if not task.size:
                         print("No size")
@@ -476,6 +717,93 @@ class Writer(Process):
                 self.results_queue.put(WriterTaskResult(True, task, written=written))
 
         
+        for mapped_file in mapped_files.values():
+            mapped_file.close()
         self.shared_memory.close()
         shutil.rmtree(self.cache, ignore_errors=True)
 
+    def offload_to_cache(self, task: WriterTask, offset, end):
+        cache_file_path = os.path.join(self.cache, task.hash)
+        dl_utils.prepare_location(self.cache)
+        cache_file = open(cache_file_path, 'wb')
+        cache_file.write(self.shared_memory.buf[offset:end].tobytes())
+        self.speed_queue.put((task.size, 0))
+        cache_file.close()
+
+
+def open_patch(task: WriterTask, speed_queue):
+    """
+    Starts decoding patch written in parts into <file_path>.tmp
+    """
+    dest = task.old_destination or task.destination
+    source = dl_utils.get_case_insensitive_name(os.path.join(dest, task.old_file))
+    target = dl_utils.get_case_insensitive_name(os.path.join(task.destination, task.file_path))
+    # Source is mapped where supported, scattered copies thrash the block cache
+    return gogdl_xdelta3.Decoder(source, target + ".tmp", speed_queue, use_mmap=True)
+
+
+def close_patch(decoder, task: WriterTask):
+    """
+    Finishes the patch and moves the result to file_path
+    """
+    try:
+        target = dl_utils.get_case_insensitive_name(os.path.join(task.destination, task.file_path))
+        decoder.close()
+        os.replace(target + ".tmp", target)
+    except Exception as e:
+        print("Patch failed", e)
+        print(traceback.format_exc())
+        return WriterTaskResult(False, task)
+
+    return WriterTaskResult(True, task, written=os.path.getsize(target))
+
+
+class Patcher(Process):
+    # Decodes patched files in parallel to the writer, each one has its own block cache
+    def __init__(self, shared_memory, patch_queue, results_queue, speed_queue):
+        self.shared_memory = SharedMemory(name=shared_memory)
+        self.patch_queue: Queue = patch_queue
+        self.results_queue: Queue = results_queue
+        self.speed_queue: Queue = speed_queue
+        super().__init__()
+
+    def run(self):
+        decoder = None
+        while True:
+            try:
+                task: Union[WriterTask, TerminateWorker] = self.patch_queue.get(timeout=1)
+            except Empty:
+                continue
+
+            if isinstance(task, TerminateWorker):
+                break
+
+            if task.flags & TaskFlag.OPEN_FILE:
+                try:
+                    decoder = open_patch(task, self.speed_queue)
+                except Exception as e:
+                    print("Patch failed", e)
+                    self.results_queue.put(WriterTaskResult(False, task))
+                    continue
+                self.results_queue.put(WriterTaskResult(True, task))
+
+            elif task.flags & TaskFlag.CLOSE_FILE:
+                self.results_queue.put(close_patch(decoder, task))
+                decoder = None
+
+            else:
+                try:
+                    if task.data is not None:
+                        data = task.data
+                        task.data = None
+                    else:
+                        offset = task.shared_memory.offset + task.shared_memory_offset
+                        data = self.shared_memory.buf[offset:offset + task.size].tobytes()
+                    written = decoder.write(data)
+                except Exception as e:
+                    print("Patch failed", e)
+                    self.results_queue.put(WriterTaskResult(False, task))
+                    continue
+                self.results_queue.put(WriterTaskResult(True, task, written=written))
+
+        self.shared_memory.close()
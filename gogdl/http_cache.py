@@ -0,0 +1,208 @@
+# On-disk cache of GOG API and metadata responses, shared by gogdl processes
+#
+# Each entry is a single file with a JSON header line followed by the raw response body.
+# Entries are written to temporary files and moved into place, so concurrent processes
+# only ever read complete entries and the last writer wins.
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+import requests
+from urllib3 import HTTPResponse
+
+import gogdl.constants as constants
+
+MINUTE = 60
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+READ_SIZE = 256 * 1024
+# Entries not written for that long are removed, checked at most once a day
+MAX_AGE = 30 * DAY
+
+# Signed, expiring and user specific links to files, never cached
+UNCACHED = re.compile(r"https://[^?]*/downlink/")
+# (url pattern, seconds a response is used without revalidation, response depends on the user)
+RULES = (
+    # Builds change with each release, always revalidated with ETag
+    (re.compile(re.escape(constants.GOG_CONTENT_SYSTEM) + r"/products/\d+/os/\w+/builds"), 0, False),
+    (re.compile(re.escape(constants.GOG_CONTENT_SYSTEM) + r"/products/\d+/patches"), HOUR, False),
+    (re.compile(re.escape(constants.GOG_CONTENT_SYSTEM) + r"/(dependencies|redists)/repository"), HOUR, False),
+    (re.compile(re.escape(constants.GOG_CONTENT_SYSTEM) + r"/open_link"), 5 * MINUTE, True),
+    (re.compile(re.escape(constants.GOG_API) + r"/products/\d+(\?|$)"), HOUR, False),
+    (re.compile(re.escape(constants.GOG_EMBED) + r"/user/data/games"), 5 * MINUTE, True),
+    # Metas and manifests are addressed by their hash or build timestamp, they never change
+    (re.compile(r"https://(gog-cdn-fastly|cdn)\.gog\.com/content-system/"
+                r"(v1/manifests/[^?]*\.json$|(v2/meta|v2/patches/meta|v2/dependencies/meta)/)"), MAX_AGE, False),
+)
+
+
+def get_rule(url):
+    if UNCACHED.match(url):
+        return None
+    for pattern, ttl, private in RULES:
+        if pattern.match(url):
+            return ttl, private
+    return None
+
+
+class HttpCache:
+    def __init__(self, path):
+        self.path = path
+        # Without it stored responses are ignored, fresh ones are still stored
+        self.enabled = not os.environ.get("GOGDL_NO_CACHE")
+        self.prune()
+
+    def get_key(self, request, private):
+        key = request.url
+        if private:
+            key += "\0" + request.headers.get("Authorization", "")
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def get_entry_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def open(self, key):
+        """
+        Returns header and body file of the entry or None
+        """
+        try:
+            body = open(self.get_entry_path(key), "rb")
+        except OSError:
+            return None
+        try:
+            return json.loads(body.readline()), body
+        except ValueError:
+            body.close()
+            return None
+
+    def write(self, key, header, chunks):
+        """
+        Writes entry from header and body chunks, returns whether it was stored
+        """
+        path = self.get_entry_path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                f.write(json.dumps(header).encode() + b"\n")
+                for chunk in chunks:
+                    f.write(chunk)
+            os.replace(tmp_path, path)
+        except BaseException as exception:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            # Errors of the response being read are for the caller
+            if isinstance(exception, OSError):
+                return False
+            raise
+        return True
+
+    def prune(self):
+        marker = os.path.join(self.path, "pruned")
+        now = time.time()
+        try:
+            if now - os.path.getmtime(marker) < DAY:
+                return
+        except OSError:
+            pass
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(marker, "w"):
+                pass
+            for directory in os.scandir(self.path):
+                if not directory.is_dir():
+                    continue
+                for entry in os.scandir(directory.path):
+                    if now - entry.stat().st_mtime > MAX_AGE:
+                        os.remove(entry.path)
+        except OSError:
+            pass
+
+
+class CachingAdapter(requests.adapters.HTTPAdapter):
+
+    """Serves GET requests matching RULES from HttpCache, revalidating expired entries with ETag"""
+
+    def __init__(self, cache, **kwargs):
+        super().__init__(**kwargs)
+        self.cache = cache
+
+    def send(self, request, stream=False, **kwargs):
+        rule = get_rule(request.url) if request.method == "GET" else None
+        # Conditional and ranged requests made by the caller are left alone
+        if (not rule or "If-None-Match" in request.headers or "Range" in request.headers
+                or "no-cache" in request.headers.get("Cache-Control", "")):
+            return super().send(request, stream=stream, **kwargs)
+        ttl, private = rule
+        key = self.cache.get_key(request, private)
+
+        entry = self.cache.open(key) if self.cache.enabled else None
+        if entry:
+            header, body = entry
+            if time.time() - header["time"] < ttl:
+                return self.build_cached_response(request, header, body)
+            if header.get("etag"):
+                request.headers["If-None-Match"] = header["etag"]
+            else:
+                body.close()
+                entry = None
+
+        try:
+            response = super().send(request, stream=True, **kwargs)
+        except Exception:
+            if entry:
+                entry[1].close()
+            raise
+
+        if entry:
+            header, body = entry
+            if response.status_code == 304:
+                response.close()
+                header["time"] = time.time()
+                with body:
+                    self.cache.write(key, header, iter(lambda: body.read(READ_SIZE), b""))
+                # Old entry is still there if it couldn't be refreshed
+                entry = self.cache.open(key)
+                if entry:
+                    return self.build_cached_response(request, *entry)
+                return self.send_uncached(request, stream, **kwargs)
+            body.close()
+
+        etag = response.headers.get("ETag")
+        if response.status_code != 200 or not (ttl or etag):
+            return response
+        header = {
+            "time": time.time(),
+            "status": response.status_code,
+            "reason": response.reason,
+            "headers": dict(response.headers),
+            "etag": etag,
+        }
+        with response:
+            stored = self.cache.write(key, header, response.raw.stream(READ_SIZE, decode_content=False))
+        entry = self.cache.open(key) if stored else None
+        if not entry:
+            # Body was consumed, get it again without the cache
+            return self.send_uncached(request, stream, **kwargs)
+        return self.build_cached_response(request, *entry)
+
+    def send_uncached(self, request, stream, **kwargs):
+        request.headers.pop("If-None-Match", None)
+        return super().send(request, stream=stream, **kwargs)
+
+    def build_cached_response(self, request, header, body):
+        raw = HTTPResponse(
+            body=body,
+            headers=header["headers"],
+            status=header["status"],
+            reason=header["reason"],
+            preload_content=False,
+            decode_content=True,
+            request_method=request.method,
+        )
+        return self.build_response(request, raw)
@@ -0,0 +1,122 @@
+import ctypes
+import logging
+import os
+import struct
+from sys import platform
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 64 * 1024
+
+
+def supported() -> bool:
+    return platform == "linux"
+
+
+class Inotify:
+
+    """Minimal inotify wrapper watching directory trees"""
+
+    def __init__(self):
+        self.logger = logging.getLogger("INOTIFY")
+        libc = ctypes.CDLL(None, use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        # wd -> watched directory
+        self.watches = dict()
+
+    def add_watch(self, path, mask):
+        wd = self._add_watch(self.fd, os.fsencode(path), mask | IN_ONLYDIR)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        self.watches[wd] = path
+        return wd
+
+    def add_tree(self, path, mask, visited=None) -> list:
+        """
+        Watches directory and its subdirectories, returns files found in them.
+        Symlinked directories are followed like in saves sync
+        """
+        files = list()
+        if visited is None:
+            visited = set()
+        real_path = os.path.realpath(path)
+        if real_path in visited:
+            # Symlink loop
+            return files
+        visited.add(real_path)
+        try:
+            self.add_watch(path, mask)
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        files.extend(self.add_tree(entry.path, mask, visited))
+                    else:
+                        files.append(entry.path)
+        except (FileNotFoundError, NotADirectoryError):
+            # Removed before we got to it
+            pass
+        except OSError as e:
+            # Out of watches (ENOSPC) or unreadable directory
+            self.logger.warning(f"Not watching {path}: {e.strerror}")
+        return files
+
+    def remove_tree(self, path):
+        prefix = os.path.join(path, "")
+        for wd, watched in list(self.watches.items()):
+            if watched == path or watched.startswith(prefix):
+                self._rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def read_events(self) -> list:
+        """
+        Reads pending events as (path, mask) pairs
+        """
+        events = list()
+        while True:
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+                if mask & IN_Q_OVERFLOW:
+                    events.append((None, mask))
+                    continue
+                directory = self.watches.get(wd)
+                if directory is None:
+                    # Watch removed along with moved directory
+                    continue
+                events.append((os.path.join(directory, os.fsdecode(name)) if name else directory, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
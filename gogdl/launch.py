@@ -7,13 +7,12 @@ import time
 from gogdl.dl.dl_utils import get_case_insensitive_name
 from ctypes import *
 from gogdl.process import Process
+import gogdl.prewarm as prewarm
+import gogdl.constants as constants
 import signal
 import shutil
 import shlex
 
-class NoMoreChildren(Exception):
-    pass
-
 def get_flatpak_command(id: str) -> list[str]:
     if sys.platform != "linux":
         return []
@@ -55,10 +54,119 @@ def get_app_bundle_command(id: str) -> list[str]:
         pass
     return []
 
+RUNNERS = {
+    "scummvm": {
+        "flatpak": "org.scummvm.ScummVM",
+        "bundle": "org.scummvm.app",
+        "native": ["scummvm"],
+    },
+    "dosbox": {
+        "flatpak": "io.github.dosbox-staging",
+        "bundle": "io.github.dosbox-staging",
+        # Most distributions prefer "dosbox" for DOSBox Staging's
+        #  binary and let different DOSBox variants conflict, but
+        #  Homebrew in particular uses "dosbox-staging". As the
+        #  latter is more specific we try that first.
+        "native": ["dosbox-staging", "dosbox"],
+    },
+}
+
+
+def get_mtimes(paths) -> dict:
+    mtimes = dict()
+    for path in paths:
+        try:
+            mtimes[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            mtimes[path] = None
+    return mtimes
+
+
+def get_runner_watched_paths(runner) -> list:
+    """
+    Paths which change when runner gets installed, updated or removed
+    """
+    flatpak_id = RUNNERS[runner]["flatpak"]
+    paths = [
+        os.path.join("/var/lib/flatpak/app", flatpak_id),
+        os.path.join(os.path.expanduser("~/.local/share/flatpak/app"), flatpak_id),
+    ]
+    paths.extend(path for path in os.environ.get("PATH", "").split(os.pathsep) if path)
+    if sys.platform == "darwin":
+        paths.extend(["/Applications", os.path.expanduser("~/Applications")])
+    return paths
+
+
+def probe_runner(runner):
+    from concurrent.futures import ThreadPoolExecutor
+    spec = RUNNERS[runner]
+
+    def get_native_command():
+        for candidate in spec["native"]:
+            native = shutil.which(candidate)
+            if native:
+                return [native]
+        return []
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        flatpak = executor.submit(get_flatpak_command, spec["flatpak"])
+        bundle = executor.submit(get_app_bundle_command, spec["bundle"])
+        native = executor.submit(get_native_command)
+        return flatpak.result() or bundle.result() or native.result()
+
+
+def resolve_runner(runner):
+    """
+    Returns command of native runner, cached in config until any of its watched paths change
+    Runners that weren't found are probed again each time, as they may be installed in a way
+    that doesn't touch watched paths. Nothing is cached inside Flatpak sandbox, host
+    installations can't be seen from it
+    """
+    if os.path.exists("/.flatpak-info"):
+        return probe_runner(runner)
+    watched_paths = get_runner_watched_paths(runner)
+    cache = dict()
+    try:
+        with open(constants.RUNNERS_CACHE_PATH, "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        pass
+
+    entry = cache.get(runner)
+    if entry and entry["command"] and set(watched_paths) <= set(entry["mtimes"]) and get_mtimes(entry["mtimes"]) == entry["mtimes"]:
+        return entry["command"]
+
+    command = probe_runner(runner)
+    if not command:
+        return command
+    if os.path.isabs(command[0]):
+        watched_paths.append(command[0])
+    cache[runner] = {"command": command, "mtimes": get_mtimes(watched_paths)}
+    try:
+        os.makedirs(constants.CONFIG_DIR, exist_ok=True)
+        tmp_path = f"{constants.RUNNERS_CACHE_PATH}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, constants.RUNNERS_CACHE_PATH)
+    except OSError:
+        pass
+    return command
+
+
 # Supports launching linux builds
 def launch(arguments, unknown_args):
     # print(arguments)
+    timings = list()
+    phase_start = time.perf_counter()
+
+    def phase(name):
+        nonlocal phase_start
+        now = time.perf_counter()
+        timings.append(f"{name} {(now - phase_start) * 1000:.1f}ms")
+        phase_start = now
+
     info = load_game_info(arguments.path, arguments.id, arguments.platform)
+    phase("load_info")
 
     wrapper = []
     if arguments.wrapper:
@@ -109,13 +217,8 @@ def launch(arguments, unknown_args):
         
         if sys.platform != "win32" and arguments.platform == 'windows' and not arguments.override_exe:
             if "scummvm.exe" in executable.lower():
-                flatpak_scummvm = get_flatpak_command("org.scummvm.ScummVM")
-                bundle_scummvm = get_app_bundle_command("org.scummvm.app")
-                native_scummvm = shutil.which("scummvm")
-                if native_scummvm:
-                    native_scummvm = [native_scummvm]
-            
-                native_runner = flatpak_scummvm or bundle_scummvm or native_scummvm
+                native_runner = resolve_runner("scummvm")
+                phase("resolve_runner")
                 if native_runner:
                     wrapper = native_runner
                     executable = None
@@ -136,18 +239,8 @@ def launch(arguments, unknown_args):
                         with open(full_config_file, 'w') as f:
                             config.write(f)
             elif "dosbox.exe" in executable.lower():
-                flatpak_dosbox = get_flatpak_command("io.github.dosbox-staging")
-                bundle_dosbox = get_app_bundle_command("io.github.dosbox-staging")
-                for candidate in ["dosbox-staging", "dosbox"]:
-                    # Most distributions prefer "dosbox" for DOSBox Staging's
-                    #  binary and let different DOSBox variants conflict, but
-                    #  Homebrew in particular uses "dosbox-staging". As the
-                    #  latter is more specific we try that first.
-                    native_dosbox= shutil.which(candidate)
-                    if native_dosbox:
-                        native_dosbox = [native_dosbox]
-                        break
-                native_runner = flatpak_dosbox or bundle_dosbox or native_dosbox
+                native_runner = resolve_runner("dosbox")
+                phase("resolve_runner")
                 if native_runner:
                     wrapper = native_runner
                     executable = None
@@ -198,8 +291,20 @@ def launch(arguments, unknown_args):
                 pass
             environment.update({"LD_LIBRARY_PATH": ":".join(splitted)})
     
+    phase("prepare")
     print("Launch command:", command)
 
+    if arguments.prewarm:
+        if arguments.override_exe:
+            prewarm_executable = arguments.override_exe
+        elif type(info) != str:
+            prewarm_executable = executable
+        else:
+            prewarm_executable = info
+        prewarm.start(prewarm_executable, arguments.path, arguments.prewarm_budget * prewarm.MIB,
+                      arguments.prewarm_assets, arguments.prewarm_order)
+        phase("prewarm")
+
     status = None
     if sys.platform == 'linux':
         libc = cdll.LoadLibrary("libc.so.6")
@@ -211,14 +316,8 @@ def launch(arguments, unknown_args):
         
         process = subprocess.Popen(command, env=environment)
         process_pid = process.pid
-
-        def iterate_processes():
-            for child in Process(os.getpid()).iter_children():
-                if child.state == 'Z':
-                    continue
-
-                if child.name:
-                    yield child
+        phase("spawn")
+        print("Launch timings:", ", ".join(timings))
 
         def hard_sig_handler(signum, _frame):
             for _ in range(3):  # just in case we race a new process.
@@ -239,49 +338,40 @@ def launch(arguments, unknown_args):
                     except ProcessLookupError:
                         pass
 
-        def is_alive():
-            return next(iterate_processes(), None) is not None
-
         signal.signal(signal.SIGTERM, sig_handler)
         signal.signal(signal.SIGINT, sig_handler)
 
-        def reap_children():
-            nonlocal status
-            while True:
-                try:
-                    child_pid, child_returncode, _resource_usage = os.wait3(os.WNOHANG)
-                except ChildProcessError:
-                    raise NoMoreChildren from None  # No processes remain.
-                if child_pid == process_pid:
-                    status = child_returncode
-
-                if child_pid == 0:
-                    break
-
-        try:
-            # The initial wait loop:
-            #  the initial process may have been excluded. Wait for the game
-            #  to be considered "started".
-            if not is_alive():
-                while not is_alive():
-                    reap_children()
-                    time.sleep(0.1)
-            while is_alive():
-                reap_children()
-                time.sleep(0.1)
-            reap_children()
-        except NoMoreChildren:
-            print("All processes exited")
+        status = wait_for_children(process_pid)
+        print("All processes exited")
 
 
     else:
         process = subprocess.Popen(command, env=environment, 
                                    shell=sys.platform=="win32")
+        phase("spawn")
+        print("Launch timings:", ", ".join(timings))
         status = process.wait()
 
     sys.exit(status)
 
 
+def wait_for_children(process_pid):
+    """
+    Reaps children until none are left, returns wait status of process_pid
+    As a subreaper we get orphaned descendants reparented to us,
+    so there are no more descendants once wait reports no children.
+    Waiting blocks in the kernel until SIGCHLD, signal handlers still run.
+    """
+    status = None
+    while True:
+        try:
+            child_pid, child_status = os.waitpid(-1, 0)
+        except ChildProcessError:
+            return status
+        if child_pid == process_pid:
+            status = child_status
+
+
 def get_preferred_task(info, index):
     primaryTask = None
     for task in info["playTasks"]:
@@ -0,0 +1,108 @@
+import os
+import threading
+import time
+
+LIBRARY_EXTENSIONS = (".dll", ".so", ".dylib")
+MIB = 1024 * 1024
+
+
+def supported() -> bool:
+    return hasattr(os, "posix_fadvise")
+
+
+def is_library(name: str) -> bool:
+    name = name.lower()
+    return name.endswith(LIBRARY_EXTENSIONS) or ".so." in name
+
+
+def list_files(path: str) -> list:
+    files = list()
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        files.extend(list_files(entry.path))
+                    elif entry.is_file():
+                        files.append((entry.path, entry.stat()))
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    return files
+
+
+def get_files(executable, game_path, assets, order="size") -> list:
+    """
+    Returns (path, size) of files worth having in page cache, most important first:
+    the executable, libraries next to it, then largest or most recently used files
+    """
+    files = list()
+    seen = set()
+
+    def add(path, size):
+        if path not in seen:
+            seen.add(path)
+            files.append((path, size))
+
+    if executable and os.path.isfile(executable):
+        add(executable, os.path.getsize(executable))
+        try:
+            with os.scandir(os.path.dirname(executable)) as entries:
+                libraries = [(entry.path, entry.stat().st_size) for entry in entries
+                             if is_library(entry.name) and entry.is_file()]
+        except OSError:
+            libraries = []
+        for path, size in sorted(libraries):
+            add(path, size)
+
+    game_files = list_files(game_path)
+    if order == "recent":
+        game_files.sort(key=lambda f: f[1].st_atime, reverse=True)
+    else:
+        game_files.sort(key=lambda f: f[1].st_size, reverse=True)
+    for path, stat in game_files[:assets]:
+        add(path, stat.st_size)
+    return files
+
+
+def prewarm(files, budget):
+    """
+    Asks the kernel to read files ahead, up to budget bytes in total
+    Returns number of files and bytes advised
+    """
+    advised = 0
+    count = 0
+    for path, size in files:
+        if advised >= budget:
+            break
+        length = min(size, budget - advised)
+        try:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, length, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+        except OSError:
+            continue
+        advised += length
+        count += 1
+    return count, advised
+
+
+def start(executable, game_path, budget, assets, order="size"):
+    """
+    Prewarms page cache in background thread, so it overlaps with wrapper startup
+    """
+    if not supported():
+        print("Prewarming is not supported on this platform")
+        return None
+
+    def run():
+        start_time = time.time()
+        count, advised = prewarm(get_files(executable, game_path, assets, order), budget)
+        print(f"Prewarmed {count} files, {advised / MIB:.1f} MiB in {time.time() - start_time:.2f}s")
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
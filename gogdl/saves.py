@@ -1,18 +1,115 @@
 import os
 import sys
+import select
+import signal
+import stat as stat_module
 import logging
 import requests
 import urllib.parse
 import hashlib
 import datetime
 import gzip
+import json
+import struct
+import tempfile
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 
 import gogdl.dl.dl_utils as dl_utils
 import gogdl.constants as constants
+import gogdl.inotify as inotify
 
 LOCAL_TIMEZONE = datetime.datetime.utcnow().astimezone().tzinfo
 
+# Files synced at once
+SYNC_WORKERS = 8
+# Compressed saves bigger than that are spooled to disk before upload
+SPOOL_SIZE = 8 * 1024 * 1024
+READ_SIZE = 1024 * 1024
+# Header written by gzip.compress(data, 6, mtime=0), it differs between Python versions
+GZIP_HEADER = gzip.compress(b"", 6, mtime=0)[:10]
+# Files modified that recently aren't indexed, another write
+# within the timestamp granularity wouldn't change their stat
+RACY_WINDOW = 2 * 10**9
+# Changes in watch mode are uploaded at most that many seconds after the first one
+WATCH_MAX_DELAY = 60
+WATCH_MASK = (inotify.IN_CLOSE_WRITE | inotify.IN_CREATE | inotify.IN_DELETE
+              | inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO)
+
+
+def gzip_file(path, output=None):
+    """
+    Compresses file in blocks, with the same result as gzip.compress(data, 6, mtime=0)
+    Compressed data is written to output if provided, returns its md5
+    """
+    md5 = hashlib.md5()
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    crc = 0
+    size = 0
+
+    def emit(data):
+        md5.update(data)
+        if output:
+            output.write(data)
+
+    emit(GZIP_HEADER)
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(READ_SIZE)
+            if not block:
+                break
+            crc = zlib.crc32(block, crc)
+            size += len(block)
+            emit(compressor.compress(block))
+    emit(compressor.flush())
+    emit(struct.pack("<LL", crc, size & 0xffffffff))
+    return md5.hexdigest()
+
+
+class HashIndex:
+    """
+    Persisted md5 of compressed save files, valid as long as
+    size, mtime and inode of the file stay the same
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = dict()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = dict()
+
+    def get(self, relative_path, stat):
+        entry = self.entries.get(relative_path)
+        if entry and entry[:3] == [stat.st_size, stat.st_mtime_ns, stat.st_ino]:
+            return entry[3]
+        return None
+
+    def set(self, relative_path, stat, md5):
+        if stat.st_mtime_ns > time.time_ns() - RACY_WINDOW:
+            self.entries.pop(relative_path, None)
+            return
+        self.entries[relative_path] = [stat.st_size, stat.st_mtime_ns, stat.st_ino, md5]
+
+    def save(self, relative_paths=None):
+        # Drop files that no longer exist
+        if relative_paths is not None:
+            self.entries = {path: self.entries[path] for path in relative_paths if path in self.entries}
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            pass
+
 
 class SyncAction(Enum):
     DOWNLOAD = 0
@@ -22,9 +119,10 @@ class SyncAction(Enum):
 
 
 class SyncFile:
-    def __init__(self, path, abs_path, md5=None, update_time=None):
+    def __init__(self, path, abs_path, md5=None, update_time=None, stat=None):
         self.relative_path = path.replace('\\', '/')  # cloud file identifier
         self.absolute_path = abs_path
+        self.stat = stat
         self.md5 = md5
         self.update_time = update_time
         self.update_ts = (
@@ -33,14 +131,17 @@ class SyncFile:
             else None
         )
 
-    def get_file_metadata(self):
-        ts = os.stat(self.absolute_path).st_mtime
+    def get_file_metadata(self, index=None):
+        if not self.stat:
+            self.stat = os.stat(self.absolute_path)
         date_time_obj = datetime.datetime.fromtimestamp(
-            ts, tz=LOCAL_TIMEZONE
+            self.stat.st_mtime, tz=LOCAL_TIMEZONE
         ).astimezone(datetime.timezone.utc)
-        self.md5 = hashlib.md5(
-            gzip.compress(open(self.absolute_path, "rb").read(), 6, mtime=0)
-        ).hexdigest()
+        self.md5 = index.get(self.relative_path, self.stat) if index else None
+        if not self.md5:
+            self.md5 = gzip_file(self.absolute_path)
+            if index:
+                index.set(self.relative_path, self.stat, self.md5)
 
         self.update_time = date_time_obj.isoformat(timespec="seconds")
         self.update_ts = date_time_obj.timestamp()
@@ -55,6 +156,8 @@ class CloudStorageManager:
         self.auth_manager = authorization_manager
         self.session = requests.Session()
         self.logger = logging.getLogger("SAVES")
+        self.workers = SYNC_WORKERS
+        self.adapter = None
 
         self.session.headers.update(
             {"User-Agent": "GOGGalaxyCommunicationService/2.0.13.27 (Windows_32bit) dont_sync_marker/true installation_source/gog",
@@ -68,18 +171,56 @@ class CloudStorageManager:
     def create_directory_map(self, path: str) -> list:
         """
         Creates list of every file in directory to be synced
+        as (path, stat) pairs
         """
         files = list()
-        directory_contents = os.listdir(path)
-
-        for content in directory_contents:
-            abs_path = os.path.join(path, content)
-            if os.path.isdir(abs_path):
-                files.extend(self.create_directory_map(abs_path))
-            else:
-                files.append(abs_path)
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    files.extend(self.create_directory_map(entry.path))
+                else:
+                    files.append((entry.path, entry.stat()))
         return files
 
+    def get_index_path(self):
+        key = hashlib.md5(f"{self.cloud_save_dir_name}:{self.sync_path}".encode()).hexdigest()
+        return os.path.join(constants.SAVES_INDEX_DIR, f"{self.arguments.id}_{key}.json")
+
+    def get_local_files(self):
+        """
+        Lists files in sync path with their metadata,
+        md5 of files unchanged since last sync is taken from the index
+        """
+        local_files = [
+            SyncFile(self.get_relative_path(self.sync_path, f), f, stat=stat)
+            for f, stat in self.create_directory_map(self.sync_path)
+        ]
+        index = HashIndex(self.get_index_path())
+        self.run_parallel(lambda f: f.get_file_metadata(index), local_files)
+        index.save([f.relative_path for f in local_files])
+        return local_files
+
+    def set_workers(self, count):
+        if self.adapter and self.workers == max(1, count):
+            # Keep open connections
+            return
+        self.workers = max(1, count)
+        # Connection per sync worker
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.adapter = adapter
+
+    def run_parallel(self, function, files):
+        """
+        Runs function for each file with bounded number of threads
+        """
+        if not files:
+            return
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(files))) as executor:
+            # Consume results, so exceptions aren't swallowed
+            list(executor.map(function, files))
+
     @staticmethod
     def get_relative_path(root: str, path: str) -> str:
         if not root.endswith("/") and not root.endswith("\\"):
@@ -87,28 +228,25 @@ class CloudStorageManager:
         return path.replace(root, "")
 
     def sync(self, arguments, unknown_args):
+        """
+        Syncs saves, returns action that was taken or None when it was refused
+        """
         prefered_action = arguments.prefered_action
         self.sync_path = os.path.normpath(arguments.path.strip('"'))
         self.sync_path = self.sync_path.replace("\\", os.sep)
         self.cloud_save_dir_name = arguments.dirname
         self.arguments = arguments
         self.unknown_args = unknown_args
+        self.set_workers(arguments.workers_count)
 
         if not os.path.exists(self.sync_path):
             self.logger.warning("Provided path doesn't exist, creating")
             os.makedirs(self.sync_path, exist_ok=True)
-        dir_list = self.create_directory_map(self.sync_path)
-        if len(dir_list) == 0:
+        local_files = self.get_local_files()
+        if len(local_files) == 0:
             self.logger.info("No files in directory")
 
-        local_files = [
-            SyncFile(self.get_relative_path(self.sync_path, f), f) for f in dir_list
-        ]
-
-        for f in local_files:
-            f.get_file_metadata()
-
-        self.logger.info(f"Local files: {len(dir_list)}")
+        self.logger.info(f"Local files: {len(local_files)}")
         self.client_id, self.client_secret = self.get_auth_ids()
         self.get_auth_token()
 
@@ -118,21 +256,19 @@ class CloudStorageManager:
         if len(local_files) > 0 and len(cloud_files) == 0:
             action = SyncAction.UPLOAD
             self.logger.info("No files in cloud, uploading")
-            for f in local_files:
-                self.upload_file(f)
+            self.run_parallel(self.upload_file, local_files)
             self.logger.info("Done")
             sys.stdout.write(str(datetime.datetime.now().timestamp()))
             sys.stdout.flush()
-            return
+            return action
         elif len(local_files) == 0 and len(cloud_files) > 0:
             self.logger.info("No files locally, downloading")
             action = SyncAction.DOWNLOAD
-            for f in downloadable_cloud:
-                self.download_file(f)
+            self.run_parallel(self.download_file, downloadable_cloud)
             self.logger.info("Done")
             sys.stdout.write(str(datetime.datetime.now().timestamp()))
             sys.stdout.flush()
-            return
+            return action
 
         timestamp = float(arguments.timestamp)
         classifier = SyncClassifier.classify(local_files, cloud_files, timestamp)
@@ -151,23 +287,21 @@ class CloudStorageManager:
             if prefered_action == "upload" and action == SyncAction.DOWNLOAD:
                 self.logger.warning("Refused to upload files, newer files in the cloud")
                 print(self.arguments.timestamp)
-                return
+                return None
             elif prefered_action == "download" and action == SyncAction.UPLOAD:
                 self.logger.warning("Refused to download files, newer files locally")
                 print(self.arguments.timestamp)
-                return
+                return None
 
         if action == SyncAction.UPLOAD:
             self.logger.info("Uploading files")
-            for f in classifier.updated_local:
-                self.upload_file(f)
+            self.run_parallel(self.upload_file, classifier.updated_local)
             for f in classifier.not_existing_locally:
                 self.logger.info(f"DELETING IN CLOUD {f}")
-                self.delete_file(f)
+            self.run_parallel(self.delete_file, classifier.not_existing_locally)
         elif action == SyncAction.DOWNLOAD:
             self.logger.info("Downloading files")
-            for f in classifier.updated_cloud:
-                self.download_file(f)
+            self.run_parallel(self.download_file, classifier.updated_cloud)
             for f in classifier.not_existing_remotely:
                 self.logger.info(f"DELETING LOCALLY {f.absolute_path}")
                 os.remove(f.absolute_path)
@@ -182,6 +316,140 @@ class CloudStorageManager:
         sys.stdout.write(str(datetime.datetime.now().timestamp()))
         sys.stdout.flush()
         self.logger.info("Done")
+        return action
+
+    def watch(self, arguments, unknown_args):
+        """
+        Syncs saves, then uploads files as they change until a signal is received
+        """
+        if not inotify.supported():
+            self.logger.error("Watching saves is only supported on Linux, syncing once")
+            self.sync(arguments, unknown_args)
+            return
+
+        received = list()
+        wakeup_read, wakeup_write = os.pipe()
+        os.set_blocking(wakeup_write, False)
+        previous_wakeup = signal.set_wakeup_fd(wakeup_write)
+        handlers = {
+            sig: signal.signal(sig, lambda signum, frame: received.append(signum))
+            for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP)
+        }
+
+        watcher = None
+        try:
+            action = self.sync(arguments, unknown_args)
+            if action not in (SyncAction.UPLOAD, SyncAction.DOWNLOAD, SyncAction.NONE):
+                # Changes would be uploaded over newer or conflicting cloud saves
+                self.logger.error("Saves weren't synced, not watching for changes")
+                return
+            # Files written by the initial sync shouldn't be seen as changes,
+            # so watching starts after it
+            watcher = inotify.Inotify()
+            watcher.add_tree(self.sync_path, WATCH_MASK)
+            if not watcher.watches:
+                self.logger.error("Unable to watch saves directory, synced once")
+                return
+            # Last known cloud hashes, changes that don't alter them aren't uploaded
+            known = {f.relative_path: f.md5 for f in self.get_cloud_files_list()}
+            index = HashIndex(self.get_index_path())
+            self.logger.info(f"Watching {self.sync_path} for changes")
+
+            poller = select.poll()
+            poller.register(watcher.fd, select.POLLIN)
+            poller.register(wakeup_read, select.POLLIN)
+            pending = set()
+            first_change = last_change = None
+            while not received:
+                timeout = None
+                if pending:
+                    deadline = min(last_change + arguments.debounce, first_change + WATCH_MAX_DELAY)
+                    timeout = max(0, int((deadline - time.monotonic()) * 1000))
+                for fd, _ in poller.poll(timeout):
+                    if fd == wakeup_read:
+                        os.read(wakeup_read, 64)
+                    elif self.collect_changes(watcher, pending, known):
+                        last_change = time.monotonic()
+                        first_change = first_change or last_change
+
+                if not pending:
+                    first_change = None
+                elif not received and time.monotonic() >= min(last_change + arguments.debounce,
+                                                              first_change + WATCH_MAX_DELAY):
+                    self.flush_changes(pending, known, index)
+                    pending = set()
+                    first_change = None
+
+            self.logger.info("Stopping, uploading remaining changes")
+            self.collect_changes(watcher, pending, known)
+            if pending:
+                self.flush_changes(pending, known, index)
+        finally:
+            signal.set_wakeup_fd(previous_wakeup)
+            for sig, handler in handlers.items():
+                signal.signal(sig, handler)
+            os.close(wakeup_read)
+            os.close(wakeup_write)
+            if watcher:
+                watcher.close()
+
+    def collect_changes(self, watcher, pending, known) -> bool:
+        """
+        Adds paths changed since last call to pending, returns whether there were any
+        """
+        events = watcher.read_events()
+        for path, mask in events:
+            if mask & inotify.IN_Q_OVERFLOW:
+                self.logger.warning("Missed file events, rescanning")
+                pending.update(f for f, _ in self.create_directory_map(self.sync_path))
+                pending.update(os.path.join(self.sync_path, f) for f in known)
+            elif mask & inotify.IN_ISDIR:
+                if mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+                    pending.update(watcher.add_tree(path, WATCH_MASK))
+                elif mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+                    watcher.remove_tree(path)
+                    directory = self.get_relative_path(self.sync_path, path).replace('\\', '/') + "/"
+                    pending.update(os.path.join(self.sync_path, f) for f in known if f.startswith(directory))
+            else:
+                pending.add(path)
+        return len(events) > 0
+
+    def flush_changes(self, paths, known, index):
+        """
+        Uploads changed files and deletes removed ones in the cloud
+        """
+        changed = list()
+        deleted = list()
+        for path in paths:
+            relative_path = self.get_relative_path(self.sync_path, path)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                if relative_path.replace('\\', '/') in known:
+                    deleted.append(SyncFile(relative_path, path))
+                continue
+            if stat_module.S_ISREG(stat.st_mode):
+                changed.append(SyncFile(relative_path, path, stat=stat))
+
+        self.run_parallel(lambda f: f.get_file_metadata(index), changed)
+        changed = [f for f in changed if known.get(f.relative_path) != f.md5]
+        if not changed and not deleted:
+            return
+
+        # Token may have expired during the session
+        self.get_auth_token()
+        for f in changed:
+            self.logger.info(f"Uploading {f.relative_path}")
+        self.run_parallel(self.upload_file, changed)
+        self.run_parallel(self.delete_file, deleted)
+        for f in changed:
+            known[f.relative_path] = f.md5
+        for f in deleted:
+            known.pop(f.relative_path, None)
+        index.save()
+
+        sys.stdout.write("\n" + str(datetime.datetime.now().timestamp()))
+        sys.stdout.flush()
 
     def clear(self, arguments, unknown_args):
         self.sync_path = os.path.normpath(arguments.path.strip('"'))
@@ -189,13 +457,13 @@ class CloudStorageManager:
         self.cloud_save_dir_name = arguments.dirname
         self.arguments = arguments
         self.unknown_args = unknown_args
+        self.set_workers(arguments.workers_count)
 
         self.client_id, self.client_secret = self.get_auth_ids()
         self.get_auth_token()
 
         cloud_files = self.get_cloud_files_list()
-        for f in cloud_files:
-            self.delete_file(f)
+        self.run_parallel(self.delete_file, cloud_files)
         self.logger.info("Done")
 
     def get_auth_token(self):
@@ -259,21 +527,23 @@ class CloudStorageManager:
         self.logger.debug(f"Delete response: {response}")
 
     def upload_file(self, file: SyncFile):
-        compressed_data = gzip.compress(
-            open(file.absolute_path, "rb").read(), 6, mtime=0
-        )
-        headers = {
-            "X-Object-Meta-LocalLastModified": f"{file.update_time}",
-            "Etag": hashlib.md5(compressed_data).hexdigest(),
-            "Content-Encoding": "gzip",
-        }
+        # Etag has to be known before sending, so data is compressed and hashed
+        # in one pass into a buffer that moves to disk once it gets big
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as compressed_data:
+            md5 = gzip_file(file.absolute_path, compressed_data)
+            compressed_data.seek(0)
+            headers = {
+                "X-Object-Meta-LocalLastModified": f"{file.update_time}",
+                "Etag": md5,
+                "Content-Encoding": "gzip",
+            }
 
-        fpath = urllib.parse.quote(file.relative_path)
-        response = self.session.put(
-            f"{constants.GOG_CLOUDSTORAGE}/v1/{self.credentials['user_id']}/{self.client_id}/{self.cloud_save_dir_name}/{fpath}",
-            data=compressed_data,
-            headers=headers,
-        )
+            fpath = urllib.parse.quote(file.relative_path)
+            response = self.session.put(
+                f"{constants.GOG_CLOUDSTORAGE}/v1/{self.credentials['user_id']}/{self.client_id}/{self.cloud_save_dir_name}/{fpath}",
+                data=compressed_data,
+                headers=headers,
+            )
 
         if not response.ok:
             self.logger.error(
@@ -360,20 +630,27 @@ class SyncClassifier:
     def classify(cls, local, cloud, timestamp):
         classifier = cls()
 
-        local_paths = [f.relative_path for f in local]
-        cloud_paths = [f.relative_path for f in cloud]
+        local_files = {f.relative_path: f for f in local}
+        cloud_files = {f.relative_path: f for f in cloud}
 
         for f in local:
-            if f.relative_path not in cloud_paths:
+            cloud_file = cloud_files.get(f.relative_path)
+            if not cloud_file:
                 classifier.not_existing_remotely.append(f)
+            elif cloud_file.md5 == f.md5:
+                # Same content, timestamps don't matter
+                continue
             if f.update_ts > timestamp:
                 classifier.updated_local.append(f)
 
         for f in cloud:
             if f.md5 == "aadd86936a80ee8a369579c3926f1b3c":
                 continue
-            if f.relative_path not in local_paths:
+            local_file = local_files.get(f.relative_path)
+            if not local_file:
                 classifier.not_existing_locally.append(f)
+            elif local_file.md5 == f.md5:
+                continue
             if f.update_ts > timestamp:
                 classifier.updated_cloud.append(f)
 
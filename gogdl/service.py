@@ -0,0 +1,375 @@
+# Long running gogdl, commands are sent as newline delimited JSON-RPC 2.0 over a Unix socket
+#
+# -> {"jsonrpc": "2.0", "id": 1, "method": "run", "params": {"argv": ["info", "1207658924"], "cwd": "/", "env": {...}}}
+# <- {"jsonrpc": "2.0", "method": "output", "params": {"id": 1, "stream": "stdout", "data": "...\n"}}
+# <- {"jsonrpc": "2.0", "id": 1, "result": {"exit_code": 0}}
+# -> {"jsonrpc": "2.0", "method": "cancel", "params": {"id": 1}}
+#
+# "ping" and "shutdown" methods are also available.
+# Short commands run in the service itself, reusing sessions and cached data, when the caller's
+# working directory and environment match the service's. Others run in a child process with
+# the caller's environment and working directory.
+# "cancel" terminates commands running in a child process, commands run in the service are
+# short and always run to completion.
+import io
+import json
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import gogdl.constants as constants
+
+# Short commands run in the service, others run in their own process, so they can be
+# cancelled and don't block the short ones
+IN_PROCESS_COMMANDS = ("auth", "info", "lang-match", "check-updates", "import")
+# Commands never forwarded to the service, they need the caller's process
+LOCAL_COMMANDS = ("serve", "launch")
+
+# Variables changing where gogdl keeps its data or how it connects, commands
+# run in the service only if they have the same values as in the caller's environment
+ENVIRONMENT_PREFIXES = ("GOGDL_", "XDG_", "HEROIC_")
+ENVIRONMENT_VARIABLES = ("HOME", "APPDATA", "REQUESTS_CA_BUNDLE", "CURL_CA_BUNDLE", "SSL_CERT_FILE", "SSL_CERT_DIR")
+
+PARSE_ERROR = -32700
+METHOD_NOT_FOUND = -32601
+
+
+def supported() -> bool:
+    return hasattr(socket, "AF_UNIX")
+
+
+def get_socket_path(path=None) -> str:
+    """
+    Returns socket path from argument, GOGDL_SOCKET or the default one
+    Empty GOGDL_SOCKET turns the client off
+    """
+    if path:
+        return path
+    return os.environ.get("GOGDL_SOCKET", constants.SERVICE_SOCKET_PATH)
+
+
+def get_exit_code(exception: SystemExit) -> int:
+    if exception.code is None:
+        return 0
+    if isinstance(exception.code, int):
+        return exception.code
+    print(exception.code, file=sys.stderr)
+    return 1
+
+
+def get_relevant_environment(environment) -> dict:
+    return {
+        key: value for key, value in environment.items()
+        if key != "GOGDL_SOCKET" and (
+            key.startswith(ENVIRONMENT_PREFIXES)
+            or key in ENVIRONMENT_VARIABLES
+            or key.lower().endswith("_proxy")
+        )
+    }
+
+
+def get_self_command() -> list:
+    if getattr(sys, "frozen", False):
+        return [sys.executable]
+    if os.path.basename(sys.argv[0]) in ("cli.py", "__main__.py") and os.path.basename(os.path.dirname(sys.argv[0])) == "gogdl":
+        return [sys.executable, "-m", "gogdl.cli"]
+    return [sys.executable, sys.argv[0]]
+
+
+class Connection:
+    def __init__(self, sock):
+        self.socket = sock
+        self.lock = threading.Lock()
+        # request id -> process running it
+        self.processes = dict()
+
+    def send(self, message):
+        message["jsonrpc"] = "2.0"
+        data = (json.dumps(message) + "\n").encode()
+        with self.lock:
+            self.socket.sendall(data)
+
+    def notify_output(self, request_id, stream, data):
+        self.send({"method": "output", "params": {"id": request_id, "stream": stream, "data": data}})
+
+
+class OutputChannel(io.TextIOBase):
+
+    """Line buffered text stream sending output notifications"""
+
+    def __init__(self, connection, request_id, stream):
+        self.connection = connection
+        self.request_id = request_id
+        self.stream = stream
+        self.buffer = ""
+
+    def write(self, data):
+        self.buffer += data
+        end = self.buffer.rfind("\n") + 1
+        if end:
+            self.emit(self.buffer[:end])
+            self.buffer = self.buffer[end:]
+        return len(data)
+
+    def flush(self):
+        if self.buffer:
+            self.emit(self.buffer)
+            self.buffer = ""
+
+    def emit(self, data):
+        try:
+            self.connection.notify_output(self.request_id, self.stream, data)
+        except OSError:
+            # Client went away, keep running the command
+            pass
+
+
+class StreamProxy(io.TextIOBase):
+
+    """Sends writes to the output of command being run, or to the original stream"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.target = None
+
+    def write(self, data):
+        return (self.target or self.stream).write(data)
+
+    def flush(self):
+        (self.target or self.stream).flush()
+
+
+class Service:
+    def __init__(self, socket_path, workers):
+        self.socket_path = get_socket_path(socket_path) or constants.SERVICE_SOCKET_PATH
+        self.pool = ThreadPoolExecutor(max_workers=max(1, workers))
+        self.logger = logging.getLogger("SERVICE")
+        # Commands run in this process share stdout, stderr and logging, so they run one at a time
+        self.command_lock = threading.Lock()
+        self.stdout = StreamProxy(sys.stdout)
+        self.stderr = StreamProxy(sys.stderr)
+        self.self_command = get_self_command()
+        self.environment = get_relevant_environment(os.environ)
+        self.server = None
+
+    def serve(self):
+        if not supported():
+            self.logger.error("Unix sockets are not supported on this platform")
+            return
+        if os.path.exists(self.socket_path):
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                    probe.connect(self.socket_path)
+                self.logger.error(f"Service already running on {self.socket_path}")
+                return
+            except OSError:
+                os.remove(self.socket_path)
+
+        sys.stdout, sys.stderr = self.stdout, self.stderr
+        for handler in logging.getLogger().handlers:
+            if isinstance(handler, logging.StreamHandler) and handler.stream is self.stderr.stream:
+                handler.setStream(self.stderr)
+
+        os.makedirs(os.path.dirname(self.socket_path), exist_ok=True)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        self.server.listen()
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        self.logger.info(f"Listening on {self.socket_path}")
+
+        try:
+            while True:
+                try:
+                    sock, _ = self.server.accept()
+                except OSError:
+                    # Socket closed by stop()
+                    break
+                threading.Thread(target=self.handle_connection, args=(Connection(sock),), daemon=True).start()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            sys.stdout, sys.stderr = self.stdout.stream, self.stderr.stream
+
+    def stop(self):
+        if self.server:
+            self.server.close()
+            self.server = None
+            try:
+                os.remove(self.socket_path)
+            except OSError:
+                pass
+
+    def handle_connection(self, connection):
+        try:
+            with connection.socket, connection.socket.makefile("r", encoding="utf-8") as reader:
+                for line in reader:
+                    self.handle_message(connection, line)
+        except OSError:
+            pass
+        finally:
+            # Nobody is waiting for results anymore
+            for process in list(connection.processes.values()):
+                process.terminate()
+
+    def handle_message(self, connection, line):
+        try:
+            message = json.loads(line)
+            method = message.get("method")
+            params = message.get("params") or dict()
+            request_id = message.get("id")
+        except (ValueError, AttributeError):
+            connection.send({"id": None, "error": {"code": PARSE_ERROR, "message": "Parse error"}})
+            return
+
+        if method == "run":
+            self.pool.submit(self.run, connection, request_id, params)
+        elif method == "cancel":
+            process = connection.processes.get(params.get("id"))
+            if process:
+                process.terminate()
+        elif method == "ping":
+            connection.send({"id": request_id, "result": "pong"})
+        elif method == "shutdown":
+            connection.send({"id": request_id, "result": None})
+            self.stop()
+        elif request_id is not None:
+            connection.send({"id": request_id, "error": {"code": METHOD_NOT_FOUND, "message": "Method not found"}})
+
+    def run(self, connection, request_id, params):
+        argv = [str(arg) for arg in params.get("argv", [])]
+        cwd = params.get("cwd") or os.getcwd()
+        environment = params.get("env") or dict(os.environ)
+        try:
+            if (cwd == os.getcwd() and get_relevant_environment(environment) == self.environment
+                    and self.can_run_in_process(argv)):
+                exit_code = self.run_in_process(connection, request_id, argv)
+            else:
+                exit_code = self.run_in_subprocess(connection, request_id, argv, cwd, environment)
+            connection.send({"id": request_id, "result": {"exit_code": exit_code}})
+        except OSError:
+            pass
+        except Exception:
+            self.logger.error(f"Request {request_id} failed\n{traceback.format_exc()}")
+
+    def can_run_in_process(self, argv) -> bool:
+        import gogdl.args as args
+        with self.command_lock:
+            # Parse errors are reported when the command is run
+            self.stdout.target = self.stderr.target = io.StringIO()
+            try:
+                arguments, _ = args.init_parser(argv)
+            except SystemExit:
+                return True
+            finally:
+                self.stdout.target = self.stderr.target = None
+        return arguments.command in IN_PROCESS_COMMANDS
+
+    def run_in_process(self, connection, request_id, argv) -> int:
+        import gogdl.args as args
+        import gogdl.cli as cli
+        with self.command_lock:
+            self.stdout.target = OutputChannel(connection, request_id, "stdout")
+            self.stderr.target = OutputChannel(connection, request_id, "stderr")
+            try:
+                arguments, unknown_args = args.init_parser(argv)
+                cli.run(arguments, unknown_args)
+                exit_code = 0
+            except SystemExit as exception:
+                exit_code = get_exit_code(exception)
+            except Exception:
+                traceback.print_exc()
+                exit_code = 1
+            finally:
+                self.stdout.target.flush()
+                self.stderr.target.flush()
+                self.stdout.target = self.stderr.target = None
+        return exit_code
+
+    def run_in_subprocess(self, connection, request_id, argv, cwd, environment) -> int:
+        # Child runs the command itself instead of sending it back to us
+        environment = dict(environment, PYTHONUNBUFFERED="1", GOGDL_SOCKET="")
+        process = subprocess.Popen(self.self_command + argv, cwd=cwd, env=environment, text=True,
+                                   stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        connection.processes[request_id] = process
+
+        def forward(pipe, stream):
+            for line in iter(pipe.readline, ""):
+                try:
+                    connection.notify_output(request_id, stream, line)
+                except OSError:
+                    pass
+
+        readers = [threading.Thread(target=forward, args=(process.stdout, "stdout")),
+                   threading.Thread(target=forward, args=(process.stderr, "stderr"))]
+        [reader.start() for reader in readers]
+        try:
+            exit_code = process.wait()
+        finally:
+            [reader.join() for reader in readers]
+            connection.processes.pop(request_id, None)
+        return exit_code
+
+
+def should_forward(arguments) -> bool:
+    return (
+        supported()
+        and arguments.command is not None
+        and arguments.command not in LOCAL_COMMANDS
+        and not getattr(arguments, "watch", False)
+        and get_socket_path()
+        and os.path.exists(get_socket_path())
+    )
+
+
+def run_client(argv):
+    """
+    Runs command in the service, returns its exit code
+    or None when the service isn't reachable and command should run locally
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(get_socket_path())
+    except OSError:
+        sock.close()
+        return None
+
+    connection = Connection(sock)
+    cancelled = list()
+
+    def cancel(signum, frame):
+        if cancelled:
+            # Second signal, stop waiting
+            sys.exit(-signum)
+        cancelled.append(signum)
+        try:
+            connection.send({"method": "cancel", "params": {"id": 1}})
+        except OSError:
+            pass
+
+    signal.signal(signal.SIGTERM, cancel)
+    signal.signal(signal.SIGINT, cancel)
+
+    with sock, sock.makefile("r", encoding="utf-8") as reader:
+        connection.send({"id": 1, "method": "run", "params": {"argv": argv, "cwd": os.getcwd(), "env": dict(os.environ)}})
+        for line in reader:
+            message = json.loads(line)
+            if message.get("method") == "output":
+                stream = sys.stdout if message["params"]["stream"] == "stdout" else sys.stderr
+                stream.write(message["params"]["data"])
+                stream.flush()
+            elif message.get("id") == 1:
+                if "error" in message:
+                    print(message["error"]["message"], file=sys.stderr)
+                    return 1
+                return message["result"]["exit_code"]
+    print("Service closed the connection", file=sys.stderr)
+    return 1
@@ -0,0 +1,144 @@
+# Checks installed games for updates, using manifests stored by download in MANIFESTS_DIR
+import json
+import logging
+import os
+import threading
+
+from gogdl import constants
+from gogdl.dl import dl_utils
+from gogdl.languages import Language
+
+
+def get_installed_games(ids=None):
+    """
+    Returns installed games read from stored manifests
+    """
+    games = list()
+    try:
+        names = sorted(os.listdir(constants.MANIFESTS_DIR))
+    except OSError:
+        return games
+    for name in names:
+        if ids and name not in ids:
+            continue
+        try:
+            with open(os.path.join(constants.MANIFESTS_DIR, name), "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if not isinstance(data, dict) or "HGLInstallLanguage" not in data:
+            continue
+        games.append({
+            "id": name,
+            "platform": data.get("HGLPlatform") or data.get("platform") or "windows",
+            # Older manifests only have build id of v2 metas
+            "build_id": data.get("HGLBuildId") or data.get("buildId"),
+            "branch": data.get("HGLBranch"),
+            "manifest": data,
+        })
+    return games
+
+
+def get_builds(api_handler, game_id, platform):
+    # Builds lists are revalidated with ETag by the session's cache
+    url = f"{constants.GOG_CONTENT_SYSTEM}/products/{game_id}/os/{platform}/builds?generation=2"
+    response = api_handler.session.get(url)
+    if not response.ok:
+        raise Exception(f"Unable to get builds, status {response.status_code}")
+    return response.json()
+
+
+def get_manifest(api_handler, game, build):
+    from gogdl.dl.objects import v1, v2
+    meta, _ = dl_utils.get_zlib_encoded(api_handler, build["link"])
+    if not meta:
+        raise Exception("Unable to get build meta")
+    installed = game["manifest"]
+    language = Language.parse(installed["HGLInstallLanguage"])
+    if build["generation"] == 1:
+        return v1.Manifest(game["platform"], meta, language, installed["HGLdlcs"], api_handler, False)
+    return v2.Manifest(meta, language, installed["HGLdlcs"], api_handler, False)
+
+
+def get_depots_delta(installed_manifest, manifest):
+    """
+    Returns sizes of depots that changed between manifests, a depot
+    is downloaded again if its manifest differs from the installed one
+    """
+    installed = set(depot.manifest for depot in installed_manifest.depots)
+    download_size = 0
+    disk_size = 0
+    changed = set(depot.manifest for depot in manifest.depots) != installed
+    for depot in manifest.depots:
+        if depot.manifest in installed:
+            continue
+        download_size += getattr(depot, "compressed_size", depot.size)
+        disk_size += depot.size
+    return changed, {"download_size": download_size, "disk_size": disk_size}
+
+
+def check_game(api_handler, game, estimate_size):
+    """
+    Returns update of the game or None when it's up to date
+    """
+    from gogdl.dl.managers.manager import get_target_build
+    builds = get_builds(api_handler, game["id"], game["platform"])
+    if not builds.get("items"):
+        raise Exception("No builds found")
+    build = get_target_build(builds, game["branch"])
+    if build["build_id"] == game["build_id"]:
+        return None
+
+    update = {
+        "id": game["id"],
+        "platform": game["platform"],
+        "branch": build["branch"],
+        "installedBuildId": game["build_id"],
+        "buildId": build["build_id"],
+        "versionName": build["version_name"],
+        "generation": build["generation"],
+    }
+    if not estimate_size:
+        if not game["build_id"]:
+            # Installed build isn't known, telling if it's outdated needs metas
+            update["unknown"] = True
+        return update
+
+    installed_manifest = dl_utils.create_manifest_class(game["manifest"], api_handler)
+    changed, size = get_depots_delta(installed_manifest, get_manifest(api_handler, game, build))
+    if not changed and not game["build_id"]:
+        # Unknown installed build with the same content
+        return None
+    update["size"] = size
+    return update
+
+
+def check_updates(arguments, unknown_arguments, api_handler):
+    """
+    Prints JSON line for each installed game that has an update
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    logger = logging.getLogger("UPDATES")
+    ids = arguments.ids.split(",") if arguments.ids else None
+    games = get_installed_games(ids)
+    if not games:
+        logger.info("No installed games found")
+        return
+
+    workers = max(1, min(int(arguments.workers_count), len(games)))
+    api_handler.set_workers(workers)
+    print_lock = threading.Lock()
+
+    def run(game):
+        try:
+            result = check_game(api_handler, game, not arguments.skip_size)
+        except Exception as e:
+            logger.error(f"Failed to check updates of {game['id']}: {e}")
+            result = {"id": game["id"], "platform": game["platform"], "error": str(e) or e.__class__.__name__}
+        if result:
+            with print_lock:
+                print(json.dumps(result), flush=True)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(run, games))
@@ -1,13 +1,19 @@
 #ifndef Py_LIMITED_API
 #error "Py_LIMITED_API must be defined! We rely on it to ensure we attempt to use stable 3.x ABI"
 #endif
+#define PY_SSIZE_T_CLEAN
 #include <Python.h>
 #ifdef _LARGEFILE_SOURCE
 #undef _LARGEFILE_SOURCE
 #endif
 #include <xdelta3/xdelta3.h>
+#ifndef _WIN32
+#include <sys/mman.h>
+#include <sys/stat.h>
+#define HAVE_MMAP 1
+#endif
 
-#define BLOCK_SIZE 1 << 23
+#define BLOCK_SIZE (1 << 23)
 #define BLOCK_CACHE_SIZE 32
 
 struct cache_nav {
@@ -20,6 +26,8 @@ struct cache {
   usize_t onblk;
   uint8_t *blk;
   struct cache_nav nav;
+  /* next entry in the same lookup bucket */
+  struct cache *hnext;
 };
 
 static inline struct cache* cache_entry(struct cache_nav *l) {
@@ -52,6 +60,23 @@ static inline struct cache* cache_remove(struct cache *f) {
   return cache_entry(i);
 }
 
+static inline struct cache* cache_lookup(struct cache **buckets, usize_t mask, xoff_t blkno) {
+  struct cache *i = buckets[blkno & mask];
+  while (i && i->blkno != blkno) i = i->hnext;
+  return i;
+}
+
+static inline void cache_unlink(struct cache **buckets, usize_t mask, struct cache *f) {
+  struct cache **i = &buckets[f->blkno & mask];
+  while (*i && *i != f) i = &(*i)->hnext;
+  if (*i) *i = f->hnext;
+  f->hnext = NULL;
+}
+
+static inline void cache_link(struct cache **buckets, usize_t mask, struct cache *f) {
+  f->hnext = buckets[f->blkno & mask];
+  buckets[f->blkno & mask] = f;
+}
 
 void put_progress(PyObject *queue, usize_t written, usize_t read) {
   PyObject *progress_tuple = NULL;
@@ -95,180 +120,446 @@ void put_progress(PyObject *queue, usize_t written, usize_t read) {
   Py_DECREF(put_result);
 }
 
-static PyObject *patch(PyObject *self, PyObject *args) {
-  const char *source;
-  const char *patch;
-  const char *target;
-  PyObject *queue;
-
+struct patch_state {
   xd3_stream stream;
   xd3_config config;
   xd3_source src;
-  uint8_t *input_buffer = NULL;
-  struct cache *block_cache = NULL;
+  struct cache *block_cache;
+  struct cache **buckets;
   struct cache_nav block_cache_nav;
+  usize_t buckets_mask;
+  usize_t cache_size;
+  int use_mmap;
 
-  FILE *fsource = NULL;
-  FILE *fpatch = NULL;
-  FILE *ftarget = NULL;
+  /* whole source file, when mapped blocks are served straight from it */
+  uint8_t *source_map;
+  xoff_t source_size;
 
-  usize_t input_read = 0;
-  uint64_t offset = 0;
-  usize_t cache_size = 0;
+  FILE *fsource;
+  FILE *ftarget;
 
-  usize_t written = 0;
-  usize_t read = 0;
+  PyObject *queue;
+  usize_t written;
+  usize_t read;
+};
 
+static uint8_t empty_block[1];
 
-  if (!PyArg_ParseTuple(args, "sssO", &source, &patch, &target, &queue)) {
-    return NULL;
+static int parse_options(int use_mmap, Py_ssize_t block_size,
+                         Py_ssize_t cache_blocks, Py_ssize_t window_size) {
+  if (block_size < XD3_ALLOCSIZE || (block_size & (block_size - 1))) {
+    PyErr_SetString(PyExc_ValueError,
+                    "block_size must be a power of two, at least 16 KiB");
+    return -1;
+  }
+  if (cache_blocks < 1 || window_size < XD3_ALLOCSIZE) {
+    PyErr_SetString(PyExc_ValueError,
+                    "cache_blocks must be positive and window_size at least 16 KiB");
+    return -1;
+  }
+  return 0;
+}
+
+static void state_free(struct patch_state *state) {
+  xd3_free_stream(&state->stream);
+  if (state->block_cache) {
+    if (state->block_cache[0].blk) free(state->block_cache[0].blk);
+    free(state->block_cache);
+  }
+  if (state->buckets)
+    free(state->buckets);
+#ifdef HAVE_MMAP
+  if (state->source_map)
+    munmap(state->source_map, state->source_size);
+#endif
+  if (state->fsource)
+    fclose(state->fsource);
+  if (state->ftarget) {
+    fflush(state->ftarget);
+    fclose(state->ftarget);
   }
+  Py_XDECREF(state->queue);
+  memset(state, 0, sizeof(*state));
+}
+
+/* Opens files and sets up the decoder, on failure sets an exception and
+ * returns -1, state has to be freed either way */
+static int state_init(struct patch_state *state, const char *source,
+                      const char *target, PyObject *queue, int use_mmap,
+                      Py_ssize_t block_size, Py_ssize_t cache_blocks,
+                      Py_ssize_t window_size) {
+  int error = 0;
+
+  memset(state, 0, sizeof(*state));
   if (!PyObject_HasAttrString(queue, "put")) {
     PyErr_SetString(PyExc_TypeError,
                     "Expected a queue-like object with a .put() method");
-    return NULL;
+    return -1;
   }
-  cache_init(&block_cache_nav);
-  input_buffer = malloc(BLOCK_SIZE);
-  block_cache = malloc(BLOCK_CACHE_SIZE * sizeof(struct cache));
-  if (!block_cache) {
-    PyErr_SetFromErrno(PyExc_MemoryError);
-    goto cleanup;
+  if (parse_options(use_mmap, block_size, cache_blocks, window_size)) {
+    return -1;
   }
-  memset(block_cache, 0, sizeof(block_cache[0]) * BLOCK_CACHE_SIZE);
-  block_cache[0].blk = malloc((BLOCK_SIZE) * BLOCK_CACHE_SIZE);
-  if (!block_cache[0].blk) {
-    PyErr_SetFromErrno(PyExc_MemoryError);
-    goto cleanup;
+  Py_INCREF(queue);
+  state->queue = queue;
+#ifndef HAVE_MMAP
+  /* Block cache is used where mmap isn't available */
+  use_mmap = 0;
+#endif
+  state->use_mmap = use_mmap;
+
+  cache_init(&state->block_cache_nav);
+  if (!use_mmap) {
+    state->cache_size = cache_blocks;
+    state->block_cache = calloc(state->cache_size, sizeof(struct cache));
+    for (state->buckets_mask = 1; state->buckets_mask < state->cache_size * 2;
+         state->buckets_mask <<= 1);
+    state->buckets = calloc(state->buckets_mask, sizeof(struct cache *));
+    state->buckets_mask -= 1;
+    if (!state->block_cache || !state->buckets) {
+      PyErr_NoMemory();
+      return -1;
+    }
+    state->block_cache[0].blk = malloc(block_size * state->cache_size);
+    if (!state->block_cache[0].blk) {
+      PyErr_NoMemory();
+      return -1;
+    }
+    for (usize_t i = 0; i < state->cache_size; i++) {
+      state->block_cache[i].blkno = -1;
+      if (i > 0)
+        state->block_cache[i].blk = state->block_cache[0].blk + (i * block_size);
+      cache_add(state->block_cache_nav.prev, &state->block_cache_nav,
+                &state->block_cache[i].nav);
+    }
   }
-  cache_size = BLOCK_CACHE_SIZE;
-  for (int i=0; i<cache_size;i++) {
-    block_cache[i].blkno = -1;
-    if (i>0) block_cache[i].blk = block_cache[0].blk + (i * BLOCK_SIZE);
-    cache_add(block_cache_nav.prev, &block_cache_nav, &block_cache[i].nav);
+
+  Py_BEGIN_ALLOW_THREADS
+  if (!(state->fsource = fopen(source, "rb")) ||
+      !(state->ftarget = fopen(target, "wb"))) {
+    error = 1;
+  }
+#ifdef HAVE_MMAP
+  if (!error && use_mmap) {
+    struct stat st;
+    if (fstat(fileno(state->fsource), &st)) {
+      error = 1;
+    } else {
+      state->source_size = st.st_size;
+    }
+    if (!error && state->source_size) {
+      state->source_map = mmap(NULL, state->source_size, PROT_READ,
+                               MAP_PRIVATE, fileno(state->fsource), 0);
+      if (state->source_map == MAP_FAILED) {
+        state->source_map = NULL;
+        error = 1;
+      }
+    }
   }
+#endif
 
-  Py_BEGIN_ALLOW_THREADS if (!(fsource = fopen(source, "rb"))) {
-    Py_BLOCK_THREADS PyErr_SetFromErrno(PyExc_OSError);
-    Py_UNBLOCK_THREADS goto cleanup;
+  if (!error) {
+    state->config.winsize = window_size;
+    xd3_config_stream(&state->stream, &state->config);
+
+    state->src.blksize = block_size;
+    state->src.curblkno = 0;
+    if (use_mmap) {
+      state->src.curblk = state->source_map ? state->source_map : empty_block;
+      state->src.onblk = state->source_size < state->src.blksize
+                             ? state->source_size
+                             : state->src.blksize;
+    } else {
+      state->src.onblk = fread(state->block_cache[0].blk, sizeof(uint8_t),
+                               state->src.blksize, state->fsource);
+      state->src.curblk = state->block_cache[0].blk;
+      state->block_cache[0].blkno = 0;
+      state->block_cache[0].onblk = state->src.onblk;
+      cache_link(state->buckets, state->buckets_mask, &state->block_cache[0]);
+    }
+    xd3_set_source(&state->stream, &state->src);
   }
+  Py_END_ALLOW_THREADS
 
-  if (!(fpatch = fopen(patch, "rb"))) {
-    Py_BLOCK_THREADS PyErr_SetFromErrno(PyExc_OSError);
-    Py_UNBLOCK_THREADS goto cleanup;
+  if (error) {
+    PyErr_SetFromErrno(PyExc_OSError);
+    return -1;
   }
+  return 0;
+}
 
-  if (!(ftarget = fopen(target, "wb"))) {
-    Py_BLOCK_THREADS PyErr_SetFromErrno(PyExc_OSError);
-    Py_UNBLOCK_THREADS goto cleanup;
+static void state_getsrcblk(struct patch_state *state) {
+  xd3_source *src = &state->src;
+  uint64_t offset = src->blksize * src->getblkno;
+
+  if (state->use_mmap) {
+    src->curblkno = src->getblkno;
+    if (offset < state->source_size) {
+      src->curblk = state->source_map + offset;
+      src->onblk = state->source_size - offset < src->blksize
+                       ? state->source_size - offset
+                       : src->blksize;
+    } else {
+      src->curblk = empty_block;
+      src->onblk = 0;
+    }
+    return;
   }
 
-  memset(&stream, 0, sizeof(stream));
-  memset(&config, 0, sizeof(config));
-  memset(&src, 0, sizeof(src));
+  struct cache *cache_el =
+      cache_lookup(state->buckets, state->buckets_mask, src->getblkno);
+  if (cache_el) {
+    cache_remove(cache_el);
+    cache_add(state->block_cache_nav.prev, &state->block_cache_nav,
+              &cache_el->nav);
+  } else {
+    cache_el = cache_pop_front(&state->block_cache_nav);
+    cache_add(state->block_cache_nav.prev, &state->block_cache_nav,
+              &cache_el->nav);
+    cache_unlink(state->buckets, state->buckets_mask, cache_el);
+
+    fseek(state->fsource, offset, SEEK_SET);
+    cache_el->onblk =
+        fread(cache_el->blk, sizeof(uint8_t), src->blksize, state->fsource);
+    cache_el->blkno = src->getblkno;
+    cache_link(state->buckets, state->buckets_mask, cache_el);
+  }
 
-  config.winsize = XD3_DEFAULT_WINSIZE;
-  xd3_config_stream(&stream, &config);
+  src->curblkno = cache_el->blkno;
+  src->onblk = cache_el->onblk;
+  src->curblk = cache_el->blk;
+}
 
-  src.blksize = BLOCK_SIZE;
-  src.curblk = block_cache[0].blk;
-  src.curblkno = 0;
-  block_cache[0].blkno = 0;
-  src.onblk = fread(src.curblk, sizeof(uint8_t), BLOCK_SIZE, fsource);
-  xd3_set_source(&stream, &src);
-  block_cache[0].onblk = src.onblk;
+/* Decodes provided part of the patch, called with the GIL held.
+ * With flush set this is the last part, and the stream gets closed */
+static int state_decode(struct patch_state *state, const uint8_t *input,
+                        usize_t input_size, int flush) {
+  xd3_stream *stream = &state->stream;
+  int error = 0;
 
-  do {
-    input_read = fread(input_buffer, sizeof(uint8_t), BLOCK_SIZE, fpatch);
-    if (input_read < BLOCK_SIZE) {
-      xd3_set_flags(&stream, XD3_FLUSH);
+  Py_BEGIN_ALLOW_THREADS
+  if (flush) {
+    xd3_set_flags(stream, XD3_FLUSH);
+  }
+  xd3_avail_input(stream, input, input_size);
+  while (!error) {
+    int ret = xd3_decode_input(stream);
+    if (ret == XD3_INPUT) {
+      break;
     }
-    xd3_avail_input(&stream, input_buffer, input_read);
-  process:
-    switch (xd3_decode_input(&stream)) {
-    case XD3_INPUT:
-      continue;
+    switch (ret) {
     case XD3_OUTPUT:
-      fwrite(stream.next_out, sizeof(uint8_t), stream.avail_out, ftarget);
-      xd3_consume_output(&stream);
-      goto process;
-    case XD3_GETSRCBLK: {
-      for (int i = 0; i < cache_size; i++) {
-        if (block_cache[i].blkno == src.getblkno) {
-          src.onblk = block_cache[i].onblk;
-          src.curblk = block_cache[i].blk;
-          src.curblkno = src.getblkno;
-          cache_remove(&block_cache[i]);
-          cache_add(block_cache_nav.prev, &block_cache_nav, &block_cache[i].nav);
-          goto process;
-        }
-      }
-      struct cache* cache_el = cache_pop_front(&block_cache_nav);
-      cache_add(block_cache_nav.prev, &block_cache_nav, &cache_el->nav);
-
-      offset = src.blksize * src.getblkno;
-      fseek(fsource, offset, SEEK_SET);
-      cache_el->onblk = fread(
-          cache_el->blk, sizeof(uint8_t), src.blksize, fsource);
-      cache_el->blkno = src.getblkno;
-
-      src.curblkno = cache_el->blkno;
-      src.onblk = cache_el->onblk;
-      src.curblk = cache_el->blk;
-
-      goto process;
-    }
+      fwrite(stream->next_out, sizeof(uint8_t), stream->avail_out,
+             state->ftarget);
+      xd3_consume_output(stream);
+      break;
+    case XD3_GETSRCBLK:
+      state_getsrcblk(state);
+      break;
     case XD3_GOTHEADER:
     case XD3_WINSTART:
     case XD3_WINFINISH:
-      /* no action necessary */
       Py_BLOCK_THREADS
-      put_progress(queue, stream.total_out - written, stream.total_in - read);
-      written = stream.total_out;
-      read = stream.total_in;
+      put_progress(state->queue, stream->total_out - state->written,
+                   stream->total_in - state->read);
+      state->written = stream->total_out;
+      state->read = stream->total_in;
       Py_UNBLOCK_THREADS
-      goto process;
+      break;
     default:
-      Py_BLOCK_THREADS if (stream.msg) {
-        printf("%s\n", stream.msg);
+      Py_BLOCK_THREADS if (stream->msg) {
+        printf("%s\n", stream->msg);
         fflush(stdout);
       }
       PyErr_SetFromErrno(PyExc_MemoryError);
-      Py_UNBLOCK_THREADS goto cleanup;
+      Py_UNBLOCK_THREADS
+      error = 1;
     }
-
-  } while (input_read == BLOCK_SIZE);
-  if (xd3_close_stream(&stream)) {
-    Py_BLOCK_THREADS PyErr_SetFromErrno(PyExc_AssertionError);
+  }
+  if (!error && flush && xd3_close_stream(stream)) {
+    Py_BLOCK_THREADS PyErr_SetString(PyExc_AssertionError,
+                                     stream->msg ? stream->msg : "incomplete patch");
     Py_UNBLOCK_THREADS
+    error = 1;
   }
+  Py_END_ALLOW_THREADS
 
-cleanup:
-  Py_END_ALLOW_THREADS xd3_free_stream(&stream);
-  if (block_cache) {
-    if (block_cache[0].blk) free(block_cache[0].blk);
-    free(block_cache);
+  return error ? -1 : 0;
+}
+
+static PyObject *patch(PyObject *self, PyObject *args, PyObject *kwargs) {
+  static char *kwlist[] = {"source", "patch", "target", "queue", "use_mmap",
+                           "block_size", "cache_blocks", "window_size", NULL};
+  const char *source;
+  const char *patch;
+  const char *target;
+  PyObject *queue;
+  int use_mmap = 0;
+  Py_ssize_t block_size = BLOCK_SIZE;
+  Py_ssize_t cache_blocks = BLOCK_CACHE_SIZE;
+  Py_ssize_t window_size = XD3_DEFAULT_WINSIZE;
+
+  struct patch_state state;
+  uint8_t *input_buffer = NULL;
+  FILE *fpatch = NULL;
+  usize_t input_read = 0;
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "sssO|$pnnn", kwlist, &source,
+                                   &patch, &target, &queue, &use_mmap,
+                                   &block_size, &cache_blocks, &window_size)) {
+    return NULL;
   }
 
+  if (state_init(&state, source, target, queue, use_mmap, block_size,
+                 cache_blocks, window_size)) {
+    goto cleanup;
+  }
+  input_buffer = malloc(block_size);
+  if (!input_buffer) {
+    PyErr_NoMemory();
+    goto cleanup;
+  }
+  if (!(fpatch = fopen(patch, "rb"))) {
+    PyErr_SetFromErrno(PyExc_OSError);
+    goto cleanup;
+  }
+
+  do {
+    Py_BEGIN_ALLOW_THREADS
+    input_read = fread(input_buffer, sizeof(uint8_t), block_size, fpatch);
+    Py_END_ALLOW_THREADS
+    if (state_decode(&state, input_buffer, input_read, input_read < block_size)) {
+      goto cleanup;
+    }
+  } while (input_read == block_size);
+
+cleanup:
+  state_free(&state);
   if (input_buffer)
     free(input_buffer);
-  if (fsource)
-    fclose(fsource);
   if (fpatch)
     fclose(fpatch);
-  if (ftarget) {
-    fflush(ftarget);
-    fclose(ftarget);
+
+  if (PyErr_Occurred())
+    return NULL;
+  Py_RETURN_NONE;
+}
+
+/* Decoder fed with the patch in parts, as they become available */
+typedef struct {
+  PyObject_HEAD
+  struct patch_state state;
+  int opened;
+} Decoder;
+
+static int Decoder_init(Decoder *self, PyObject *args, PyObject *kwargs) {
+  static char *kwlist[] = {"source", "target", "queue", "use_mmap",
+                           "block_size", "cache_blocks", "window_size", NULL};
+  const char *source;
+  const char *target;
+  PyObject *queue;
+  int use_mmap = 0;
+  Py_ssize_t block_size = BLOCK_SIZE;
+  Py_ssize_t cache_blocks = BLOCK_CACHE_SIZE;
+  Py_ssize_t window_size = XD3_DEFAULT_WINSIZE;
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "ssO|$pnnn", kwlist, &source,
+                                   &target, &queue, &use_mmap, &block_size,
+                                   &cache_blocks, &window_size)) {
+    return -1;
+  }
+  if (self->opened) {
+    state_free(&self->state);
+    self->opened = 0;
+  }
+  if (state_init(&self->state, source, target, queue, use_mmap, block_size,
+                 cache_blocks, window_size)) {
+    state_free(&self->state);
+    return -1;
+  }
+  self->opened = 1;
+  return 0;
+}
+
+static void Decoder_dealloc(Decoder *self) {
+  PyTypeObject *type = Py_TYPE(self);
+  freefunc tp_free = (freefunc)PyType_GetSlot(type, Py_tp_free);
+  if (self->opened)
+    state_free(&self->state);
+  tp_free(self);
+  Py_DECREF(type);
+}
+
+static PyObject *Decoder_write(Decoder *self, PyObject *args) {
+  const char *data;
+  Py_ssize_t size;
+
+  if (!PyArg_ParseTuple(args, "y#", &data, &size)) {
+    return NULL;
+  }
+  if (!self->opened) {
+    PyErr_SetString(PyExc_ValueError, "write to closed decoder");
+    return NULL;
+  }
+  if (state_decode(&self->state, (const uint8_t *)data, size, 0)) {
+    return NULL;
   }
+  return PyLong_FromSsize_t(size);
+}
 
+static PyObject *Decoder_close(Decoder *self, PyObject *Py_UNUSED(args)) {
+  int error = 0;
+  if (self->opened) {
+    error = state_decode(&self->state, empty_block, 0, 1);
+    state_free(&self->state);
+    self->opened = 0;
+  }
+  if (error)
+    return NULL;
   Py_RETURN_NONE;
 }
 
+static PyMethodDef Decoder_methods[] = {
+    {"write", (PyCFunction)Decoder_write, METH_VARARGS,
+     "Decodes next part of the patch, returns number of bytes consumed"},
+    {"close", (PyCFunction)Decoder_close, METH_NOARGS,
+     "Flushes the decoder and closes files, fails if the patch is incomplete"},
+    {NULL, NULL, 0, NULL}};
+
+static PyType_Slot Decoder_slots[] = {
+    {Py_tp_doc,
+     "Decoder(source, target, queue, *, use_mmap=False, block_size=8 MiB, "
+     "cache_blocks=32, window_size=8 MiB)\n"
+     "Applies a patch written to it in parts, with the same options as patch()"},
+    {Py_tp_new, PyType_GenericNew},
+    {Py_tp_init, Decoder_init},
+    {Py_tp_dealloc, Decoder_dealloc},
+    {Py_tp_methods, Decoder_methods},
+    {0, NULL}};
+
+static PyType_Spec Decoder_spec = {"gogdl_xdelta3.Decoder", sizeof(Decoder), 0,
+                                   Py_TPFLAGS_DEFAULT, Decoder_slots};
+
 static PyMethodDef methods[] = {
-    {"patch", patch, METH_VARARGS, "Runs a patch on provided files"},
+    {"patch", (PyCFunction)(void (*)(void))patch, METH_VARARGS | METH_KEYWORDS,
+     "patch(source, patch, target, queue, *, use_mmap=False, block_size=8 MiB, "
+     "cache_blocks=32, window_size=8 MiB)\n"
+     "Runs a patch on provided files. With use_mmap the source file is mapped "
+     "instead of read through the block cache"},
     {NULL, NULL, 0, NULL}};
 
 static struct PyModuleDef xdelta_def = {PyModuleDef_HEAD_INIT, "gogdl_xdelta3", NULL,
                                         -1, methods};
 
-PyMODINIT_FUNC PyInit_gogdl_xdelta3(void) { return PyModule_Create(&xdelta_def); }
\ No newline at end of file
+PyMODINIT_FUNC PyInit_gogdl_xdelta3(void) {
+  PyObject *module = PyModule_Create(&xdelta_def);
+  PyObject *decoder_type;
+  if (!module)
+    return NULL;
+  decoder_type = PyType_FromSpec(&Decoder_spec);
+  if (!decoder_type || PyModule_AddObject(module, "Decoder", decoder_type)) {
+    Py_XDECREF(decoder_type);
+    Py_DECREF(module);
+    return NULL;
+  }
+  return module;
+}
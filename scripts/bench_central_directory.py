@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+import argparse
+import io
+import os
+import struct
+import subprocess
+import sys
+import time
+import types
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from gogdl.dl.objects import linux
+
+# Script used to benchmark Linux installer central directory parsing
+# and to check the parser against the previous slicing implementation, loaded from git.
+# Builds a ZIP64 installer (shell stub + zip with more than 65535 entries, extra fields
+# and comments) and a directory with ZIP64 extended information fields. Installers or
+# other zip files passed as arguments are checked too, e.g.
+#   bench_central_directory.py [--entries N] [--baseline REVISION] [installer ...]
+
+ENTRIES = 100_000
+LEGACY_ENTRIES = 10_000
+# Fields of records, some of them used to be kept as bytes
+FIELDS = (
+    "version_made_by", "version_needed_to_extract", "general_purpose_bit_flag", "compression_method",
+    "last_modification_time", "last_modification_date", "crc32", "compressed_size", "uncompressed_size",
+    "file_name_length", "extra_field_length", "file_comment_length", "disk_number_start", "int_file_attrs",
+    "ext_file_attrs", "relative_local_file_offset", "file_name", "last_byte", "file_data_offset",
+)
+
+
+def load_baseline(revision):
+    """
+    Loads module with the parser from before it was rewritten to avoid copies
+    """
+    root = os.path.join(os.path.dirname(__file__), "..")
+    path = "gogdl/dl/objects/linux.py"
+    if not revision:
+        # Parent of the commit that introduced the struct based parser
+        rewrite = subprocess.run(["git", "log", "-1", "--format=%H", "-S", "HEADER = struct.Struct", "--", path],
+                                 cwd=root, check=True, capture_output=True, text=True).stdout.strip()
+        revision = f"{rewrite}^"
+    source = subprocess.run(["git", "show", f"{revision}:{path}"],
+                            cwd=root, check=True, capture_output=True, text=True).stdout
+    module = types.ModuleType("baseline_linux")
+    exec(compile(source, f"{revision}:{path}", "exec"), module.__dict__)
+    return module
+
+
+def as_values(cd_file):
+    values = dict()
+    for key in FIELDS:
+        value = getattr(cd_file, key)
+        values[key] = int.from_bytes(value, "little") if isinstance(value, bytes) else value
+    values["as_dict"] = cd_file.as_dict()
+    return values
+
+
+def generate_installer(entries):
+    # Offsets in GOG installers are relative to the beginning of the archive
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zf:
+        for i in range(entries):
+            info = zipfile.ZipInfo(f"data/noarch/game/dir{i % 500}/file_{i}.dat")
+            info.compress_type = zipfile.ZIP_DEFLATED if i % 2 else zipfile.ZIP_STORED
+            info.external_attr = (0o120777 if i % 100 == 0 else 0o100755) << 16
+            if i % 3 == 0:
+                # Extended timestamp field
+                info.extra = struct.pack("<HHBI", 0x5455, 5, 1, i)
+            if i % 7 == 0:
+                info.comment = f"comment {i}".encode()
+            zf.writestr(info, b"x" * (i % 64))
+    return b"#!/bin/sh\n" + b"#" * 4096 + b"\nexit 0\n" + buffer.getvalue()
+
+
+def read_central_directory(installer):
+    archive_start = installer.find(linux.LOCAL_FILE_HEADER)
+    tail = installer[-100:]
+    end_of_cd = linux.EndOfCentralDir.from_bytes(tail[tail.find(linux.END_OF_CENTRAL_DIRECTORY):])
+    locator_index = tail.find(linux.ZIP_64_END_OF_CD_LOCATOR)
+    if locator_index != -1:
+        locator = linux.Zip64EndOfCentralDirLocator.from_bytes(tail[locator_index:])
+        zip64_offset = locator.zip64_end_of_cd_offset + archive_start
+        zip64_end_of_cd = linux.Zip64EndOfCentralDir.from_bytes(installer[zip64_offset:zip64_offset + 56])
+        offset = zip64_end_of_cd.central_directory_offset + archive_start
+        return installer[offset:offset + zip64_end_of_cd.size_of_central_directory], zip64_end_of_cd.number_of_entries_total
+    offset = end_of_cd.central_directory_offset + archive_start
+    return installer[offset:offset + end_of_cd.size_of_central_directory], end_of_cd.central_directory_records
+
+
+def generate_zip64_records(entries):
+    records = []
+    for i in range(entries):
+        name = f"data/noarch/big_{i}.pak".encode()
+        extra = struct.pack("<HH4s", 0x000A, 4, b"abcd") + struct.pack("<HHQQQ", 0x0001, 24, 5 << 32, 4 << 32, (i + 1) << 33)
+        comment = f"zip64 {i}".encode() if i % 2 else b""
+        records.append(struct.pack(
+            "<4sHHHHHHIIIHHHHHII", linux.CENTRAL_DIRECTORY, 0x031E, 45, 0, 8, 0, 0, i,
+            0xFFFFFFFF, 0xFFFFFFFF, len(name), len(extra), len(comment), 0, 0, 0o100644 << 16, 0xFFFFFFFF,
+        ) + name + extra + comment)
+    return b"".join(records)
+
+
+def check(baseline, name, data, n):
+    expected = [as_values(f) for f in baseline.CentralDirectory.from_bytes(data, n, "1").files]
+    got = [as_values(f) for f in linux.CentralDirectory.from_bytes(data, n, "1").files]
+    assert got == expected, f"Parsers disagree on {name}"
+    print(f"{name:>30}: {n} entries match")
+
+
+def measure(name, function):
+    start = time.perf_counter()
+    function()
+    print(f"{name:>30}: {time.perf_counter() - start:.3f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, default=ENTRIES)
+    parser.add_argument("--baseline", help="Revision of the previous parser, by default the one before it was rewritten")
+    parser.add_argument("installers", nargs="*")
+    arguments = parser.parse_args()
+    baseline = load_baseline(arguments.baseline)
+
+    installer = generate_installer(arguments.entries)
+    data, n = read_central_directory(installer)
+    print(f"Installer: {len(installer) / 1024 / 1024:.2f} MiB, {n} entries, central directory {len(data) / 1024 / 1024:.2f} MiB")
+
+    legacy_data, legacy_n = read_central_directory(generate_installer(LEGACY_ENTRIES))
+    check(baseline, "installer", legacy_data, legacy_n)
+    check(baseline, "zip64 installer", data, n)
+    check(baseline, "zip64 extended information", generate_zip64_records(1000), 1000)
+    for path in arguments.installers:
+        with open(path, "rb") as f:
+            check(baseline, os.path.basename(path), *read_central_directory(f.read()))
+    print("Equivalence checks passed")
+
+    measure(f"baseline ({legacy_n} entries)", lambda: baseline.CentralDirectory.from_bytes(legacy_data, legacy_n, "1"))
+    measure(f"memoryview ({legacy_n} entries)", lambda: linux.CentralDirectory.from_bytes(legacy_data, legacy_n, "1"))
+    measure(f"memoryview ({n} entries)", lambda: linux.CentralDirectory.from_bytes(data, n, "1"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Script used to benchmark gogdl startup for each subcommand.
+# Runs the CLI with -X importtime and sums time spent importing modules on top
+# of a bare interpreter. Commands are given arguments that make them stop
+# early and network is pointed at a closed port, so only startup is measured, e.g.
+#   bench_cli_startup.py [runs]
+
+RUNS = 5
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def commands(directory):
+    missing = os.path.join(directory, "missing")
+    auth = ["--auth-config-path", os.path.join(directory, "auth.json")]
+    return (
+        ("--version", ["--version"]),
+        ("lang-match", ["lang-match", "en"]),
+        ("launch", ["launch", missing, "1", "--platform", "linux"]),
+        ("import", ["import", missing]),
+        ("auth", auth + ["auth"]),
+        ("info", auth + ["info", "1", "--platform", "windows"]),
+        ("save-sync", auth + ["save-sync", missing, "1", "--ts", "0", "--os", "windows"]),
+    )
+
+
+def import_times(code, env):
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", code], env=env, cwd=ROOT,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    elapsed = time.perf_counter() - start
+    times = dict()
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        # Only top level imports, nested ones are part of their cumulative time
+        if not name.startswith("  "):
+            times[name.strip()] = int(cumulative)
+    return elapsed, times
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else RUNS
+    env = dict(os.environ, HTTPS_PROXY="http://127.0.0.1:9", HTTP_PROXY="http://127.0.0.1:9",
+               PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get("PYTHONPATH")])))
+    _, interpreter = import_times("pass", env)
+
+    with tempfile.TemporaryDirectory() as directory:
+        env["GOGDL_CONFIG_PATH"] = directory
+        print(f"{'command':>12} {'imports':>10} {'wall':>10}")
+        for name, argv in commands(directory):
+            code = f"import sys; sys.argv = ['gogdl'] + {argv!r}; import gogdl.cli; gogdl.cli.main()"
+            imports = list()
+            walls = list()
+            for _ in range(runs):
+                elapsed, times = import_times(code, env)
+                imports.append(sum(t for module, t in times.items() if module not in interpreter))
+                walls.append(elapsed)
+            print(f"{name:>12} {statistics.median(imports) / 1000:>8.1f}ms {statistics.median(walls) * 1000:>8.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+import ctypes
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from gogdl.launch import wait_for_children
+from gogdl.process import Process
+
+# Script used to measure CPU time used by the launch supervisor.
+# Simulates a session where a game keeps spawning short-lived processes,
+# some of them orphaned, and compares polling /proc every 100 ms with
+# waiting for children, e.g.
+#   bench_launch_supervisor.py [session seconds] [processes per second]
+
+SESSION = 30
+RATE = 20
+
+
+def workload(session, rate):
+    # Half of the processes are double forked, so they get reparented to the supervisor
+    return ["sh", "-c", f"end=$(($(date +%s) + {session})); "
+            f"while [ $(date +%s) -lt $end ]; do "
+            f"for i in $(seq {rate // 2}); do sleep 0.01 & (sleep 0.02 &) ; done; "
+            f"sleep 1; done; wait"]
+
+
+def polling(process_pid):
+    # Supervision as done before, /proc children walk and wait3 every 100 ms
+    status = None
+
+    def is_alive():
+        for child in Process(os.getpid()).iter_children():
+            if child.state != 'Z' and child.name:
+                return True
+        return False
+
+    def reap_children():
+        nonlocal status
+        while True:
+            try:
+                child_pid, child_returncode, _resource_usage = os.wait3(os.WNOHANG)
+            except ChildProcessError:
+                return False
+            if child_pid == process_pid:
+                status = child_returncode
+            if child_pid == 0:
+                return True
+
+    while is_alive():
+        if not reap_children():
+            break
+        time.sleep(0.1)
+    reap_children()
+    return status
+
+
+def supervise(name, session, rate, results):
+    ctypes.CDLL(None).prctl(36, 1, 0, 0, 0)  # PR_SET_CHILD_SUBREAPER
+    process = subprocess.Popen(workload(session, rate))
+    start = time.perf_counter()
+    if name == "polling":
+        polling(process.pid)
+    else:
+        wait_for_children(process.pid)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    results.put((time.perf_counter() - start, usage.ru_utime + usage.ru_stime))
+
+
+def main():
+    session = int(sys.argv[1]) if len(sys.argv) > 1 else SESSION
+    rate = int(sys.argv[2]) if len(sys.argv) > 2 else RATE
+    print(f"{session}s session, {rate} processes per second")
+    for name in ("polling", "wait"):
+        results = multiprocessing.Queue()
+        supervisor = multiprocessing.Process(target=supervise, args=(name, session, rate, results))
+        supervisor.start()
+        elapsed, cpu = results.get()
+        supervisor.join()
+        print(f"{name:>10}: {elapsed:.1f}s wall, {cpu * 1000:.0f} ms CPU")
+
+
+if __name__ == "__main__":
+    main()
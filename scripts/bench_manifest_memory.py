@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+import json
+import os
+import sys
+import time
+import tracemalloc
+import zlib
+from hashlib import md5
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from gogdl import constants
+from gogdl.dl import dl_utils
+from gogdl.dl.objects import v2
+
+# Script used to compare peak memory of depot manifest parsing.
+# Builds a synthetic v2 depot manifest and parses it either the classic way
+# (decompress whole response, json.loads, wrap items in plain objects keeping
+# json chunk dicts) or by streaming items into packed DepotFile objects.
+
+ITEMS = 200_000
+
+
+def generate_manifest(items):
+    depot_items = []
+    for i in range(items):
+        chunks = []
+        for c in range(1 + i % 3):
+            chunks.append({
+                "md5": md5(f"{i}-{c}".encode()).hexdigest(),
+                "size": 1024 * 1024,
+                "compressedMd5": md5(f"c{i}-{c}".encode()).hexdigest(),
+                "compressedSize": 512 * 1024,
+            })
+        depot_items.append({
+            "type": "DepotFile",
+            "path": f"data\\dir{i % 100}\\file{i}.dat",
+            "chunks": chunks,
+            "md5": md5(str(i).encode()).hexdigest(),
+        })
+    return zlib.compress(json.dumps({"version": 2, "depot": {"items": depot_items}}).encode())
+
+
+class LegacyDepotFile:
+    def __init__(self, item_data, product_id):
+        self.flags = item_data.get("flags") or list()
+        self.path = item_data["path"].replace(constants.NON_NATIVE_SEP, os.sep).lstrip(os.sep)
+        if "support" in self.flags:
+            self.path = os.path.join(product_id, self.path)
+        self.chunks = item_data["chunks"]
+        self.md5 = item_data.get("md5")
+        self.sha256 = item_data.get("sha256")
+        self.product_id = product_id
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.content = data
+
+    def iter_content(self, size):
+        for i in range(0, len(self.content), size):
+            yield self.content[i:i+size]
+
+
+def classic(data):
+    manifest = json.loads(zlib.decompress(data, 15))
+    return [LegacyDepotFile(item, "1") for item in manifest["depot"]["items"]]
+
+
+def streamed(data):
+    items = dl_utils.iter_json_array(dl_utils.iter_inflated_text(FakeResponse(data)), ("depot", "items"))
+    return [v2.DepotFile(item, "1") for item in items]
+
+
+def measure(name, function, data):
+    tracemalloc.start()
+    start = time.perf_counter()
+    files = function(data)
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:>10}: peak {peak / 1024 / 1024:8.2f} MiB, retained {current / 1024 / 1024:8.2f} MiB, {elapsed:.2f}s, {len(files)} files")
+    return files
+
+
+def main():
+    items = int(sys.argv[1]) if len(sys.argv) > 1 else ITEMS
+    data = generate_manifest(items)
+    print(f"Manifest: {items} items, {len(data) / 1024 / 1024:.2f} MiB compressed")
+    a = measure("classic", classic, data)
+    b = measure("streamed", streamed, data)
+    assert [f.path for f in a] == [f.path for f in b]
+
+
+if __name__ == "__main__":
+    main()
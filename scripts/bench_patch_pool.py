@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing import Queue
+from multiprocessing.shared_memory import SharedMemory
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from gogdl.dl.objects.generic import TaskFlag, TerminateWorker
+from gogdl.dl.workers import task_executor
+
+# Script used to benchmark applying many xdelta3 patches in the writer
+# compared to a pool of patch workers. Patches are streamed to the decoders
+# in 1 MiB chunks, read by the writer from .delta files.
+# Requires gogdl_xdelta3 to be importable and an xdelta3 binary used to
+# encode the patches, e.g.
+#   bench_patch_pool.py /usr/bin/xdelta3 [files] [file size MiB] [workers]
+
+FILES = 16
+FILE_SIZE = 64
+CHUNK_SIZE = 1024 * 1024
+
+
+def generate(directory, files, file_size, encoder):
+    rng = random.Random(0)
+    for i in range(files):
+        source = rng.randbytes(file_size)
+        target = bytearray(source)
+        for _ in range(64):
+            offset = rng.randrange(len(target) - 4096)
+            target[offset:offset + 4096] = rng.randbytes(4096)
+        with open(os.path.join(directory, f"file_{i}.src"), "wb") as f:
+            f.write(source)
+        with open(os.path.join(directory, f"file_{i}.tgt"), "wb") as f:
+            f.write(target)
+        subprocess.run([encoder, "-e", "-f", "-S", "none", "-s",
+                        os.path.join(directory, f"file_{i}.src"),
+                        os.path.join(directory, f"file_{i}.tgt"),
+                        os.path.join(directory, f"file_{i}.patch")], check=True)
+
+
+def prepare(directory, game, files):
+    shutil.rmtree(game, ignore_errors=True)
+    os.makedirs(game)
+    for i in range(files):
+        shutil.copyfile(os.path.join(directory, f"file_{i}.src"), os.path.join(game, f"file_{i}"))
+        shutil.copyfile(os.path.join(directory, f"file_{i}.patch"), os.path.join(game, f"file_{i}.delta"))
+
+
+def run(game, files, workers):
+    shared_memory = SharedMemory(create=True, size=1024 * 1024)
+    writer_queue, results_queue, speed_queue = Queue(), Queue(), Queue()
+    patch_queues = [Queue() for _ in range(workers)]
+    stop = threading.Event()
+
+    def drain():
+        while not stop.is_set() or not speed_queue.empty():
+            try:
+                speed_queue.get(timeout=0.1)
+            except Exception:
+                pass
+
+    drain_thread = threading.Thread(target=drain)
+    drain_thread.start()
+
+    writer = task_executor.Writer(shared_memory.name, writer_queue, results_queue, speed_queue,
+                                  os.path.join(game, ".cache"), patch_queues)
+    patchers = [task_executor.Patcher(shared_memory.name, patch_queue, results_queue, speed_queue) for patch_queue in patch_queues]
+    for process in [writer] + patchers:
+        process.start()
+
+    start = time.perf_counter()
+    tasks = 0
+    for i in range(files):
+        writer_queue.put(task_executor.WriterTask(game, f"file_{i}", TaskFlag.OPEN_FILE | TaskFlag.PATCH, old_file=f"file_{i}"))
+        patch_size = os.path.getsize(os.path.join(game, f"file_{i}.delta"))
+        for offset in range(0, patch_size, CHUNK_SIZE):
+            writer_queue.put(task_executor.WriterTask(game, f"file_{i}", TaskFlag.NONE, old_file=f"file_{i}.delta",
+                                                      old_offset=offset, size=min(CHUNK_SIZE, patch_size - offset)))
+            tasks += 1
+        writer_queue.put(task_executor.WriterTask(game, f"file_{i}", TaskFlag.CLOSE_FILE | TaskFlag.PATCH))
+        tasks += 2
+    for _ in range(tasks):
+        result = results_queue.get()
+        assert result.success, f"Patch failed {result.task.file_path}"
+    elapsed = time.perf_counter() - start
+
+    writer_queue.put(TerminateWorker())
+    for patch_queue in patch_queues:
+        patch_queue.put(TerminateWorker())
+    for process in [writer] + patchers:
+        process.join()
+    stop.set()
+    drain_thread.join()
+    shared_memory.close()
+    shared_memory.unlink()
+    return elapsed
+
+
+def verify(directory, game, files):
+    for i in range(files):
+        with open(os.path.join(directory, f"file_{i}.tgt"), "rb") as expected, open(os.path.join(game, f"file_{i}"), "rb") as got:
+            assert expected.read() == got.read(), f"file_{i} differs"
+        assert not os.path.exists(os.path.join(game, f"file_{i}.tmp"))
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} <xdelta3 binary> [files] [file size MiB] [workers]")
+        sys.exit(1)
+    encoder = sys.argv[1]
+    files = int(sys.argv[2]) if len(sys.argv) > 2 else FILES
+    file_size = (int(sys.argv[3]) if len(sys.argv) > 3 else FILE_SIZE) * 1024 * 1024
+    workers = int(sys.argv[4]) if len(sys.argv) > 4 else os.cpu_count()
+
+    with tempfile.TemporaryDirectory() as directory:
+        generate(directory, files, file_size, encoder)
+        game = os.path.join(directory, "game")
+        print(f"{files} patched files, {file_size // 1024 // 1024} MiB each")
+        for name, count in (("writer", 0), ("1 patch worker", 1), (f"{workers} patch workers", workers)):
+            prepare(directory, game, files)
+            elapsed = run(game, files, count)
+            verify(directory, game, files)
+            print(f"{name:>20}: {elapsed:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
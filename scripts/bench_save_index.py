@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from gogdl import constants, saves
+
+# Script used to benchmark listing and hashing local saves before sync.
+# Creates a directory with many small files and compares a cold run
+# (empty hash index), a warm run and a warm run after a few files changed, e.g.
+#   bench_save_index.py [files] [file size KiB]
+
+FILES = 5000
+FILE_SIZE = 16
+CHANGED = 10
+
+
+def generate(directory, files, file_size):
+    # Files are dated in the past, so they aren't considered racy
+    past = time.time() - 3600
+    for i in range(files):
+        subdirectory = os.path.join(directory, f"slot_{i % 50}")
+        os.makedirs(subdirectory, exist_ok=True)
+        path = os.path.join(subdirectory, f"save_{i}.dat")
+        with open(path, "wb") as f:
+            f.write(os.urandom(file_size // 2) + b"\0" * (file_size - file_size // 2))
+        os.utime(path, (past, past))
+
+
+def run(manager):
+    start = time.perf_counter()
+    files = manager.get_local_files()
+    return time.perf_counter() - start, {f.relative_path: f.md5 for f in files}
+
+
+def main():
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else FILES
+    file_size = (int(sys.argv[2]) if len(sys.argv) > 2 else FILE_SIZE) * 1024
+
+    with tempfile.TemporaryDirectory() as directory:
+        constants.SAVES_INDEX_DIR = os.path.join(directory, "index")
+        sync_path = os.path.join(directory, "saves")
+        generate(sync_path, files, file_size)
+
+        manager = saves.CloudStorageManager(None, None)
+        manager.sync_path = sync_path
+        manager.cloud_save_dir_name = "saves"
+        manager.arguments = argparse.Namespace(id="1234")
+
+        print(f"{files} files, {file_size // 1024} KiB each")
+        elapsed, cold = run(manager)
+        print(f"{'cold':>20}: {elapsed:.3f}s")
+        elapsed, warm = run(manager)
+        assert warm == cold, "warm run differs"
+        print(f"{'warm':>20}: {elapsed:.3f}s")
+
+        past = time.time() - 60
+        for i in range(CHANGED):
+            path = os.path.join(sync_path, f"slot_{i % 50}", f"save_{i}.dat")
+            with open(path, "ab") as f:
+                f.write(b"changed")
+            os.utime(path, (past, past))
+        elapsed, changed = run(manager)
+        assert sum(changed[path] != cold[path] for path in cold) == CHANGED
+        print(f"{f'{CHANGED} files changed':>20}: {elapsed:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+import argparse
+import contextlib
+import gzip
+import hashlib
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from gogdl import constants, saves
+
+# Script used to benchmark cloud saves sync against a local stand-in for the cloudstorage API.
+# The server adds a fixed latency to every file request, so the effect of syncing
+# in parallel is visible. Uploads, downloads and clears the same saves with 1 and
+# with the default number of workers, checking downloaded files match, e.g.
+#   bench_save_sync.py [files] [file size KiB] [latency ms]
+
+FILES = 200
+FILE_SIZE = 64
+LATENCY = 50
+
+
+class CloudStorage(ThreadingHTTPServer):
+    def __init__(self, latency):
+        super().__init__(("127.0.0.1", 0), CloudStorageHandler)
+        self.latency = latency
+        # name -> (gzipped data, md5, last modified)
+        self.files = dict()
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+
+    def track(self, delta):
+        with self.lock:
+            self.active += delta
+            self.max_active = max(self.max_active, self.active)
+
+
+class CloudStorageHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def get_name(self):
+        # /v1/{user}/{client}/{dirname}/{path}
+        return urllib.parse.unquote("/".join(self.path.split("?")[0].split("/")[4:]))
+
+    def reply(self, status, body=b"", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or dict()).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if not self.get_name():
+            files = [{"name": name, "hash": md5, "last_modified": last_modified}
+                     for name, (_, md5, last_modified) in self.server.files.items()]
+            self.reply(200, json.dumps(files).encode())
+            return
+        self.server.track(1)
+        time.sleep(self.server.latency)
+        data, _, last_modified = self.server.files[self.get_name()]
+        self.reply(200, data, {"Content-Encoding": "gzip", "X-Object-Meta-LocalLastModified": last_modified})
+        self.server.track(-1)
+
+    def do_PUT(self):
+        self.server.track(1)
+        time.sleep(self.server.latency)
+        data = self.rfile.read(int(self.headers["Content-Length"]))
+        assert hashlib.md5(data).hexdigest() == self.headers["Etag"], "Etag doesn't match uploaded data"
+        gzip.decompress(data)
+        self.server.files[self.get_name()] = (data, self.headers["Etag"],
+                                              self.headers["X-Object-Meta-LocalLastModified"])
+        self.reply(201)
+        self.server.track(-1)
+
+    def do_DELETE(self):
+        self.server.track(1)
+        time.sleep(self.server.latency)
+        self.server.files.pop(self.get_name(), None)
+        self.reply(204)
+        self.server.track(-1)
+
+
+def generate(directory, files, file_size):
+    for i in range(files):
+        subdirectory = os.path.join(directory, f"slot_{i % 10}")
+        os.makedirs(subdirectory, exist_ok=True)
+        with open(os.path.join(subdirectory, f"save {i}.dat"), "wb") as f:
+            f.write(os.urandom(file_size // 2) + b"\0" * (file_size - file_size // 2))
+
+
+def create_manager():
+    manager = saves.CloudStorageManager(None, None)
+    manager.get_auth_ids = lambda: ("client_id", "client_secret")
+
+    def get_auth_token():
+        manager.credentials = {"user_id": "user", "access_token": "token"}
+    manager.get_auth_token = get_auth_token
+    return manager
+
+
+def run(server, function, path, workers):
+    server.max_active = 0
+    arguments = argparse.Namespace(path=path, id="1234", timestamp="0", dirname="saves",
+                                   prefered_action=None, workers_count=workers, platform="windows")
+    start = time.perf_counter()
+    # Sync prints timestamp for Heroic
+    with contextlib.redirect_stdout(io.StringIO()):
+        function(create_manager(), arguments)
+    return time.perf_counter() - start
+
+
+def same_files(source, destination):
+    for directory, _, files in os.walk(source):
+        for name in files:
+            path = os.path.join(directory, name)
+            with open(path, "rb") as f, open(os.path.join(destination, os.path.relpath(path, source)), "rb") as g:
+                if f.read() != g.read():
+                    return False
+    return True
+
+
+def main():
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else FILES
+    file_size = (int(sys.argv[2]) if len(sys.argv) > 2 else FILE_SIZE) * 1024
+    latency = (int(sys.argv[3]) if len(sys.argv) > 3 else LATENCY) / 1000
+
+    server = CloudStorage(latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    constants.GOG_CLOUDSTORAGE = f"http://127.0.0.1:{server.server_port}"
+
+    with tempfile.TemporaryDirectory() as directory:
+        constants.SAVES_INDEX_DIR = os.path.join(directory, "index")
+        source = os.path.join(directory, "saves")
+        generate(source, files, file_size)
+
+        print(f"{files} files, {file_size // 1024} KiB each, {int(latency * 1000)} ms latency")
+        for workers in (1, saves.SYNC_WORKERS):
+            server.files.clear()
+            elapsed = run(server, lambda manager, arguments: manager.sync(arguments, []), source, workers)
+            assert len(server.files) == files, "not every file was uploaded"
+            print(f"{f'upload, {workers} workers':>22}: {elapsed:.3f}s, {server.max_active} at once")
+
+            destination = os.path.join(directory, f"download_{workers}")
+            elapsed = run(server, lambda manager, arguments: manager.sync(arguments, []), destination, workers)
+            assert same_files(source, destination), "downloaded files differ"
+            print(f"{f'download, {workers} workers':>22}: {elapsed:.3f}s, {server.max_active} at once")
+
+            elapsed = run(server, lambda manager, arguments: manager.clear(arguments, []), destination, workers)
+            assert not server.files, "not every file was deleted"
+            print(f"{f'clear, {workers} workers':>22}: {elapsed:.3f}s, {server.max_active} at once")
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import gogdl_xdelta3
+
+# Script used to benchmark gogdl_xdelta3 source access modes.
+# Generates a source file and targets copying from it with different
+# locality, encodes them with an xdelta3 binary and applies the patches
+# with the block cache of various sizes and with mmap, e.g.
+#   bench_xdelta3.py /usr/bin/xdelta3 [source size MiB]
+
+SOURCE_SIZE = 512
+PIECE = 64 * 1024
+
+CONFIGS = (
+    ("cache 32 x 8 MiB", {}),
+    ("cache 8 x 8 MiB", {"cache_blocks": 8}),
+    ("cache 128 x 1 MiB", {"block_size": 1 << 20, "cache_blocks": 128}),
+    ("mmap", {"use_mmap": True}),
+)
+
+
+class NullQueue:
+    def put(self, item):
+        pass
+
+
+def sequential(rng, size):
+    # Source with a few small edits, copies follow the source order
+    pieces = [(offset, PIECE) for offset in range(0, size, PIECE)]
+    for i in rng.sample(range(len(pieces)), len(pieces) // 50):
+        pieces[i] = None
+    return pieces
+
+
+def local(rng, size):
+    # Pieces moved around within a 16 MiB neighbourhood
+    pieces = [(offset, PIECE) for offset in range(0, size, PIECE)]
+    window = 16 * 1024 * 1024 // PIECE
+    for start in range(0, len(pieces), window):
+        chunk = pieces[start:start + window]
+        rng.shuffle(chunk)
+        pieces[start:start + window] = chunk
+    return pieces
+
+
+def scattered(rng, size):
+    # Pieces copied from anywhere in the source
+    return [(rng.randrange(0, size - PIECE), PIECE) for _ in range(size // PIECE)]
+
+
+PROFILES = (("sequential", sequential), ("local", local), ("scattered", scattered))
+
+
+def write_target(rng, source, pieces, path):
+    with open(path, "wb") as f:
+        for piece in pieces:
+            if piece is None:
+                f.write(os.urandom(PIECE))
+            else:
+                offset, size = piece
+                f.write(source[offset:offset + size])
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} <xdelta3 binary> [source size MiB]")
+        sys.exit(1)
+    encoder = sys.argv[1]
+    size = (int(sys.argv[2]) if len(sys.argv) > 2 else SOURCE_SIZE) * 1024 * 1024
+    rng = random.Random(0)
+
+    with tempfile.TemporaryDirectory() as directory:
+        source_path = os.path.join(directory, "source")
+        source = os.urandom(size)
+        with open(source_path, "wb") as f:
+            f.write(source)
+
+        print(f"Source {size // 1024 // 1024} MiB")
+        for profile, generate in PROFILES:
+            target_path = os.path.join(directory, profile)
+            patch_path = target_path + ".delta"
+            write_target(rng, source, generate(rng, size), target_path)
+            subprocess.run([encoder, "-e", "-f", "-S", "none", "-B", str(size),
+                            "-s", source_path, target_path, patch_path], check=True)
+            with open(target_path, "rb") as f:
+                expected = f.read()
+            print(f"{profile}: patch {os.path.getsize(patch_path) / 1024 / 1024:.2f} MiB")
+
+            for name, kwargs in CONFIGS:
+                output = os.path.join(directory, "output")
+                start = time.perf_counter()
+                gogdl_xdelta3.patch(source_path, patch_path, output, NullQueue(), **kwargs)
+                elapsed = time.perf_counter() - start
+                with open(output, "rb") as f:
+                    assert f.read() == expected, f"{profile} {name}: output differs"
+                print(f"{name:>30}: {elapsed:.3f}s")
+            os.remove(target_path)
+
+
+if __name__ == "__main__":
+    main()
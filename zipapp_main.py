@@ -1,8 +1,8 @@
 # This is Linux only right now
 
 import os
+import shutil
 import sys
-import zlib
 import zipfile
 
 cache_path = os.path.join(
@@ -13,16 +13,32 @@ vendored_packages_path = os.path.join(cache_path, 'vendored')
 vendored_packages_lock = os.path.join(cache_path, 'vendored.lock')
 if zipfile.is_zipfile(os.path.dirname(__file__)):
     with zipfile.ZipFile(os.path.dirname(__file__)) as zf:
-        should_extract = True
-        gogdl_xdelta = os.path.join(vendored_packages_path, 'gogdl_xdelta3.abi3.so')
         xdelta = zf.getinfo('gogdl_xdelta3.abi3.so')
-        if os.path.exists(gogdl_xdelta):
-            with open(gogdl_xdelta, 'rb') as f:
-                crc = zlib.crc32(f.read())
-                should_extract = xdelta.CRC != crc
-        if should_extract:
-            extracted = zf.extract(xdelta, vendored_packages_path)
-            extracted = os.chmod(extracted, xdelta.external_attr >> 16)
+        # Extension is extracted to a directory named after its CRC,
+        # so checking if it's up to date needs a single stat instead of hashing it
+        vendored_packages_path = os.path.join(vendored_packages_path, f'{xdelta.CRC:08x}')
+        gogdl_xdelta = os.path.join(vendored_packages_path, 'gogdl_xdelta3.abi3.so')
+        if not os.path.exists(gogdl_xdelta):
+            os.makedirs(vendored_packages_path, exist_ok=True)
+            tmp_path = f'{gogdl_xdelta}.{os.getpid()}.tmp'
+            with zf.open(xdelta) as src, open(tmp_path, 'wb') as dst:
+                dst.write(src.read())
+            os.chmod(tmp_path, (xdelta.external_attr >> 16) or 0o755)
+            os.replace(tmp_path, gogdl_xdelta)
+
+            # Remove extensions left by previous versions, older ones were extracted to vendored/ itself
+            vendored_root = os.path.dirname(vendored_packages_path)
+            for name in os.listdir(vendored_root):
+                old_path = os.path.join(vendored_root, name)
+                if name == f'{xdelta.CRC:08x}':
+                    continue
+                if os.path.isdir(old_path):
+                    shutil.rmtree(old_path, ignore_errors=True)
+                else:
+                    try:
+                        os.remove(old_path)
+                    except OSError:
+                        pass
 
     sys.path.insert(0, vendored_packages_path)
 